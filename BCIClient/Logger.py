@@ -1,18 +1,71 @@
+import queue
+import atexit
 import logging
+import logging.handlers
 
 logger_kwargs = dict(
     level_file=logging.DEBUG,
     level_console=logging.DEBUG,
     format_file='%(asctime)s %(name)s %(levelname)-8s %(message)-40s {{%(filename)s:%(lineno)s:%(module)s:%(funcName)s}}',
-    format_console='%(asctime)s %(name)s %(levelname)-8s %(message)-40s {{%(filename)s:%(lineno)s}}'
+    format_console='%(asctime)s %(name)s %(levelname)-8s %(message)-40s {{%(filename)s:%(lineno)s}}',
+    queue_size=10000
 )
 
+# The queue handlers of the loggers, the key is the name of the logger
+queue_handlers = dict()
 
-def generate_logger(name, filepath, level_file, level_console, format_file, format_console):
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    ''' The queue handler with bounded buffering,
+    the records are dropped when the queue is full,
+    and the number of the dropped records is counted.
+    '''
+
+    def __init__(self, queue):
+        super(DroppingQueueHandler, self).__init__(queue)
+        self.dropped = 0
+        self._unreported = 0
+
+    def prepare(self, record):
+        # The record is formatted by the writer thread,
+        # so nothing is done on the calling thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+            return
+
+        if self._unreported > 0:
+            n = self._unreported
+            self._unreported = 0
+            try:
+                self.queue.put_nowait(logging.makeLogRecord(dict(
+                    name=record.name,
+                    levelno=logging.WARNING,
+                    levelname='WARNING',
+                    msg='%d log records are dropped since the logging queue is full',
+                    args=(n,),
+                )))
+            except queue.Full:
+                self._unreported += n
+
+
+def generate_logger(name, filepath, level_file, level_console, format_file, format_console, queue_size=10000):
+    ''' Generate the logger of [name],
+    the records are put into the bounded queue and written by the background writer thread,
+    so the calling threads never format or write the records.
+    '''
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
 
-    file_handler = logging.FileHandler(filepath)
+    # The disabled levels are filtered before the records are made
+    logger.setLevel(min(level_file, level_console))
+
+    # The file is created on the first record written to it
+    file_handler = logging.FileHandler(filepath, delay=True)
     file_handler.setFormatter(logging.Formatter(format_file))
     file_handler.setLevel(level_file)
 
@@ -20,7 +73,39 @@ def generate_logger(name, filepath, level_file, level_console, format_file, form
     console_handler.setFormatter(logging.Formatter(format_console))
     console_handler.setLevel(level_console)
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    queue_handler = DroppingQueueHandler(queue.Queue(queue_size))
+    listener = logging.handlers.QueueListener(queue_handler.queue,
+                                              file_handler,
+                                              console_handler,
+                                              respect_handler_level=True)
+    listener.start()
+
+    def stop():
+        # The queued records are written before the interpreter exits,
+        # and the total of the dropped records is written directly by the handlers
+        listener.stop()
+        if queue_handler.dropped > 0:
+            record = logging.makeLogRecord(dict(
+                name=name,
+                levelno=logging.WARNING,
+                levelname='WARNING',
+                msg='%d log records are dropped in total since the logging queue is full',
+                args=(queue_handler.dropped,),
+            ))
+            for handler in listener.handlers:
+                handler.handle(record)
+
+    atexit.register(stop)
+
+    logger.addHandler(queue_handler)
+    queue_handlers[name] = queue_handler
 
     return logger
+
+
+def dropped_records(name):
+    ''' The number of the dropped records of the logger of [name] '''
+    handler = queue_handlers.get(name, None)
+    if handler is None:
+        return 0
+    return handler.dropped
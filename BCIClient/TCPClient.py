@@ -4,14 +4,22 @@ Aim: Define TCP client object for BCI application.
 '''
 
 # Imports
+import os
 import time
 import socket
-import threading
 import traceback
 
 # Local Imports
 from .sessions import TrainSession, BuildSession, ActiveSession, PassiveSession
 from . import logger, tcp_params, decode, encode, pack, unpack, active_interval
+from . import telemetry
+from . import profiler
+from . import metrics
+from .heartbeat import Heartbeat
+from .link import Link
+from .outbox import Outbox, is_urgent
+from protocol import dumps, Splitter, SCHEMAS, KEEP_ALIVE_REQUEST, KEEP_ALIVE_REPLY, keepAliveReply
+from protocol.dispatcher import Dispatcher
 
 # ------------------------------------------------------
 # Pack Useful Messages
@@ -20,9 +28,8 @@ from . import logger, tcp_params, decode, encode, pack, unpack, active_interval
 
 
 def keepAliveMessage(count='0'):
-    ''' Make keep alive message '''
-    logger.debug(f'Make keepAliveMessage')
-    return pack(dict(method='keepAlive', count=count))
+    ''' Make keep alive message, the bytes are encoded on import '''
+    return KEEP_ALIVE_REQUEST if count == '0' else KEEP_ALIVE_REPLY
 
 # Error Messages of Invalid Message Received
 
@@ -47,18 +54,37 @@ def operationFailedError(raw, detail='undefinedError', comment=''):
                      raw=raw,
                      comment=comment))
 
+# Shadow Decoders
+# The shadow decoders are given as the paths separated by ';'
+
+
+def shadowModelPaths(dct):
+    ''' Get the paths of the shadow decoders from the message [dct] '''
+    paths = dct.get('shadowModelPaths', '')
+    return [e.strip() for e in paths.split(';') if e.strip()]
+
 # TCPClient
 
 
 class TCPClient(object):
     ''' TCP client object,
     it connects to the TCP server, sends and receives messages.
+    The sessions are kept in the [link],
+    so they keep running when the connection drops and the new client resumes them.
     '''
 
-    def __init__(self, IP=tcp_params['IP'], port=tcp_params['port'], buffer_size=tcp_params['buffer_size']):
-        ''' Initialize and setup client '''
+    def __init__(self, IP=tcp_params['IP'], port=tcp_params['port'], buffer_size=tcp_params['buffer_size'], link=None):
+        ''' Initialize and setup client
+
+        Args:
+        - @IP, @port: The address of the server;
+        - @buffer_size: The size of every receiving;
+        - @link: The link keeps the sessions across the reconnections, None refers a new link.
+        '''
         client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         client.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # The labels are sent at once instead of waiting for the Nagle's algorithm
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
         # Connet to IP:port
         client.connect((IP, port))
@@ -71,21 +97,45 @@ class TCPClient(object):
         self.name = name
         logger.info(f'TCP Client is initialized as {name} to {IP}')
 
-        self.session = None
+        # The running sessions, the key is the sessionName,
+        # the sessions of different names run concurrently on the shared acquisition stream,
+        # they are owned by the link and kept across the reconnections
+        self.link = Link() if link is None else link
+        self.sessions = self.link.sessions
+
+        # The dispatch table of the incoming messages
+        self.dispatcher = self._register_handlers()
+        # The incoming messages are reassembled from the stream of the connection
+        self.splitter = Splitter()
+
+        # The outbound writer, it owns the socket for sending,
+        # the messages are queued by the priorities and the bulk messages are coalesced
+        self.outbox = Outbox(client.sendall, on_error=self._on_send_failed)
+
+        # The adaptive heartbeat, it measures the RTT and detects the dead connection
+        self.heartbeat = Heartbeat(self.send, self._on_dead)
+
+        # The metrics of the current connection replace the ones of the closed connection
+        metrics.gauge('outbox', self.outbox.metrics)
+        metrics.gauge('heartbeat', self.heartbeat.metrics)
+
+        # The sessions send through the link from now on
+        self.link.attach(self)
 
         # Keep listening
         self.keep_listen()
 
     def close(self):
-        ''' Close the session '''
+        ''' Close the connection,
+        the sessions keep running in the link, they are stopped by link.close
+        '''
         # Close the client
+        self.heartbeat.stop()
+        self.link.detach(self)
+        self.outbox.close()
         self.client.close()
         self.is_connected = False
 
-        # Stop the data stack
-        if self.session is not None:
-            self.session.ds.stop()
-
         logger.info(f'Client closed: {self.serverIP}')
 
     def keep_listen(self):
@@ -96,213 +146,38 @@ class TCPClient(object):
         '''
         logger.info(f'Start listening to {self.serverIP}')
 
-        thread = threading.Thread(target=self._keep_send_keepAliveMessages)
-        thread.setDaemon(True)
-        thread.start()
+        self.heartbeat.start()
 
         while True:
             try:
                 # ----------------------------------------------------------------
                 # Wait until new message is received
                 income = self.client.recv(self.buffer_size)
+                telemetry.record(telemetry.RECEIVE, a=len(income))
 
                 if income == b'':
                     logger.debug('Received empty message')
                     break
-                logger.debug(f'Received message: {income}')
+                logger.debug('Received message: %s', income)
 
                 # ----------------------------------------------------------------
                 # Unpack incoming message.
-                # It should be json object and parsed into a dict.
-                dct = unpack(income)
+                # It should be json objects and parsed into dicts,
+                # several messages may arrive together, and a message may arrive in pieces.
+                dcts, errors = self.splitter.feed(income)
                 # If unpack fails,
                 # send invalid message error.
-                if dct is None:
-                    self.send(invalidMessageError(income,
+                for raw in errors:
+                    self.send(invalidMessageError(raw,
                                                   comment=f'Illegal JSON from {self.serverIP}'))
-                    continue
-
-                logger.debug(f'Parsed message "{dct}" from {self.serverIP}')
-
-                # ----------------------------------------------------------------
-                # Keep alive message
-                if all([dct.get('method', None) == 'keepAlive',
-                        dct.get('count', None) == '0']):
-                    logger.debug(f'Received keepAlive message')
-                    self.send(keepAliveMessage('1'))
-                    continue
-
-                if all([dct.get('method', None) == 'keepAlive',
-                        dct.get('count', None) == '1']):
-                    logger.debug(
-                        f'Received replied keepAlive message, doing nothing.')
-                    continue
-
-                # ----------------------------------------------------------------
-                # Start Training Session
-                if all([dct.get('method', None) == 'startSession',
-                        dct.get('sessionName', None) == 'training',
-                        dct.get('dataPath', None) is not None,
-                        self.session == None]):
-
-                    logger.info(f'Training session is starting')
-
-                    # Startup Training Session
-                    try:
-                        kwargs = dict(filepath=dct['dataPath'])
-
-                        self.session = TrainSession(**kwargs)
-                        logger.info(f'Training session started')
-                    except:
-                        self.session = None
-                        error = traceback.format_exc()
-                        logger.error(
-                            f'Failed start training session for "{kwargs}", error is "{error}"')
-                        self.send(operationFailedError(income, comment=error))
-                        continue
-
-                    continue
 
-                # ----------------------------------------------------------------
-                # Start and Finish Build Session
-                if all([dct.get('method', None) == 'startBuilding',
-                        dct.get('sessionName') in [
-                    'youbiaoqian', 'wubiaoqian'],
-                        dct.get('dataPath', None) is not None,
-                        dct.get('modelPath', None) is not None,
-                        self.session == None]):
-
-                    t_start = time.time()
-                    logger.info(f'Building session is starting')
-
-                    # Starting Building Session
-                    try:
-                        kwargs = dict(sessionname=dct['sessionName'],
-                                      filepath=dct['dataPath'],
-                                      decoderpath=dct['modelPath'])
-
-                        self.session = BuildSession(**kwargs)
-                        logger.info(f'Building session started')
-                    except:
-                        self.session = None
-                        error = traceback.format_exc()
-                        logger.error(
-                            f'Failed start building session for "{kwargs}", error is "{error}"')
-                        self.send(operationFailedError(income, comment=error))
-                        continue
-
-                    # Compute Accuracy using Validation
-                    try:
-                        acc = self.session.decoder.k_fold_valid()
-                        logger.info(
-                            f'Validation Accuracy is Computed, Accuracy is {acc}')
-                        self.send(dict(method='stopBuilding',
-                                       sessionName=dct['sessionName'],
-                                       validAccuracy=f'{acc}'))
-                    except:
-                        self.session = None
-                        error = traceback.format_exc()
-                        logger.error(
-                            f'Failed computing validation accuracy for "{kwargs}", error is "{error}"')
-                        self.send(operationFailedError(income, comment=error))
-                        continue
-
-                    self.session = None
-                    cost = time.time() - t_start
-                    logger.info(
-                        f'Building session finished, costing "{cost}" seconds')
-                    continue
-
-                # ----------------------------------------------------------------
-                # Start Active Session
-                if all([dct.get('method', None) == 'startSession',
-                        dct.get('sessionName', None) == 'wubiaoqian',
-                        dct.get('dataPath', None) is not None,
-                        dct.get('modelPath', None) is not None,
-                        self.session == None]):
-                    logger.info(f'Active session is starting')
-
-                    # Start Active Session
-                    try:
-                        kwargs = dict(
-                            filepath=dct['dataPath'],
-                            decoderpath=dct['modelPath'],
-                            interval=active_interval,
-                            send=self.send
-                        )
-
-                        self.session = ActiveSession(**kwargs)
-                        logger.info(
-                            f'Active session started, the labels will be sent every {active_interval} seconds.')
-                    except:
-                        self.session = None
-                        error = traceback.format_exc()
-                        logger.error(
-                            f'Failed start active session for "{kwargs}", error is "{error}"')
-                        self.send(operationFailedError(income, comment=error))
-                        continue
-
-                    continue
-
-                # ----------------------------------------------------------------
-                # Start Passive Session
-                if all([dct.get('method', None) == 'startSession',
-                        dct.get('sessionName', None) == 'youbiaoqian',
-                        dct.get('dataPath', None) is not None,
-                        dct.get('modelPath', None) is not None,
-                        dct.get('newModelPath', None) is not None,
-                        dct.get('updateCount', None) is not None,
-                        self.session == None]):
-                    logger.info(f'Passive module is starting')
-
-                    # Start Passive Module
-                    try:
-                        kwargs = dict(
-                            filepath=dct['dataPath'],
-                            decoderpath=dct['modelPath'],
-                            updatedecoderpath=dct['newModelPath'],
-                            update_count=int(dct['updateCount']),
-                            send=self.send,
-                        )
-                        self.session = PassiveSession(**kwargs)
-                        logger.info(
-                            f'Passive session started, the labels will be sent at every requests.')
-                    except:
-                        self.session = None
-                        error = traceback.format_exc()
-                        logger.error(
-                            f'Failed start passive session for "{kwargs}", error is "{error}"')
-                        self.send(operationFailedError(income, comment=error))
-                        continue
-
-                    continue
-
-                # ----------------------------------------------------------------
-                # Feed
-                if self.session is not None:
-                    success, rdct = self.session.receive(dct)
-
-                    logger.debug(
-                        f'Module received {dct}, operation returned {success}:{rdct}')
-
-                    if success == 0:
-                        self.send(rdct)
-                    else:
-                        self.send(invalidMessageError(income,
-                                                      comment=rdct['comment']))
+                for dct in dcts:
+                    logger.debug('Parsed message "%s" from %s',
+                                 dct, self.serverIP)
 
-                    # Remove existing module if it has stopped
-                    if self.session.stopped:
-                        self.session = None
-                        logger.info(
-                            f'Current session stopped for {self.serverIP}.')
-
-                    continue
-
-                # ----------------------------------------------------------------
-                # No operation is done
-                self.send(invalidMessageError(income,
-                                              comment=f'Invalid operation from {self.serverIP}'))
+                    # ----------------------------------------------------------------
+                    # Route the message by the dispatch table
+                    self.dispatcher.dispatch(dct, income)
 
             except KeyboardInterrupt:
                 logger.error(f'Keyboard Interruption is detected')
@@ -314,6 +189,7 @@ class TCPClient(object):
                 break
 
             except Exception as err:
+                telemetry.record(telemetry.ERROR, a=1)
                 detail = traceback.format_exc()
                 print(f'E: {detail}')
                 logger.error(f'Unexpected error: {err}')
@@ -325,28 +201,315 @@ class TCPClient(object):
         self.close()
         logger.info(f'Stopped listening to {self.serverIP}')
 
-    def _keep_send_keepAliveMessages(self):
-        msg = keepAliveMessage('0')
-        logger.debug(f'Start keep sending keepAliveMessage')
-        while True:
-            time.sleep(5)
-            try:
-                self.send(msg)
-            except:
-                err = traceback.format_exc()
-                logger.debug(f'Failed on sending keepAliveMessage: {err}')
-                break
-        logger.debug(f'Stopped keep sending keepAliveMessage')
-
-    def send(self, message):
-        ''' Send [message] to server
+    def _register_handlers(self):
+        # Built-in method of building the dispatch table,
+        # the unrouted messages are fed into the running sessions
+        dispatcher = Dispatcher(default=self._feed)
+
+        dispatcher.register('keepAlive', self._on_keepAlive,
+                            fields=SCHEMAS['keepAliveRequest'])
+        dispatcher.register('keepAlive', self._on_keepAliveReply,
+                            fields=SCHEMAS['keepAliveReply'])
+
+        dispatcher.register('startSession', self._start_training,
+                            sessionName='training',
+                            fields=SCHEMAS['startTraining'],
+                            when=lambda dct: 'training' not in self.sessions)
+
+        for name in ['youbiaoqian', 'wubiaoqian']:
+            dispatcher.register('startBuilding', self._build,
+                                sessionName=name,
+                                fields=SCHEMAS['startBuilding'],
+                                background=True)
+
+        dispatcher.register('startSession', self._start_active,
+                            sessionName='wubiaoqian',
+                            fields=SCHEMAS['startActive'],
+                            when=lambda dct: 'wubiaoqian' not in self.sessions)
+
+        dispatcher.register('startSession', self._start_passive,
+                            sessionName='youbiaoqian',
+                            fields=SCHEMAS['startPassive'],
+                            when=lambda dct: 'youbiaoqian' not in self.sessions)
+
+        dispatcher.register('resumeSession', self._resume,
+                            fields=SCHEMAS['resumeSession'])
+
+        dispatcher.register('profileStart', self._profile_start,
+                            fields=SCHEMAS['profileStart'])
+        dispatcher.register('profileStop', self._profile_stop,
+                            fields=SCHEMAS['profileStop'])
+
+        dispatcher.register('getMetrics', self._get_metrics,
+                            fields=SCHEMAS['getMetrics'])
+
+        # The error messages are never answered by the errors, or the two sides reply each other endlessly
+        dispatcher.register('error', self._on_error)
+
+        return dispatcher
+
+    # ----------------------------------------------------------------
+    # Keep alive message
+    def _on_keepAlive(self, dct, income):
+        logger.debug('Received keepAlive message')
+        self.send(keepAliveReply(dct))
+
+    def _on_error(self, dct, income):
+        logger.warning(f'Received error from {self.serverIP}: {dct}')
+
+    def _on_keepAliveReply(self, dct, income):
+        self.heartbeat.on_reply(dct)
+
+    def _on_send_failed(self, replays):
+        # The socket failed on sending,
+        # the unsent replayable messages are handed back to the link, and the connection is shut down
+        self.link.restore(replays)
+        self._on_dead()
+
+    def _on_dead(self):
+        # The connection is regarded as dead by the heartbeat,
+        # it is shut down so the listening stops at once
+        logger.error(f'Connection to {self.serverIP} is dead, shutting it down')
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # ----------------------------------------------------------------
+    # Start Training Session
+    def _start_training(self, dct, income):
+        logger.info(f'Training session is starting')
+
+        # Startup Training Session
+        try:
+            kwargs = dict(filepath=dct['dataPath'],
+                          send=self.link.sender('training'),
+                          link=self.heartbeat)
+
+            self.sessions['training'] = TrainSession(**kwargs)
+            logger.info(f'Training session started')
+        except:
+            error = traceback.format_exc()
+            logger.error(
+                f'Failed start training session for "{kwargs}", error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+
+    # ----------------------------------------------------------------
+    # Start and Finish Build Session
+    # It runs on independent thread, since the validation is slow
+    def _build(self, dct, income):
+        t_start = time.time()
+        logger.info(f'Building session is starting')
+
+        # Starting Building Session
+        try:
+            kwargs = dict(sessionname=dct['sessionName'],
+                          filepath=dct['dataPath'],
+                          decoderpath=dct['modelPath'])
+
+            session = BuildSession(**kwargs)
+            logger.info(f'Building session started')
+        except:
+            error = traceback.format_exc()
+            logger.error(
+                f'Failed start building session for "{kwargs}", error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+            return
+
+        # Compute Accuracy using Validation
+        try:
+            acc = session.decoder.k_fold_valid()
+            logger.info(
+                f'Validation Accuracy is Computed, Accuracy is {acc}')
+            self.send(dict(method='stopBuilding',
+                           sessionName=dct['sessionName'],
+                           validAccuracy=f'{acc}'))
+        except:
+            error = traceback.format_exc()
+            logger.error(
+                f'Failed computing validation accuracy for "{kwargs}", error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+            return
+
+        cost = time.time() - t_start
+        logger.info(
+            f'Building session finished, costing "{cost}" seconds')
+
+    # ----------------------------------------------------------------
+    # Start Active Session
+    def _start_active(self, dct, income):
+        logger.info(f'Active session is starting')
+
+        # Start Active Session
+        try:
+            kwargs = dict(
+                filepath=dct['dataPath'],
+                decoderpath=dct['modelPath'],
+                interval=active_interval,
+                send=self.link.sender('wubiaoqian'),
+                shadowdecoderpaths=shadowModelPaths(dct),
+                link=self.heartbeat
+            )
+
+            self.sessions['wubiaoqian'] = ActiveSession(**kwargs)
+            logger.info(
+                f'Active session started, the labels will be sent every {active_interval} seconds.')
+        except:
+            error = traceback.format_exc()
+            logger.error(
+                f'Failed start active session for "{kwargs}", error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+
+    # ----------------------------------------------------------------
+    # Start Passive Session
+    def _start_passive(self, dct, income):
+        logger.info(f'Passive module is starting')
+
+        # Start Passive Module
+        try:
+            kwargs = dict(
+                filepath=dct['dataPath'],
+                decoderpath=dct['modelPath'],
+                updatedecoderpath=dct['newModelPath'],
+                update_count=int(dct['updateCount']),
+                send=self.link.sender('youbiaoqian'),
+                shadowdecoderpaths=shadowModelPaths(dct),
+                link=self.heartbeat
+            )
+            self.sessions['youbiaoqian'] = PassiveSession(
+                **kwargs)
+            logger.info(
+                f'Passive session started, the labels will be sent at every requests.')
+        except:
+            error = traceback.format_exc()
+            logger.error(
+                f'Failed start passive session for "{kwargs}", error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+
+    # ----------------------------------------------------------------
+    # Resume Session
+    # The server resumes the sessions after reconnecting,
+    # the messages buffered while the link was down are replayed in order
+    def _resume(self, dct, income):
+        name = dct.get('sessionName', None) or None
+        if name is None:
+            running = sorted(self.sessions)
+        else:
+            running = [name] if name in self.sessions else []
+
+        def replay(replays):
+            # The replays are queued before the link is released,
+            # so the new messages of the sessions are queued after them
+            logger.info(
+                f'Resuming sessions {running}, replaying {len(replays)} buffered messages')
+            self.send(dict(method='sessionResumed',
+                           sessionName=name or '',
+                           runningSessions=';'.join(running),
+                           replayed=f'{len(replays)}'))
+            for sessionName, message in replays:
+                self.send(message, sessionName)
+
+        self.link.take(name, send=replay)
+
+    # ----------------------------------------------------------------
+    # Profile
+    # The sampling profiler of the process is toggled during the live experiment,
+    # the folded stacks are written next to the data of the session
+    def _profile_start(self, dct, income):
+        folder = None
+        if dct.get('dataPath', None):
+            folder = os.path.dirname(dct['dataPath'])
+        elif dct.get('sessionName', None) in self.sessions:
+            folder = os.path.dirname(self.sessions[dct['sessionName']].filepath)
+        elif self.sessions:
+            folder = os.path.dirname(
+                self.sessions[sorted(self.sessions)[0]].filepath)
+
+        try:
+            path = profiler.start(folder or None)
+        except:
+            error = traceback.format_exc()
+            logger.error(f'Failed start profiler, error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+            return
+
+        self.send(dict(method='profileStarted',
+                       profilePath=path,
+                       interval=f'{profiler.interval}'))
+
+    def _profile_stop(self, dct, income):
+        try:
+            stats = profiler.stop()
+        except:
+            error = traceback.format_exc()
+            logger.error(f'Failed stop profiler, error is "{error}"')
+            self.send(operationFailedError(income, comment=error))
+            return
+
+        self.send(dict(method='profileStopped',
+                       profilePath=stats['path'],
+                       samples=f'{stats["samples"]}',
+                       seconds=f'{stats["seconds"]:.3f}',
+                       overhead=f'{stats["overhead"]:.4f}'))
+
+    # ----------------------------------------------------------------
+    # Metrics
+    # The snapshot of the metrics, the values are in strings as the other messages
+    def _get_metrics(self, dct, income):
+        # The [keys] are the prefixes of the requested metrics separated by ',', all of them if it is absent
+        snapshot = metrics.snapshot()
+        keys = [e.strip() for e in dct.get('keys', '').split(',') if e.strip()]
+        if keys:
+            snapshot = {name: value for name, value in snapshot.items()
+                        if any([name == e or name.startswith(e + '.') for e in keys])}
+        out = dict(method='metricsReported')
+        out.update({name: f'{value}' for name, value in snapshot.items()})
+        self.send(out)
+
+    # ----------------------------------------------------------------
+    # Feed
+    def _feed(self, dct, income):
+        name = dct.get('sessionName', None)
+        if name not in self.sessions and len(self.sessions) == 1:
+            name = list(self.sessions)[0]
+
+        if name not in self.sessions:
+            # No operation is done
+            self.send(invalidMessageError(income,
+                                          comment=f'Invalid operation from {self.serverIP}'))
+            return
+
+        session = self.sessions[name]
+        success, rdct = session.receive(dct)
+
+        logger.debug('Module received %s, operation returned %s:%s',
+                     dct, success, rdct)
+
+        if success == 0:
+            self.send(rdct)
+        else:
+            self.send(invalidMessageError(income,
+                                          comment=rdct['comment']))
+
+        # Remove existing module if it has stopped
+        if session.stopped:
+            del self.sessions[name]
+            logger.info(
+                f'Session {name} stopped for {self.serverIP}.')
+
+    def send(self, message, sessionName=None):
+        ''' Send [message] to server,
+        it is queued into the outbox and never blocks on the socket,
+        the urgent messages are sent at once, the others are coalesced.
         Args:
-        - @message: The message to be sent
+        - @message: The message to be sent;
+        - @sessionName: The session of the message, the replayable one is restored to the link if it is not sent.
         '''
         if isinstance(message, dict):
-            msg = encode(pack(message))
-            logger.debug(f'Pack dict message: "{message}"')
+            msg = dumps(message)
         else:
             msg = encode(message)
-        self.client.sendall(msg)
-        logger.debug(f'Sent "{msg}" to {self.serverIP}')
+        if self.outbox.put(msg,
+                           urgent=is_urgent(message),
+                           replay=self.link.replayable(message, sessionName)):
+            logger.debug('Queued "%s" to %s', msg, self.serverIP)
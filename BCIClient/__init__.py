@@ -2,16 +2,22 @@
 
 The setup will be settled;
 The local tools will be generated.
+
+The heavy modules, like the decoder and its ML stack, joblib and the simulation data,
+are loaded when the sessions need them, so importing the package is cheap.
 '''
 
 # Default Imports
 import os
 import time
-import json
 import logging
 import configparser
 
+# The time when the package is imported, the startup is measured from it
+t_import = time.monotonic()
+
 # Custom Imports
+import protocol
 from .Logger import logger_kwargs, generate_logger
 
 # ------------------------------------------------------------------------
@@ -39,6 +45,7 @@ active_interval = int(cfg['Online']['wubiaoqianInterval'])
 logger_kwargs['name'] = 'BCIClient'
 logger_kwargs['level_console'] = eval(
     'logging.{}'.format(cfg['Log']['consoleLogLevel']))
+logger_kwargs['queue_size'] = int(cfg['Log']['queueSize'])
 
 
 def timestr():
@@ -58,59 +65,41 @@ logger_kwargs['filepath'] = logger_file_path
 
 logger = generate_logger(**logger_kwargs)
 
-logger.info('Package initialized')
-
 
 # ------------------------------------------------------------------------
 # Tools
 # Binary Tools
-# The TCP message is binary, so decoding and encoding is necessary.
+# The TCP message is binary, so decoding and encoding is necessary,
+# the codec is shared with the server in the protocol package.
 
 coding = cfg['TCP']['coding']
 
 
 def decode(content, coding=coding):
     ''' Decode [content] if necessary '''
-    t = type(content)
-    logger.debug(f'Decoding "{content}", {t}')
-    if isinstance(content, type(b'')):
-        return content.decode(coding)
-    else:
-        return content
+    return protocol.decode(content, coding)
 
 
 def encode(content, coding=coding):
     ''' Encode [content] if necessary '''
-    t = type(content)
-    logger.debug(f'Encoding "{content}", {t}')
-    if isinstance(content, type('')):
-        return content.encode(coding)
-    else:
-        return content
+    return protocol.encode(content, coding)
 
 # Dict Tools
 # Deal with dict in TCP message.
 
 
 def unpack(pack):
-    ''' Unpack [pack] into dict using json.loads '''
-    try:
-        out = json.loads(pack)
-        logger.debug(f'Unpack "{pack}"')
-        return out
-    except:
+    ''' Unpack [pack] into dict, None is returned if it fails '''
+    out = protocol.unpack(pack)
+    if out is None:
         logger.error(f'Failed to unpack "{pack}"')
-        return None
+    return out
 
 
 def pack(dct):
-    ''' Pack [dct] into bytes using json.dumps '''
+    ''' Pack [dct] into string '''
     try:
-        for key in dct:
-            dct[key] = decode(dct[key])
-        out = json.dumps(dct)
-        logger.debug(f'Pack "{dct}"')
-        return out
+        return protocol.pack(dct)
     except:
         logger.error(f'Failed to pack "{dct}"')
         return None
@@ -0,0 +1,326 @@
+'''
+File: acquisition.py
+Aim: The long-lived acquisition service.
+
+The device stream is opened once per process and keeps running,
+the consumers subscribe and unsubscribe by their names,
+every consumer has its own read cursor and recording window,
+the window is the [start, end) sample indices over the continuously running buffer,
+so the consumers share the data and the socket without duplicating them.
+
+- @AcquisitionService: The service owns the device client;
+- @SharedAcquisitionService: The service reads the stream published by the acquisition process through the shared memory;
+- @Consumer: The named consumer of the stream;
+- @get_service: Get the service of the device, it is created on the first call.
+'''
+
+import atexit
+import threading
+import traceback
+
+from . import logger, cfg, metrics
+from .neuroScanToolbox import NeuroScanDeviceClient, simulationMode, maxLength
+from .sharedMemory import SharedStreamClient
+from . import multiSource
+
+n_channels = int(cfg['EEG']['numChannels'])  # Number of channels
+freq = int(cfg['EEG']['sampleRate'])  # Hz
+eeg_IP = cfg['EEG']['deviceIP']
+eeg_port = int(cfg['EEG']['devicePort'])
+# The name of the shared memory published by the acquisition process,
+# empty refers the acquisition runs in this process
+shared_memory_name = cfg['EEG']['sharedMemoryName']
+
+
+class Consumer(object):
+    ''' The named consumer of the stream,
+    it has its own read cursor and recording window over the continuously running buffer.
+
+    Useful methods:
+    - @close: Mark the end of the window;
+    - @get_data: Get the data of the window;
+    - @latest: Get the latest data of the window;
+    - @read_new: Get the data after the cursor, and move the cursor to the latest sample.
+    '''
+
+    def __init__(self, nsclient, name, start, autoDetectLabelFlag=False, predict=None):
+        ''' Initialize the consumer
+
+        Args:
+        - @nsclient: The device client of the service;
+        - @name: The name of the consumer;
+        - @start: The first sample index of the window, the cursor starts from it;
+        - @autoDetectLabelFlag: The flag of automatically detect 33 label, if it detected, the predict function will be called;
+        - @predict: Predict function, used for autoDetectLabelFlag.
+        '''
+        self.nsclient = nsclient
+        self.name = name
+        self.start = start
+        self.end = None
+        self.cursor = start
+        self.autoDetectLabelFlag = autoDetectLabelFlag
+        self.predict = predict
+
+    @property
+    def closed(self):
+        return self.end is not None
+
+    def close(self):
+        ''' Mark the end of the window as the latest sample '''
+        if self.end is None:
+            self.end = self.nsclient.data_length
+            logger.debug(
+                f'Consumer "{self.name}" is closed as [{self.start}, {self.end})')
+
+    def get_data(self, out=None):
+        ''' Get the data of the window,
+        it is read-only unless it is copied into the [out], see RingBuffer.read.
+        '''
+        return self.nsclient.get_range(self.start, self.end, out)
+
+    def latest(self, n, out=None):
+        ''' Get the latest [n] samples of the window,
+        it is read-only unless it is copied into the [out], see RingBuffer.read.
+        '''
+        stop = self.nsclient.data_length if self.end is None else self.end
+        return self.nsclient.get_range(max(self.start, stop - n), stop, out)
+
+    def read_new(self):
+        ''' Get the data after the cursor, and move the cursor to the latest sample of the window '''
+        stop = self.nsclient.data_length if self.end is None else self.end
+        d = self.nsclient.get_range(self.cursor, stop)
+        self.cursor = stop
+        return d
+
+
+class AcquisitionService(object):
+    ''' The acquisition service,
+    it keeps the device stream open across the sessions.
+
+    Useful methods:
+    - @start: Connect to the device and start the stream, it is automatically called on subscribing;
+    - @subscribe: Subscribe new named consumer starting from the latest sample;
+    - @unsubscribe: Unsubscribe the consumer;
+    - @report: Report the consumers and their cursors;
+    - @shutdown: Stop the stream and disconnect from the device.
+    '''
+
+    def __init__(self, eeg_IP=eeg_IP, eeg_port=eeg_port, n_channels=n_channels, freq=freq, simulationMode=simulationMode):
+        ''' Initialize the service, the device is not connected until @start.
+
+        Args:
+        - @eeg_IP: The IP address of the EEG device, has default value;
+        - @eeg_port: The port number of the EEG device, has default value;
+        - @n_channels: Number of channels, has default value;
+        - @freq: The sampling frequency, has default value;
+        - @simulationMode: If use simulation mode, the data is generated instead of collected from the device.
+        '''
+        self.eeg_IP = eeg_IP
+        self.eeg_port = eeg_port
+        self.n_channels = n_channels
+        self.freq = freq
+        self.simulationMode = simulationMode
+
+        self.nsclient = None
+        self.consumers = dict()
+        self.lock = threading.Lock()
+
+    def start(self):
+        ''' Connect to the device and start the stream, do nothing if it has started '''
+        with self.lock:
+            if self.nsclient is not None:
+                return
+
+            # The merged buffer keeps the data of the merged sources,
+            # so the device only buffers the samples waiting for merging
+            nsclient = NeuroScanDeviceClient(self.eeg_IP,
+                                             self.eeg_port,
+                                             self.freq,
+                                             self.n_channels,
+                                             simulationMode=self.simulationMode,
+                                             maxLength=multiSource.source_seconds if multiSource.source_names else maxLength,
+                                             autoDetectLabelFlag=not multiSource.source_names,
+                                             predict=self._on_label)
+
+            # The extra sources are merged with the device, the 33 label is detected on the merged stream
+            if multiSource.source_names:
+                nsclient = multiSource.MultiSourceClient([('eeg', nsclient)] + multiSource.config_sources(),
+                                                         autoDetectLabelFlag=True,
+                                                         predict=self._on_label)
+
+            self.nsclient = nsclient
+            self.nsclient.start_send()
+            metrics.gauge('buffer.fill', self.fill)
+            logger.info(
+                f'Acquisition service started on {self.eeg_IP}:{self.eeg_port}')
+
+    def subscribe(self, name, autoDetectLabelFlag=False, predict=None):
+        ''' Subscribe new named consumer starting from the latest sample
+
+        Args:
+        - @name: The name of the consumer, it should be unique among the subscribed consumers;
+        - @autoDetectLabelFlag: The flag of automatically detect 33 label;
+        - @predict: Predict function, it will be called on independent thread when 33 label is detected.
+
+        Outs:
+        - The consumer.
+        '''
+        self.start()
+        with self.lock:
+            if name in self.consumers:
+                raise ValueError(f'Consumer "{name}" has been subscribed')
+            consumer = Consumer(self.nsclient,
+                                name,
+                                self.nsclient.data_length,
+                                autoDetectLabelFlag=autoDetectLabelFlag,
+                                predict=predict)
+            self.consumers[name] = consumer
+        logger.debug(f'Consumer "{name}" subscribed from {consumer.start}')
+        return consumer
+
+    def unsubscribe(self, consumer):
+        ''' Close and unsubscribe the [consumer] '''
+        consumer.close()
+        with self.lock:
+            if self.consumers.get(consumer.name) is consumer:
+                del self.consumers[consumer.name]
+        logger.debug(f'Consumer "{consumer.name}" unsubscribed')
+
+    def report(self):
+        ''' Report the consumers and their cursors
+
+        Outs:
+        - The dict of the consumer names and their [start, cursor, end].
+        '''
+        with self.lock:
+            return {name: [e.start, e.cursor, e.end]
+                    for name, e in self.consumers.items()}
+
+    def fill(self):
+        ''' The fill level of the ring buffer, from 0 to 1 '''
+        nsclient = self.nsclient
+        if nsclient is None:
+            return 0
+        buffer = nsclient.buffer
+        return min(buffer.length, buffer.capacity) / buffer.capacity
+
+    def _on_label(self):
+        # Built-in method of calling the predict functions of the consumers,
+        # it is called on independent thread when 33 label is detected,
+        # every consumer predicts on its own thread, so a slow one does not delay the others
+        with self.lock:
+            consumers = [e for e in self.consumers.values()
+                         if e.autoDetectLabelFlag and not e.closed]
+
+        for consumer in consumers:
+            t = threading.Thread(target=self._predict,
+                                 args=(consumer,),
+                                 name='Inference')
+            t.setDaemon(True)
+            t.start()
+
+    def _predict(self, consumer):
+        # Built-in method of calling the predict function of the [consumer]
+        try:
+            consumer.predict()
+        except:
+            err = traceback.format_exc()
+            logger.warning(f'Failed on predict of "{consumer.name}": {err}')
+
+    def shutdown(self):
+        ''' Stop the stream and disconnect from the device '''
+        with self.lock:
+            nsclient = self.nsclient
+            for consumer in self.consumers.values():
+                consumer.close()
+            self.nsclient = None
+            self.consumers = dict()
+
+        if nsclient is None:
+            return
+
+        nsclient.stop_send()
+        nsclient.wait_stopped()
+        nsclient.disconnect()
+        logger.info(
+            f'Acquisition service stopped on {self.eeg_IP}:{self.eeg_port}')
+
+
+class SharedAcquisitionService(AcquisitionService):
+    ''' The acquisition service reading the shared memory,
+    the acquisition loop runs in the other process,
+    so the decoding in this process does not affect the packet reception.
+    '''
+
+    def __init__(self, name, n_channels=n_channels, freq=freq):
+        ''' Initialize the service, the shared memory is not attached until @start.
+
+        Args:
+        - @name: The name of the shared memory;
+        - @n_channels: Number of channels, it is checked against the shared memory;
+        - @freq: The sampling frequency, it is checked against the shared memory.
+        '''
+        super(SharedAcquisitionService, self).__init__(eeg_IP=name,
+                                                       eeg_port=None,
+                                                       n_channels=n_channels,
+                                                       freq=freq)
+        self.name = name
+
+    def start(self):
+        ''' Attach to the shared memory and start watching the labels, do nothing if it has started '''
+        with self.lock:
+            if self.nsclient is not None:
+                return
+
+            nsclient = SharedStreamClient(self.name, predict=self._on_label)
+            if (nsclient.n_channels, nsclient.sample_rate) != (self.n_channels, self.freq):
+                logger.warning(
+                    f'The shared memory is of {nsclient.n_channels} channels at {nsclient.sample_rate} Hz, it differs from the setting')
+            nsclient.start_send()
+            self.nsclient = nsclient
+            metrics.gauge('buffer.fill', self.fill)
+            logger.info(f'Acquisition service attached to "{self.name}"')
+
+
+services = dict()
+_services_lock = threading.Lock()
+
+
+def get_service(eeg_IP=eeg_IP, eeg_port=eeg_port, n_channels=n_channels, freq=freq):
+    ''' Get the acquisition service of the device,
+    the service is created on the first call and shared in the process,
+    it reads the shared memory if the [sharedMemoryName] is set.
+    '''
+    with _services_lock:
+        key = (eeg_IP, eeg_port)
+        if key not in services:
+            if shared_memory_name:
+                services[key] = SharedAcquisitionService(shared_memory_name,
+                                                         n_channels,
+                                                         freq)
+            else:
+                services[key] = AcquisitionService(eeg_IP,
+                                                   eeg_port,
+                                                   n_channels,
+                                                   freq)
+        return services[key]
+
+
+def register_service(service, eeg_IP=eeg_IP, eeg_port=eeg_port):
+    ''' Register the [service] as the one of the device,
+    it is used by the sessions afterwards, like the service of the device emulator in the benchmark.
+    '''
+    with _services_lock:
+        services[(eeg_IP, eeg_port)] = service
+
+
+def shutdown_all():
+    ''' Shutdown all the acquisition services '''
+    with _services_lock:
+        all_services = list(services.values())
+    for service in all_services:
+        service.shutdown()
+
+
+# The device stream is stopped before the interpreter exits
+atexit.register(shutdown_all)
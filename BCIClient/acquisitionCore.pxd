@@ -0,0 +1,18 @@
+# File: acquisitionCore.pxd
+# Aim: The typed declarations of acquisitionCore.py for the compiled build.
+#
+# The .py file stays the plain Python, Cython reads the types from this file when it is compiled,
+# the functions are cpdef, so they are called in C inside the module and from Python outside.
+
+cimport cython
+
+@cython.locals(buf=bytearray, count=Py_ssize_t, k=Py_ssize_t)
+cpdef bytes receive_exactly(client, Py_ssize_t n_bytes)
+
+cpdef tuple unpack_header(header_packet)
+
+cpdef object unpack_data(data_packet, int n_channels)
+
+cpdef object decode_packet(data_packet, int n_channels, double scale)
+
+cpdef tuple scan_triggers(row)
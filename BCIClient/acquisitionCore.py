@@ -0,0 +1,93 @@
+'''
+File: acquisitionCore.py
+Aim: The hot path of the acquisition, it is optionally compiled by Cython.
+
+The functions are called for every packet of the device,
+- @receive_exactly: Receive the bytes of the packet into the preallocated buffer;
+- @unpack_header: Unpack the 12 bytes header of the packet;
+- @unpack_data: View the body of the packet as the int32 matrix without copying;
+- @decode_packet: Scale the body of the packet into the data of the buffer;
+- @scan_triggers: Find the triggers of the trigger row.
+
+The module is in the pure Python mode of Cython,
+the types are declared in acquisitionCore.pxd, which is read only when the module is compiled,
+it is compiled by cythonScripts/convert.py into the extension next to this file,
+and the extension is imported instead of this file if it exists,
+so the NeuroScanDeviceClient works the same whether it is built or not.
+The [compiled] shows which one is in use.
+'''
+
+import struct
+import numpy as np
+
+try:
+    import cython
+    compiled = cython.compiled
+except ImportError:
+    compiled = False
+
+# The header of the packet, 'CTRL' or 'DATA', code, request and the size of the body
+_header = struct.Struct('>4sHHI')
+HEADER_SIZE = _header.size
+
+
+def receive_exactly(client, n_bytes):
+    ''' Receive [n_bytes] bytes from the socket [client],
+    the bytes are received into the preallocated buffer instead of being concatenated,
+    the received bytes are returned if the connection is closed before [n_bytes].
+    '''
+    buf = bytearray(n_bytes)
+    view = memoryview(buf)
+    count = 0
+    while count < n_bytes:
+        k = client.recv_into(view[count:], n_bytes - count)
+        if k == 0:
+            return bytes(buf[:count])
+        count += k
+    return bytes(buf)
+
+
+def unpack_header(header_packet):
+    ''' Unpack the [header_packet]
+
+    Outs:
+    - The contents in the header, (channel name, code, request, size).
+    '''
+    return _header.unpack(header_packet)
+
+
+def unpack_data(data_packet, n_channels):
+    ''' View the [data_packet] as the int32 matrix, the shape is ((n_channels + 1) x time_points),
+    it is a view of the bytes, so nothing is copied.
+    '''
+    return np.frombuffer(data_packet, dtype='<i4').reshape((-1, n_channels + 1)).T
+
+
+def decode_packet(data_packet, n_channels, scale):
+    ''' Decode the [data_packet] into the data of the buffer,
+    the device sends one more row than the buffer, the trigger row is zeroed.
+
+    Args:
+    - @data_packet: The body of the packet;
+    - @n_channels: The number of channels of the buffer;
+    - @scale: The scale of the counts.
+
+    Outs:
+    - The data, the shape is (n_channels x time_points).
+    '''
+    trans = unpack_data(data_packet, n_channels)
+    out = np.empty((n_channels, trans.shape[1]), dtype=float)
+    np.multiply(trans[:n_channels-1], scale, out=out[:-1])
+    out[-1] = 0
+    return out
+
+
+def scan_triggers(row):
+    ''' Find the triggers of the trigger [row]
+
+    Outs:
+    - The indices of the triggers in the [row];
+    - The codes of the triggers.
+    '''
+    idx = np.flatnonzero(row)
+    return idx, row[idx]
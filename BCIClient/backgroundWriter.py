@@ -0,0 +1,75 @@
+'''
+File: backgroundWriter.py
+Aim: Run the slow saving jobs on a background thread,
+so the control thread replies immediately.
+
+- @BackgroundWriter: The writer running the jobs one by one;
+- @writer: The writer shared by the package.
+'''
+
+import queue
+import atexit
+import threading
+import traceback
+
+from . import logger
+
+
+class BackgroundWriter(object):
+    ''' The background writer,
+    the jobs are executed one by one in the order of submitting.
+
+    Useful methods:
+    - @submit: Submit the job;
+    - @flush: Wait until all the submitted jobs are done.
+    '''
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def _ensure_thread(self):
+        # Built-in method of starting the working thread on the first job
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self._run,
+                                           name='Background writer')
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def _run(self):
+        logger.debug(f'Background writer starts.')
+        while True:
+            name, job = self.jobs.get()
+            try:
+                job()
+                logger.debug(f'Background job done: {name}')
+            except:
+                err = traceback.format_exc()
+                logger.error(f'Background job failed: {name}, error is {err}')
+            finally:
+                self.jobs.task_done()
+
+    def submit(self, job, name='job'):
+        ''' Submit the [job] to the writer
+
+        Args:
+        - @job: The function to be called without arguments;
+        - @name: The name of the job, used for logging.
+        '''
+        self._ensure_thread()
+        self.jobs.put((name, job))
+        logger.debug(f'Background job submitted: {name}')
+
+    def flush(self):
+        ''' Wait until all the submitted jobs are done '''
+        if self.thread is not None:
+            self.jobs.join()
+
+
+writer = BackgroundWriter()
+
+# The pending data is saved before the interpreter exits
+atexit.register(writer.flush)
@@ -0,0 +1,155 @@
+'''
+File: bufferPool.py
+Aim: The pool of the preallocated window buffers for the decoders.
+
+Every prediction copies the latest data into the window buffer of the fixed shape,
+the buffers are borrowed from the pool and returned after the prediction,
+so the same few arrays are reused instead of allocating the MBs for every trigger.
+The pool allocates new buffer only if all of them are borrowed, like the concurrent predictions.
+
+The dtype of the windows is [windowDtype] in the [Online] section,
+the decoder allows the other dtype by its [window_dtype] attribute, like 'float32',
+the float32 window halves the memory and the copying.
+
+The window is returned to the pool after the prediction and overwritten by the next borrow,
+so the decoder must not keep it, unless it has the [retains_input] attribute of True,
+like the updating decoder keeping the trials for retraining, then it is passed its own copy.
+The updating decoders are regarded as retaining if they do not have the attribute.
+
+The metrics are
+- window.borrows: The counter of the borrowed windows, one for every prediction;
+- window.copies: The counter of the windows copied for the decoders retaining them;
+- window.allocations, window.allocated_bytes: The counters of the allocated buffers and their bytes;
+- window.free, window.borrowed: The gauges of the buffers in the pools;
+- window.bytes_per_borrow: The gauge of the allocated bytes per borrow, it is near 0 when the pools are warm.
+
+Useful functions:
+- @get_pool: Get the pool of the shape and the dtype;
+- @window_dtype: The dtype of the windows of the decoder;
+- @decoder_input: The window passed to the decoder, it is copied if the decoder retains it.
+'''
+
+import threading
+import contextlib
+import numpy as np
+
+from . import logger, cfg, metrics
+
+default_dtype = cfg['Online']['windowDtype']
+pool_size = int(cfg['Online']['windowPoolSize'])
+
+
+def window_dtype(decoder=None):
+    ''' The dtype of the windows of the [decoder],
+    its [window_dtype] attribute is used if it has, otherwise the [windowDtype] of the setting.
+    '''
+    return np.dtype(getattr(decoder, 'window_dtype', None) or default_dtype)
+
+
+def decoder_input(decoder, window, updating=False):
+    ''' The [window] passed to the predict of the [decoder],
+    it is copied if the decoder retains its input, see the [retains_input] in the module docstring.
+
+    Args:
+    - @decoder: The decoder;
+    - @window: The borrowed window;
+    - @updating: Whether the decoder is built for updating, it is used if the decoder has no [retains_input] attribute.
+
+    Outs:
+    - The window itself or its copy.
+    '''
+    if not getattr(decoder, 'retains_input', updating):
+        return window
+    metrics.inc('window.copies')
+    return window.copy()
+
+
+class BufferPool(object):
+    ''' The pool of the buffers of the same shape and dtype.
+
+    Useful methods:
+    - @acquire: Borrow the buffer;
+    - @release: Return the buffer;
+    - @borrow: Borrow the buffer in the with statement.
+    '''
+
+    def __init__(self, shape, dtype=default_dtype, size=pool_size):
+        ''' Initialize the pool, the [size] buffers are allocated at once
+
+        Args:
+        - @shape: The shape of the buffers;
+        - @dtype: The dtype of the buffers;
+        - @size: The max number of the free buffers kept in the pool.
+        '''
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.size = size
+        self.borrowed = 0
+        self.lock = threading.Lock()
+        self.free = [self._allocate() for _ in range(size)]
+
+    def _allocate(self):
+        # Built-in method of allocating new buffer
+        buf = np.empty(self.shape, dtype=self.dtype)
+        metrics.inc('window.allocations')
+        metrics.inc('window.allocated_bytes', buf.nbytes)
+        return buf
+
+    def acquire(self):
+        ''' Borrow the buffer, new one is allocated if the pool is empty '''
+        metrics.inc('window.borrows')
+        with self.lock:
+            self.borrowed += 1
+            if self.free:
+                return self.free.pop()
+        logger.debug(f'Window pool of {self.shape} is empty, allocating new buffer')
+        return self._allocate()
+
+    def release(self, buf):
+        ''' Return the [buf] borrowed by @acquire '''
+        with self.lock:
+            self.borrowed -= 1
+            if len(self.free) < self.size:
+                self.free.append(buf)
+
+    @contextlib.contextmanager
+    def borrow(self):
+        ''' Borrow the buffer in the with statement, it is returned on leaving '''
+        buf = self.acquire()
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+
+# ------------------------------------------------------------------------
+# The pools of the process, one for every shape and dtype
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+
+def get_pool(shape, dtype=default_dtype):
+    ''' Get the pool of the [shape] and the [dtype], it is created on the first call '''
+    key = (tuple(shape), np.dtype(dtype))
+    pool = _pools.get(key, None)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key, None)
+            if pool is None:
+                pool = _pools[key] = BufferPool(*key)
+                logger.info(f'Window pool of {key[0]} in {key[1]} is created')
+    return pool
+
+
+def _report():
+    # Built-in method of reporting the pools for the metrics
+    pools = list(_pools.values())
+    counters = metrics.registry.counters
+    borrows = counters.get('window.borrows', 0)
+    return dict(free=sum([len(e.free) for e in pools]),
+                borrowed=sum([e.borrowed for e in pools]),
+                bytes_per_borrow=counters.get('window.allocated_bytes', 0) / max(borrows, 1))
+
+
+metrics.gauge('window', _report)
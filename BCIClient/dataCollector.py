@@ -1,29 +1,34 @@
 import os
 import numpy as np
 
-from joblib import dump
-
 from . import logger, cfg
-from .neuroScanToolbox import NeuroScanDeviceClient
+from . import sessionFile
+from . import bufferPool
+from .neuroScanToolbox import channel_names, scale
+from .acquisition import get_service, n_channels, freq, eeg_IP, eeg_port
 
-n_channels = int(cfg['EEG']['numChannels'])  # Number of channels
-freq = int(cfg['EEG']['sampleRate'])  # Hz
-eeg_IP = cfg['EEG']['deviceIP']
-eeg_port = int(cfg['EEG']['devicePort'])
+storage_format = cfg['Storage']['format']  # 'chunked' or 'joblib'
+storage_kwargs = dict(
+    chunk_seconds=float(cfg['Storage']['chunkSeconds']),
+    codec=cfg['Storage']['codec'],
+    delta=cfg.getboolean('Storage', 'deltaEncoding'),
+)
 
 
 class DataStack(object):
-    ''' The data stack.
+    ''' The data stack,
+    it records a window over the stream of the shared acquisition service as a named consumer.
 
     Useful methods:
     - @start: Start the data collecting;
     - @stop: Stop the data collecting;
+    - @close: Unsubscribe from the acquisition service;
     - @save: Save the data to the disk;
     - @latest: Get the latest data from the stack;
     - @report: Get the current state of the report.
     '''
 
-    def __init__(self, filepath, eeg_IP=eeg_IP, eeg_port=eeg_port, n_channels=n_channels, freq=freq, autoDetectLabelFlag=False, predict=None):
+    def __init__(self, filepath, eeg_IP=eeg_IP, eeg_port=eeg_port, n_channels=n_channels, freq=freq, autoDetectLabelFlag=False, predict=None, name=None):
         ''' Initialize the data stack
 
         Args:
@@ -32,20 +37,25 @@ class DataStack(object):
         - @eeg_port: The port number of the EEG device, has default value;
         - @n_channels: Number of channels, has default value;
         - @freq: The sampling frequency, has default value;
+        - @autoDetectLabelFlag: The flag of automatically detect 33 label, if it detected, the predict function will be called;
+        - @predict: Predict function, used for autoDetectLabelFlag;
+        - @name: The name of the consumer, the [filepath] is used by default.
         '''
         self.filepath = filepath
+        self.name = filepath if name is None else name
 
         self.n_channels = n_channels
         self.freq = freq
 
+        self.autoDetectLabelFlag = autoDetectLabelFlag
+        self.predict = predict
+
         self._reset()
 
-        self.nsclient = NeuroScanDeviceClient(eeg_IP,
-                                              eeg_port,
-                                              freq,
-                                              n_channels,
-                                              autoDetectLabelFlag=autoDetectLabelFlag,
-                                              predict=predict)
+        # The device connection is shared by the sessions,
+        # it is established on the first session and kept open
+        self.service = get_service(eeg_IP, eeg_port, n_channels, freq)
+        self.window = None
 
         logger.debug(
             f'Initialized with filepath: {filepath}, n_channels: {n_channels}')
@@ -55,8 +65,8 @@ class DataStack(object):
         self.state = 'free'
 
     def get_data(self):
-        d = self.nsclient.get_all()
-        logger.debug(f'Got all data from device, shape is {d.shape}')
+        d = self.window.get_data()
+        logger.debug('Got all data from device, shape is %s', d.shape)
         return d
 
     def _add(self, data):
@@ -70,43 +80,70 @@ class DataStack(object):
             f'Data stack is changed to the shape of {self.data.shape}')
 
     def start(self):
-        # Start the thread to keep collecting the data
+        # Start recording from the latest sample
         self._reset()
         self.state = 'collecting'
-        self.nsclient.start_send()
+        self.window = self.service.subscribe(self.name,
+                                             autoDetectLabelFlag=self.autoDetectLabelFlag,
+                                             predict=self.predict)
 
     def stop(self):
-        # Stop the collecting thread
-        self.nsclient.stop_send()
+        # Stop recording at the latest sample,
+        # the consumer is unsubscribed at once, the closed window still reads its data for saving,
+        # so the next session of the same name starts before the data is saved
+        self.service.unsubscribe(self.window)
         self.state = 'stopped'
 
     def close(self):
-        self.nsclient.disconnect()
+        # Unsubscribe from the service if it is not yet, the device connection is kept open
+        self.service.unsubscribe(self.window)
 
     def save(self):
-        # Save the data to the disk
+        # Save the data to the disk,
+        # the chunked session file is used unless the storage format is 'joblib'
         d = self.get_data()
-        if os.path.isfile(self.filepath):
-            logger.warning(
-                f'File exists (data) "{self.filepath}", overriding it.')
-        dump(d, self.filepath)
+
+        if storage_format == 'joblib':
+            if os.path.isfile(self.filepath):
+                logger.warning(
+                    f'File exists (data) "{self.filepath}", overriding it.')
+            from joblib import dump
+            dump(d, self.filepath)
+        else:
+            sessionFile.save(self.filepath,
+                             d,
+                             channels=self.channels(),
+                             sample_rate=self.freq,
+                             scale=scale,
+                             **storage_kwargs)
+
         logger.debug(f'Saved the data ({d.shape}) to {self.filepath}')
 
+    def channels(self):
+        ''' The channel names of the data, the merged stream of the multiple sources has its own names '''
+        return getattr(self.service.nsclient, 'channels', None) or channel_names(self.n_channels)
+
     def report(self):
         # Report the current state of the stack,
         # it may change on developping.
         d = self.get_data()
         logger.debug(f'Current data shape is: {d.shape}')
 
-    def latest(self, length=5):
+    def window_pool(self, length=5, dtype=bufferPool.default_dtype):
+        ''' The pool of the arrays for the latest data by the [length], see @latest '''
+        return bufferPool.get_pool((len(self.channels()), length * self.freq), dtype)
+
+    def latest(self, length=5, out=None):
         ''' Get the latest data by the [length]
 
         Args:
         - @length: The length of the fetched data, the unit is 'second', the default value is 4 seconds,
+        - @out: The array to copy the data into, like the one borrowed from @window_pool,
+          None refers the read-only view of the recording is returned.
         '''
 
         n = length * self.freq
-        d = self.get_data()
+        d = self.window.latest(n, out)
         if len(d.shape) == 1:
             logger.warning(
                 f'There is not enough data for your request of length={length} seconds, current length is 1.')
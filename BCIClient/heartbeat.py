@@ -0,0 +1,207 @@
+'''
+File: heartbeat.py
+Aim: The adaptive heartbeat of the TCP connection.
+
+Every keepAlive message carries the sequence number and the timestamp,
+so every reply yields a round trip time (RTT).
+The smoothed RTT (SRTT), the jitter (RTTVAR) and the timeout are estimated as in RFC 6298:
+- SRTT = (1 - alpha) * SRTT + alpha * RTT;
+- RTTVAR = (1 - beta) * RTTVAR + beta * |SRTT - RTT|;
+- timeout = SRTT + 4 * RTTVAR, it is bounded by [minTimeout, maxTimeout].
+
+The keepAlive message is lost if it is not replied in the timeout,
+the next one is sent at once, the late replies still count as alive,
+and the connection is regarded as dead after [maxMisses] messages are lost in a row,
+so the half-open connection is detected in seconds instead of on the next failed recv.
+
+The replies without seq come from the peers not echoing it,
+they are matched to the oldest waiting message.
+'''
+
+import time
+import threading
+import traceback
+
+from . import logger, cfg
+from protocol import keepAliveRequest
+
+interval = float(cfg['Heartbeat']['interval'])  # Seconds
+min_timeout = float(cfg['Heartbeat']['minTimeout'])  # Seconds
+max_timeout = float(cfg['Heartbeat']['maxTimeout'])  # Seconds
+max_misses = int(cfg['Heartbeat']['maxMisses'])
+
+
+class Heartbeat(object):
+    ''' The adaptive heartbeat.
+
+    Useful methods:
+    - @start: Start sending the keepAlive messages;
+    - @stop: Stop sending;
+    - @on_reply: Handle the replied keepAlive message;
+    - @metrics: The RTT metrics of the connection.
+    '''
+
+    def __init__(self, send, on_dead, interval=interval, min_timeout=min_timeout, max_timeout=max_timeout, max_misses=max_misses, alpha=1/8, beta=1/4):
+        ''' Initialize the heartbeat
+
+        Args:
+        - @send: The sending method of the bytes;
+        - @on_dead: The method called once when the connection is regarded as dead;
+        - @interval: The interval of the keepAlive messages, the unit is 'second';
+        - @min_timeout: The lower bound of the timeout, the unit is 'second';
+        - @max_timeout: The upper bound of the timeout, the unit is 'second',
+          the timeout before the first RTT is the [interval] bounded in the same way;
+        - @max_misses: The number of the lost messages in a row before the connection is regarded as dead;
+        - @alpha, @beta: The gains of the SRTT and RTTVAR.
+        '''
+        self.send = send
+        self.on_dead = on_dead
+        self.interval = interval
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.max_misses = max_misses
+        self.alpha = alpha
+        self.beta = beta
+
+        self.srtt = None
+        self.rttvar = None
+        self.rtt = None
+        self.seq = 0
+        self.waiting = dict()  # seq: sent time
+        self.expired = dict()  # seq: sent time, the lost ones kept for the late replies
+        self.sent = 0
+        self.received = 0
+        self.lost = 0
+        self.late = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @property
+    def timeout(self):
+        ''' The adaptive timeout of the reply, the unit is 'second' '''
+        if self.srtt is None:
+            timeout = self.interval
+        else:
+            timeout = self.srtt + 4 * self.rttvar
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def start(self):
+        ''' Start sending the keepAlive messages on independent thread '''
+        self.thread = threading.Thread(target=self._keep_beating,
+                                       name='Heartbeat')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        ''' Stop sending the keepAlive messages '''
+        self.stopped.set()
+
+    def _beat(self):
+        # Built-in method of sending the new keepAlive message
+        with self.lock:
+            self.seq += 1
+            seq = self.seq
+            t = time.monotonic()
+            self.waiting[seq] = t
+            self.sent += 1
+        self.send(keepAliveRequest(seq, int(t * 1000)))
+
+    def _expire(self):
+        # Built-in method of marking the messages not replied in the timeout as lost
+        # Outs: Whether the messages are lost
+        now = time.monotonic()
+        timeout = self.timeout
+        with self.lock:
+            expired = [seq for seq, t in self.waiting.items()
+                       if now - t > timeout]
+            for seq in expired:
+                self.expired[seq] = self.waiting.pop(seq)
+            while len(self.expired) > 64:
+                del self.expired[min(self.expired)]
+            self.lost += len(expired)
+            self.misses += len(expired)
+        if expired:
+            logger.warning(
+                f'Heartbeat {expired} is not replied in {timeout:.3f} seconds, {self.misses} misses in a row')
+        return len(expired) > 0
+
+    def _keep_beating(self):
+        logger.debug(f'Start keep sending keepAliveMessage')
+        try:
+            self._beat()
+            next_beat = time.monotonic() + self.interval
+            while not self.stopped.wait(min(self.timeout, self.interval) / 4):
+                if self._expire():
+                    if self.misses >= self.max_misses:
+                        logger.error(
+                            f'Connection is regarded as dead, since {self.misses} heartbeats are lost in a row')
+                        self.on_dead()
+                        break
+                    # Probe again at once
+                    self._beat()
+                    next_beat = time.monotonic() + self.interval
+                    continue
+
+                if time.monotonic() >= next_beat:
+                    self._beat()
+                    next_beat = time.monotonic() + self.interval
+        except:
+            err = traceback.format_exc()
+            logger.warning(f'Failed on sending keepAliveMessage: {err}')
+            self.on_dead()
+        logger.debug(f'Stopped keep sending keepAliveMessage')
+
+    def on_reply(self, dct):
+        ''' Handle the replied keepAlive message [dct] '''
+        now = time.monotonic()
+        with self.lock:
+            try:
+                seq = int(dct['seq'])
+            except (KeyError, ValueError):
+                # The peer does not echo the seq
+                seq = min(self.waiting) if self.waiting else None
+
+            t = self.waiting.pop(seq, None)
+            if t is None:
+                t = self.expired.pop(seq, None)
+                if t is None:
+                    logger.debug(f'Unknown heartbeat reply {seq}')
+                    return
+                # The late reply still proves the connection is alive,
+                # and its RTT enlarges the timeout
+                self.late += 1
+
+            rtt = now - t
+            self.rtt = rtt
+            self.received += 1
+            self.misses = 0
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = (1 - self.beta) * self.rttvar + \
+                    self.beta * abs(self.srtt - rtt)
+                self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+
+        logger.debug('Heartbeat %s RTT is %.6f, SRTT is %.6f, RTTVAR is %.6f',
+                     seq, rtt, self.srtt, self.rttvar)
+
+    def metrics(self):
+        ''' The RTT metrics of the connection
+
+        Outs:
+        - The dict of rtt, srtt, rttvar, timeout (in seconds) and the counts of the heartbeats.
+        '''
+        with self.lock:
+            return dict(rtt=self.rtt,
+                        srtt=self.srtt,
+                        rttvar=self.rttvar,
+                        timeout=self.timeout,
+                        sent=self.sent,
+                        received=self.received,
+                        lost=self.lost,
+                        late=self.late,
+                        waiting=len(self.waiting))
@@ -0,0 +1,206 @@
+'''
+File: link.py
+Aim: The state of the control link kept across the reconnections.
+
+The running sessions and their acquisition are kept when the TCP connection drops,
+the sessions send through the link,
+the replayable messages, like the computed labels, are buffered while the link is down,
+and they are replayed on the resumeSession handshake of the new connection.
+The new replayable messages of the session are buffered behind them until the handshake,
+even if the link is up, so the labels reach the server in order.
+
+The reconnection is delayed by the exponential backoff with jitter,
+from [reconnectMinDelay] to [reconnectMaxDelay] seconds,
+so the server just restarted is not flooded by the clients.
+'''
+
+import random
+import threading
+import collections
+
+from . import logger, cfg, metrics
+
+# The messages buffered while the link is down
+REPLAYABLE = ('labelComputed', 'sessionSaved')
+
+# The max number of the buffered messages, the oldest ones are dropped
+max_buffered = int(cfg['TCP']['maxBufferedMessages'])
+
+min_delay = float(cfg['TCP']['reconnectMinDelay'])  # Seconds
+max_delay = float(cfg['TCP']['reconnectMaxDelay'])  # Seconds
+
+
+class Backoff(object):
+    ''' The exponential backoff of the reconnection.
+
+    Useful methods:
+    - @next: The delay before the next try;
+    - @reset: Reset the delay after the connection succeeds.
+    '''
+
+    def __init__(self, min_delay=min_delay, max_delay=max_delay):
+        ''' Initialize the backoff
+
+        Args:
+        - @min_delay: The delay of the first try, the unit is 'second';
+        - @max_delay: The upper bound of the delay, the unit is 'second'.
+        '''
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
+
+    def next(self):
+        ''' The delay before the next try, it doubles every try,
+        the jitter is a random half of the delay.
+        '''
+        delay = self.delay
+        self.delay = min(self.max_delay, self.delay * 2)
+        return delay * random.uniform(0.5, 1)
+
+    def reset(self):
+        ''' Reset the delay after the connection succeeds '''
+        self.delay = self.min_delay
+
+
+class Link(object):
+    ''' The control link.
+
+    Useful methods:
+    - @attach: Attach the connected TCP client;
+    - @detach: Detach the disconnected TCP client;
+    - @sender: The sending method of the session;
+    - @take: Take the buffered messages for replaying;
+    - @restore: Buffer the messages not sent by the failed connection;
+    - @close: Stop all the sessions.
+    '''
+
+    def __init__(self, max_buffered=max_buffered):
+        ''' Initialize the link without the connection
+
+        Args:
+        - @max_buffered: The max number of the buffered messages.
+        '''
+        # The running sessions, the key is the sessionName
+        self.sessions = dict()
+        self.client = None
+        self.buffered = collections.deque(maxlen=max_buffered)
+        self.lock = threading.Lock()
+        metrics.gauge('link.buffered', lambda: len(self.buffered))
+
+    def attach(self, client):
+        ''' Attach the connected TCP [client] '''
+        with self.lock:
+            self.client = client
+        metrics.startup('connected')
+        if self.sessions:
+            logger.info(
+                f'Link is up with running sessions {list(self.sessions)}, {len(self.buffered)} messages are buffered')
+
+    def detach(self, client):
+        ''' Detach the disconnected TCP [client], the sessions keep running '''
+        with self.lock:
+            if self.client is client:
+                self.client = None
+        if self.sessions:
+            logger.warning(
+                f'Link is down, the sessions {list(self.sessions)} keep running')
+
+    def sender(self, sessionName):
+        ''' The sending method of the session of [sessionName] '''
+        def send(message):
+            self.send(message, sessionName)
+        return send
+
+    def send(self, message, sessionName=None):
+        ''' Send the [message] through the connected client,
+        the replayable message is buffered if the link is down,
+        or the buffered messages of its session are waiting for the resumeSession.
+        '''
+        replay = self.replayable(message, sessionName)
+        with self.lock:
+            client = self.client
+            waiting = replay is not None and (client is None or self._waiting(sessionName))
+            if waiting:
+                self.buffered.append(replay)
+
+        if waiting:
+            logger.debug('Buffered message "%s" of %s', message, sessionName)
+            return
+
+        if client is not None:
+            try:
+                client.send(message, sessionName)
+                return
+            except OSError as err:
+                logger.warning(f'Failed on sending through the link: {err}')
+
+        if replay is not None:
+            with self.lock:
+                self.buffered.append(replay)
+            logger.debug('Buffered message "%s" of %s', message, sessionName)
+            return
+
+        metrics.inc('link.dropped')
+        logger.warning(f'Link is down, dropped the message "{message}"')
+
+    def replayable(self, message, sessionName=None):
+        ''' The replay object of the [message], it is restored by @restore if the message is not sent,
+        None refers the message is not replayable.
+        '''
+        if isinstance(message, dict) and message.get('method', None) in REPLAYABLE:
+            return (sessionName, message)
+        return None
+
+    def restore(self, replays):
+        ''' Buffer the [replays] of the messages queued but not sent by the failed connection,
+        they are older than the messages buffered since the failure, so they are replayed first,
+        and they are dropped first if the buffer is full.
+        '''
+        if not replays:
+            return
+        with self.lock:
+            # The extendleft of the full deque would drop the newest messages on the right,
+            # so the oldest ones are trimmed before extending
+            merged = list(replays) + list(self.buffered)
+            maxlen = self.buffered.maxlen
+            dropped = 0 if maxlen is None else max(0, len(merged) - maxlen)
+            self.buffered.clear()
+            self.buffered.extend(merged[dropped:])
+        if dropped > 0:
+            metrics.inc('link.dropped', dropped)
+        logger.warning(
+            f'Restored {len(replays)} unsent messages for replaying, {dropped} oldest messages are dropped for the full buffer')
+
+    def take(self, sessionName=None, send=None):
+        ''' Take the buffered messages of the [sessionName] for replaying,
+        None refers all the sessions.
+
+        Args:
+        - @sessionName: The sessionName of the messages, None refers all the sessions;
+        - @send: The method of replaying the taken messages, it is called as send(replays) before the link is released,
+          so the new messages of the sessions are sent after the replayed ones.
+
+        Outs:
+        - The replays of the taken messages, in the format of (sessionName, message).
+        '''
+        with self.lock:
+            taken = [(name, m) for name, m in self.buffered
+                     if sessionName is None or name == sessionName]
+            remains = [(name, m) for name, m in self.buffered
+                       if not (sessionName is None or name == sessionName)]
+            self.buffered.clear()
+            self.buffered.extend(remains)
+            if send is not None:
+                send(taken)
+        return taken
+
+    def _waiting(self, sessionName):
+        # Built-in method of checking whether the buffered messages of the [sessionName] are waiting for replaying,
+        # it is called with the lock acquired
+        return any([name == sessionName for name, _ in self.buffered])
+
+    def close(self):
+        ''' Stop all the sessions, it is called on quitting '''
+        for session in list(self.sessions.values()):
+            session.ds.stop()
+        self.sessions.clear()
@@ -0,0 +1,301 @@
+'''
+File: metrics.py
+Aim: The live metrics registry of the pipeline health.
+
+The hot paths update the metrics cheaply,
+- Counter: The accumulated count, like the packets and the bytes received;
+- Timer: The durations, like the decoding and the predicting time,
+  the count, the sum and the max are kept, and the percentiles are computed from the latest [reservoir] durations;
+- Gauge: The function called on the snapshot, like the buffer fill level, the outbound queue depth and the RSS,
+  so the hot paths are not touched at all.
+The rates per second of the counters and the timers are computed on the snapshot,
+over the latest [rateWindow] seconds.
+
+The snapshot is available through
+- The getMetrics control message, see fileWorks/communication.md;
+- The local HTTP endpoint of [httpPort] in the [Metrics] section, 0 refers no endpoint,
+  the path of /metrics is in the text format of Prometheus, and /metrics.json is in json.
+
+The names of the metrics are
+- device.packets, device.samples, device.bytes: The counters of the received packets, samples and bytes;
+- device.decode: The timer of decoding the packets of the device;
+- device.malformed: The counter of the packets of the unexpected size;
+- buffer.fill: The gauge of the fill level of the ring buffer, from 0 to 1;
+- buffer.overwritten: The counter of the samples overwritten before they are read;
+- predict: The timer of predicting the labels;
+- outbox.*: The gauges of the outbound queue, like the depth and the dropped messages;
+- link.buffered: The gauge of the messages buffered until they are replayed by the resumeSession;
+- heartbeat.*: The gauges of the RTT of the connection;
+- sources.*: The gauges of the health of the merged sources, see BCIClient/multiSource.py;
+- window.*: The counters and the gauges of the pooled prediction windows, see BCIClient/bufferPool.py;
+- log.dropped: The gauge of the log records dropped since the logging queue is full;
+- process.rss: The gauge of the resident memory in bytes;
+- startup.*: The seconds from importing the package to the startup stages, like 'connected'.
+
+Useful functions:
+- @inc: Add to the counter;
+- @observe: Record the duration of the timer;
+- @gauge: Register the gauge;
+- @startup: Mark the startup stage;
+- @snapshot: The snapshot of all the metrics;
+- @serve: Start the HTTP endpoint.
+'''
+
+import os
+import json
+import time
+import threading
+import collections
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from . import logger, cfg, t_import
+from .Logger import dropped_records
+
+rate_window = float(cfg['Metrics']['rateWindow'])  # Seconds
+reservoir = int(cfg['Metrics']['reservoir'])  # Durations
+http_host = cfg['Metrics']['httpHost']
+http_port = int(cfg['Metrics']['httpPort'])
+
+
+def rss():
+    ''' The resident memory of the process in bytes, None refers it is not available '''
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class Timer(object):
+    ''' The timer of the durations '''
+
+    def __init__(self, reservoir=reservoir):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.recent = collections.deque(maxlen=reservoir)
+
+    def observe(self, seconds):
+        ''' Record the duration of [seconds] '''
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.recent.append(seconds)
+
+    def report(self):
+        ''' The dict of the count, the mean, the percentiles and the max '''
+        if self.count == 0:
+            return dict(count=0)
+        p50, p99 = np.percentile(self.recent, [50, 99])
+        return dict(count=self.count,
+                    mean=self.total / self.count,
+                    p50=p50,
+                    p99=p99,
+                    max=self.max)
+
+
+class Registry(object):
+    ''' The metrics registry.
+
+    Useful methods:
+    - @inc: Add to the counter;
+    - @observe: Record the duration of the timer;
+    - @gauge: Register the gauge;
+    - @snapshot: The snapshot of all the metrics.
+    '''
+
+    def __init__(self, rate_window=rate_window, reservoir=reservoir):
+        ''' Initialize the registry
+
+        Args:
+        - @rate_window: The window of the rates, the unit is 'second';
+        - @reservoir: The number of the latest durations of the timers for the percentiles.
+        '''
+        self.rate_window = rate_window
+        self.reservoir = reservoir
+
+        self.counters = collections.defaultdict(int)
+        self.timers = dict()
+        self.gauges = dict()
+        self.t_start = time.monotonic()
+        # The counts of the previous snapshots, for computing the rates
+        self.history = collections.deque()
+        self.lock = threading.Lock()
+
+    def inc(self, name, n=1):
+        ''' Add [n] to the counter of [name] '''
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        ''' Record the duration of [seconds] to the timer of [name] '''
+        with self.lock:
+            timer = self.timers.get(name, None)
+            if timer is None:
+                timer = self.timers[name] = Timer(self.reservoir)
+            timer.observe(seconds)
+
+    def gauge(self, name, func):
+        ''' Register the gauge of [name],
+        the [func] is called without arguments on the snapshot,
+        it returns the value, or the dict of the values named as [name].key,
+        the existing gauge of the same name is replaced.
+        '''
+        with self.lock:
+            self.gauges[name] = func
+
+    def snapshot(self):
+        ''' The snapshot of all the metrics
+
+        Outs:
+        - The flat dict of the metric names and their values.
+        '''
+        t = time.monotonic()
+        with self.lock:
+            counts = dict(self.counters)
+            counts.update({name: e.count for name, e in self.timers.items()})
+            out = dict(counts)
+            for name, timer in self.timers.items():
+                for key, value in timer.report().items():
+                    out[f'{name}.{key}'] = value
+            gauges = list(self.gauges.items())
+
+            # The rates over the latest window, the oldest snapshot in the window is the base
+            self.history.append((t, counts))
+            while len(self.history) > 1 and t - self.history[1][0] >= self.rate_window:
+                self.history.popleft()
+            t_base, base = self.history[0]
+            if t_base == t:
+                t_base, base = self.t_start, dict()
+
+        for name, count in counts.items():
+            out[f'{name}.rate'] = (count - base.get(name, 0)) / max(t - t_base, 1e-9)
+
+        # The gauges are called out of the lock, they may be slow
+        for name, func in gauges:
+            try:
+                value = func()
+            except:
+                logger.warning(f'Failed on the gauge of "{name}"')
+                continue
+            if isinstance(value, dict):
+                for key, e in value.items():
+                    out[f'{name}.{key}'] = e
+            else:
+                out[name] = value
+
+        out['uptime'] = t - self.t_start
+        return out
+
+
+# ------------------------------------------------------------------------
+# The registry of the process
+
+registry = Registry()
+registry.gauge('process.rss', rss)
+registry.gauge('log.dropped', lambda: dropped_records(logger.name))
+
+
+def inc(name, n=1):
+    ''' Add [n] to the counter of [name] '''
+    registry.inc(name, n)
+
+
+def observe(name, seconds):
+    ''' Record the duration of [seconds] to the timer of [name] '''
+    registry.observe(name, seconds)
+
+
+def gauge(name, func):
+    ''' Register the gauge of [name], see Registry.gauge '''
+    registry.gauge(name, func)
+
+
+def snapshot():
+    ''' The snapshot of all the metrics, see Registry.snapshot '''
+    return registry.snapshot()
+
+
+# The seconds from importing the package to the startup stages,
+# only the first time of every stage is kept
+startup_stages = dict()
+registry.gauge('startup', lambda: dict(startup_stages))
+
+
+def startup(stage):
+    ''' Mark the startup [stage], like 'connected',
+    the seconds since importing the package is logged and kept in the metrics.
+    '''
+    if stage in startup_stages:
+        return
+    seconds = time.monotonic() - t_import
+    startup_stages[stage] = seconds
+    logger.info(f'Startup stage "{stage}" is reached in {seconds:.3f} seconds')
+
+
+def prometheus(snap):
+    ''' Format the [snap] in the text format of Prometheus '''
+    lines = []
+    for name, value in sorted(snap.items()):
+        if isinstance(value, bool):
+            value = int(value)
+        if not isinstance(value, (int, float)):
+            continue
+        lines.append('bci_{} {}'.format(name.replace('.', '_'), value))
+    return '\n'.join(lines) + '\n'
+
+
+def _handler():
+    # Built-in method of making the handler of the HTTP endpoint,
+    # the http.server is imported only if the endpoint is used
+    from http.server import BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                body = prometheus(snapshot()).encode()
+                content_type = 'text/plain; version=0.0.4'
+            elif self.path == '/metrics.json':
+                body = json.dumps(snapshot(), default=float).encode()
+                content_type = 'application/json'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug('Metrics endpoint: ' + format, *args)
+
+    return Handler
+
+
+def serve(host=http_host, port=http_port):
+    ''' Start the HTTP endpoint on independent thread,
+    do nothing if the [port] is 0.
+
+    Outs:
+    - The server, None refers no endpoint.
+    '''
+    if not port:
+        return None
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer((host, port), _handler())
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='Metrics endpoint')
+    thread.setDaemon(True)
+    thread.start()
+    logger.info(f'Metrics endpoint is serving on http://{host}:{port}/metrics')
+    return server
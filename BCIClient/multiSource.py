@@ -0,0 +1,436 @@
+'''
+File: multiSource.py
+Aim: The multi-source acquisition, the streams of several devices are merged sample by sample.
+
+Every source is a device client, like the NeuroScanDeviceClient of the [EEG] section,
+or the one of the second amplifier or the eye tracker,
+it reads its device on its own thread, so the sources run concurrently.
+The last row of every source is its trigger row, the zero row refers it has no trigger.
+
+The merger aligns the sources and writes them into one merged ring buffer,
+- The first source is the primary one, its sample rate is the rate of the merged buffer,
+  and its trigger row is the trigger row of the merged buffer;
+- The other sources are resampled to the rate by the linear interpolation,
+  their trigger rows are not merged;
+- The merged rows are the rows of the sources in order, and the trigger row is the last one.
+
+The sources are aligned by the [alignment] policy,
+- 'timestamp': The start time of every stream is estimated by the arrival of its first packet,
+  the samples before the latest start time are skipped;
+- 'trigger': The stream starts from the first [syncTrigger] in its trigger row,
+  the sync trigger is sent to all the devices by the stimulus.
+The source lagging [maxLag] seconds behind the primary one is regarded as stalled,
+its rows are padded with zeros, and its samples of the padded time are skipped when it comes back,
+so the merged buffer keeps going and the alignment is kept.
+
+The extra sources are configured in the [Sources] section,
+[names] are the names of the sources separated by ',', empty refers the single device,
+every source has its section of [Source.name], the keys are the same as the [EEG] section,
+>> [Sources]
+>> names=eyetracker
+>> [Source.eyetracker]
+>> deviceIP=127.0.0.1
+>> devicePort=4001
+>> numChannels=5
+>> sampleRate=500
+>> simulationMode=False
+
+The merged buffer has the capacity of [bufferSeconds] of the [EEG] section,
+the samples of the sources are moved into it as they arrive,
+so the ring buffers of the sources only cover the alignment and the lag,
+their capacity is the [bufferSeconds] of the [Sources] section.
+
+The health of the sources is reported by @health, and in the sources.* metrics.
+'''
+
+import time
+import threading
+import numpy as np
+
+from . import logger, cfg, metrics
+from .ringBuffer import RingBuffer
+from .neuroScanToolbox import NeuroScanDeviceClient, channel_names, simulationMode, maxLength
+
+source_names = [e.strip()
+                for e in cfg['Sources']['names'].split(',')
+                if e.strip()]
+alignment = cfg['Sources']['alignment']  # 'timestamp' or 'trigger'
+sync_trigger = int(cfg['Sources']['syncTrigger'])
+max_lag = float(cfg['Sources']['maxLag'])  # Seconds
+stall_timeout = float(cfg['Sources']['stallTimeout'])  # Seconds
+# The capacity of the ring buffers of the sources, the unit is 'second'
+source_seconds = int(cfg['Sources']['bufferSeconds'])
+
+ALIGNMENTS = ('timestamp', 'trigger')
+
+
+def config_sources():
+    ''' Make the device clients of the extra sources in the setting,
+    their ring buffers are of [source_seconds], since the merged buffer keeps the data.
+
+    Outs:
+    - The list of (name, device client).
+    '''
+    sources = []
+    for name in source_names:
+        section = cfg[f'Source.{name}']
+        client = NeuroScanDeviceClient(section['deviceIP'],
+                                       int(section['devicePort']),
+                                       int(section['sampleRate']),
+                                       int(section['numChannels']),
+                                       simulationMode=section.getboolean('simulationMode',
+                                                                         fallback=simulationMode),
+                                       maxLength=source_seconds)
+        sources.append((name, client))
+    return sources
+
+
+class Resampler(object):
+    ''' The streaming linear resampler,
+    the data is pushed in pieces, and the resampled data is continuous across the pieces.
+    '''
+
+    def __init__(self, rate_in, rate_out):
+        ''' Initialize the resampler from [rate_in] to [rate_out] '''
+        self.step = rate_in / rate_out
+        # The samples not passed yet, and the position of the next output in them
+        self.pending = None
+        self.pos = 0.0
+
+    def push(self, d):
+        ''' Push the new data [d], the shape is (channels x samples)
+
+        Outs:
+        - The resampled data available until now.
+        '''
+        if self.step == 1:
+            return d
+
+        if self.pending is not None:
+            d = np.concatenate([self.pending, d], axis=1)
+        k = d.shape[1]
+        if k == 0 or self.pos > k - 1:
+            self.pending = d
+            return d[:, :0]
+
+        m = int(np.floor((k - 1 - self.pos) / self.step)) + 1
+        x = self.pos + self.step * np.arange(m)
+        i0 = np.floor(x).astype(int)
+        i1 = np.minimum(i0 + 1, k - 1)
+        f = x - i0
+        out = d[:, i0] * (1 - f) + d[:, i1] * f
+
+        # The samples before the next output are not needed anymore
+        self.pos += self.step * m
+        drop = min(int(np.floor(self.pos)), k)
+        self.pending = d[:, drop:]
+        self.pos -= drop
+        return out
+
+
+class Source(object):
+    ''' The source of the merged stream,
+    it keeps the cursor, the alignment and the health of the device client.
+    '''
+
+    def __init__(self, name, client, rate, primary=False):
+        ''' Initialize the source
+
+        Args:
+        - @name: The name of the source;
+        - @client: The device client of the source;
+        - @rate: The sample rate of the merged buffer;
+        - @primary: Whether it is the primary source, its trigger row is kept.
+        '''
+        self.name = name
+        self.client = client
+        self.primary = primary
+        self.sample_rate = client.sample_rate
+        self.n_channels = client.n_channels
+        self.n_rows = self.n_channels if primary else self.n_channels - 1
+        self.channels = getattr(client, 'channels', None) or channel_names(self.n_channels)
+        self.resampler = Resampler(self.sample_rate, rate)
+        self.reset()
+
+    def reset(self):
+        ''' Reset the alignment and the counters '''
+        self.cursor = None  # The next sample index to be read, None refers not aligned
+        self.scanned = 0  # The samples scanned for the sync trigger
+        self.t0 = None  # The estimated time of the first sample
+        self.t_seen = None  # The time when the new data is seen
+        self.seen_length = 0
+        self.outputs = np.zeros((self.n_rows, 0))
+        self.debt = 0  # The samples to be skipped for the padded time
+        self.received = 0
+        self.skipped = 0
+        self.merged = 0
+        self.padded = 0
+
+    @property
+    def available(self):
+        ''' The number of the resampled samples waiting for merging '''
+        return self.outputs.shape[1]
+
+    def observe(self, now):
+        ''' Observe the length of the client at [now], it estimates the start time '''
+        length = self.client.data_length
+        if length > self.seen_length:
+            if self.t0 is None:
+                self.t0 = now - length / self.sample_rate
+            self.t_seen = now
+            self.received += length - self.seen_length
+            self.seen_length = length
+
+    def find_sync(self, code):
+        ''' Find the first [code] in the trigger row from the scanned samples
+
+        Outs:
+        - The sample index of the sync trigger, None refers not found.
+        '''
+        length = self.client.data_length
+        first = max(self.scanned, self.client.buffer.first)
+        d = self.client.get_range(first, length)
+        self.scanned = length
+        idx = np.flatnonzero(d[-1, :] == code)
+        if len(idx) == 0:
+            return None
+        return first + int(idx[0])
+
+    def start_at(self, index):
+        ''' Start reading from the sample [index] '''
+        self.cursor = index
+        self.skipped = index
+        self.scanned = index
+
+    def pull(self):
+        ''' Read the new data from the cursor, and resample it for merging '''
+        length = self.client.data_length
+        if self.cursor is None or length <= self.cursor:
+            return
+        d = self.client.get_range(self.cursor, length)
+        self.cursor = length
+        if not self.primary:
+            d = d[:-1]
+        out = self.resampler.push(d)
+
+        # The samples of the padded time are skipped
+        if self.debt > 0:
+            k = min(self.debt, out.shape[1])
+            out = out[:, k:]
+            self.debt -= k
+
+        self.outputs = np.concatenate([self.outputs, out], axis=1)
+
+    def pad(self, n):
+        ''' Pad [n] zero samples for the stalled source '''
+        self.outputs = np.concatenate([self.outputs, np.zeros((self.n_rows, n))],
+                                      axis=1)
+        self.debt += n
+        self.padded += n
+
+    def take(self, n):
+        ''' Take the [n] samples for merging '''
+        d = self.outputs[:, :n]
+        self.outputs = self.outputs[:, n:]
+        self.merged += n
+        return d
+
+    def health(self, now):
+        ''' The health of the source at [now] '''
+        if self.cursor is None:
+            state = 'aligning'
+        elif self.t_seen is None or now - self.t_seen > stall_timeout:
+            state = 'stalled'
+        else:
+            state = 'streaming'
+        return dict(state=state,
+                    sample_rate=self.sample_rate,
+                    received=self.received,
+                    skipped=self.skipped,
+                    merged=self.merged,
+                    padded=self.padded,
+                    waiting=self.available,
+                    last_seen=None if self.t_seen is None else now - self.t_seen)
+
+
+class MultiSourceClient(object):
+    ''' The merged stream of the sources,
+    it has the reading interface of the NeuroScanDeviceClient,
+    so the acquisition service and the decoders use it as one device.
+
+    Useful methods:
+    - @get_range: Get the data of the sample range;
+    - @get_all: Get the data in the buffer;
+    - @start_send: Start the sources and the merging;
+    - @stop_send: Stop the merging and the sources;
+    - @disconnect: Disconnect the sources;
+    - @health: The health of the sources.
+    '''
+
+    def __init__(self, sources, alignment=alignment, sync_trigger=sync_trigger, max_lag=max_lag, maxLength=maxLength, autoDetectLabelFlag=False, predict=None, poll_interval=0.02):
+        ''' Initialize the merged stream
+
+        Args:
+        - @sources: The list of (name, device client), the first one is the primary source;
+        - @alignment: The policy of the alignment, see ALIGNMENTS;
+        - @sync_trigger: The code of the sync trigger of the 'trigger' alignment;
+        - @max_lag: The source lagging the seconds behind the primary one is padded;
+        - @maxLength: The max length of the merged data, the unit is in seconds;
+        - @autoDetectLabelFlag: The flag of automatically detect 33 label, if it detected, the predict function will be called;
+        - @predict: Predict function, it will be called on independent thread when 33 label is detected;
+        - @poll_interval: The interval of merging, the unit is 'second'.
+        '''
+        if alignment not in ALIGNMENTS:
+            raise ValueError(
+                f'Unknown alignment "{alignment}", it should be one of {ALIGNMENTS}')
+
+        primary = sources[0][1]
+        self.sample_rate = primary.sample_rate
+        self.sources = [Source(name, client, self.sample_rate, primary=i == 0)
+                        for i, (name, client) in enumerate(sources)]
+
+        # The rows of the sources, the trigger row of the primary source is the last one
+        channels = [f'{e.name}:{c}'
+                    for e in self.sources
+                    for c in e.channels[:-1]]
+        self.channels = channels + [self.sources[0].channels[-1]]
+        self.n_channels = len(self.channels)
+
+        self.alignment = alignment
+        self.sync_trigger = sync_trigger
+        self.max_lag = max_lag
+        self.maxLength = maxLength
+        self.autoDetectLabelFlag = autoDetectLabelFlag
+        self.predict = predict
+        self.poll_interval = poll_interval
+
+        self.buffer = RingBuffer(self.n_channels, self.maxLength * self.sample_rate)
+        self.merging = False
+        self.merge_thread = None
+        logger.info(
+            f'Multi-source client initialized of {[e.name for e in self.sources]}, the merged buffer is {self.buffer.data.shape}')
+
+    @property
+    def data_length(self):
+        ''' The number of the samples ever merged '''
+        return self.buffer.length
+
+    def get_all(self):
+        return self.buffer.read(self.buffer.first)
+
+    def get_range(self, start, stop=None, out=None):
+        return self.buffer.read(start, stop, out)
+
+    def health(self):
+        ''' The health of the sources
+
+        Outs:
+        - The dict of the source names and their health.
+        '''
+        now = time.monotonic()
+        return {e.name: e.health(now) for e in self.sources}
+
+    def _flat_health(self):
+        # Built-in method of flattening the health for the metrics
+        return {f'{name}.{key}': value
+                for name, e in self.health().items()
+                for key, value in e.items()
+                if not isinstance(value, str)}
+
+    def start_send(self):
+        ''' Start the sources, and merge them on independent thread '''
+        self.buffer = RingBuffer(self.n_channels, self.maxLength * self.sample_rate)
+        for source in self.sources:
+            source.reset()
+            source.resampler = Resampler(source.sample_rate, self.sample_rate)
+            source.client.start_send()
+
+        self.merging = True
+        self.merge_thread = threading.Thread(target=self._keep_merging,
+                                             name='Source merger')
+        self.merge_thread.setDaemon(True)
+        self.merge_thread.start()
+        metrics.gauge('sources', self._flat_health)
+
+    def stop_send(self):
+        ''' Stop the merging and the sources '''
+        self.merging = False
+        for source in self.sources:
+            source.client.stop_send()
+
+    def wait_stopped(self, timeout=1):
+        if self.merge_thread is not None:
+            self.merge_thread.join(timeout)
+            self.merge_thread = None
+        for source in self.sources:
+            source.client.wait_stopped(timeout)
+
+    def disconnect(self):
+        ''' Disconnect the sources '''
+        for source in self.sources:
+            source.client.disconnect()
+
+    def _align(self):
+        # Built-in method of aligning the sources by the policy,
+        # Outs: Whether the sources are aligned.
+        if self.alignment == 'timestamp':
+            if any([e.t0 is None for e in self.sources]):
+                return False
+            t = max([e.t0 for e in self.sources])
+            for source in self.sources:
+                source.start_at(int(round((t - source.t0) * source.sample_rate)))
+
+        else:
+            for source in self.sources:
+                if source.cursor is None:
+                    index = source.find_sync(self.sync_trigger)
+                    if index is not None:
+                        source.start_at(index)
+            if any([e.cursor is None for e in self.sources]):
+                return False
+
+        logger.info(
+            f'Sources are aligned by {self.alignment}, skipped {[e.skipped for e in self.sources]} samples')
+        return True
+
+    def _merge(self):
+        # Built-in method of merging the aligned samples into the buffer
+        primary = self.sources[0]
+        lag = int(self.max_lag * self.sample_rate)
+        for source in self.sources[1:]:
+            if primary.available - source.available > lag:
+                n = primary.available - source.available
+                source.pad(n)
+                logger.warning(
+                    f'Source "{source.name}" is {n / self.sample_rate:.3f} seconds behind, padded with zeros')
+
+        n = min([e.available for e in self.sources])
+        if n == 0:
+            return
+
+        d = [e.take(n) for e in self.sources]
+        d = np.concatenate([d[0][:-1]] + d[1:] + [d[0][-1:]], axis=0)
+        self.buffer.write(d)
+
+        if self.autoDetectLabelFlag and 33 in d[-1, :]:
+            t = threading.Thread(target=self.predict, name='Inference')
+            t.setDaemon(True)
+            t.start()
+
+    def _keep_merging(self):
+        # Built-in method of merging the sources until stopped
+        aligned = False
+        while self.merging:
+            time.sleep(self.poll_interval)
+            now = time.monotonic()
+            for source in self.sources:
+                source.observe(now)
+
+            if not aligned:
+                aligned = self._align()
+                if not aligned:
+                    continue
+
+            for source in self.sources:
+                source.pull()
+            self._merge()
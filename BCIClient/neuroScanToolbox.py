@@ -1,30 +1,158 @@
+import os
 import time
 import struct
 import socket
+import hashlib
+import tempfile
 import threading
+import importlib.util
 import numpy as np
-from .BCIDecoder import generate_simulation_data
 
-from . import logger
+from . import logger, cfg, telemetry, metrics
+from .ringBuffer import RingBuffer
+from . import acquisitionCore
+
+# The simulation mode generates the data instead of connecting to the device
+simulationMode = cfg.getboolean('EEG', 'simulationMode')
+# The simulation data is cached in the folder, empty refers the temporary folder of the system
+simulationCache = cfg.getboolean('EEG', 'simulationCache')
+simulationCacheFolder = cfg['EEG']['simulationCacheFolder'] or tempfile.gettempdir()
+# The capacity of the ring buffer, the unit is 'second',
+# the device stream is kept open across the sessions, so it should cover the longest session,
+# the older data is overwritten and counted in the buffer.overwritten metric,
+# the buffer takes (numChannels x sampleRate x 8) bytes per second, like 0.55 MB for 69 channels at 1000 Hz
+maxLength = int(cfg['EEG']['bufferSeconds'])
+scale = 0.0298  # uV per count
+
+# The EEG channels of the device, the trigger channel is the last row of the data
+CHANNELS = [
+    'FP1', 'FPZ', 'FP2', 'AF3', 'AF4', 'F7', 'F5', 'F3',
+    'F1', 'FZ', 'F2', 'F4', 'F6', 'F8', 'FT7', 'FC5',
+    'FC3', 'FC1', 'FCZ', 'FC2', 'FC4', 'FC6', 'FT8', 'T7',
+    'C5', 'C3', 'C1', 'CZ', 'C2', 'C4', 'C6', 'T8',
+    'M1', 'TP7', 'CP5', 'CP3', 'CP1', 'CPZ', 'CP2', 'CP4',
+    'CP6', 'TP8', 'M2', 'P7', 'P5', 'P3', 'P1', 'PZ',
+    'P2', 'P4', 'P6', 'P8', 'PO7', 'PO5', 'PO3', 'POZ',
+    'PO4', 'PO6', 'PO8', 'CB1', 'O1', 'OZ', 'O2', 'CB2',
+    'HEO', 'VEO', 'EKG', 'EMG'
+]
+TRIGGER_CHANNEL = 'TRG'
+
+
+def channel_names(n_channels):
+    ''' Get the names of the [n_channels] rows of the data,
+    the last row is the trigger channel.
+    '''
+    if n_channels == len(CHANNELS) + 1:
+        return CHANNELS + [TRIGGER_CHANNEL]
+    return [f'CH{i+1}' for i in range(n_channels - 1)] + [TRIGGER_CHANNEL]
+
+
+# The version of the cache file, it is changed when the layout of the cache changes
+SIMULATION_CACHE_VERSION = 1
+
+_simulation_data = None
+_simulation_lock = threading.Lock()
+
 
-simulationMode = True
-maxLength = 3600  # Seconds
+def simulation_cache_path(folder=simulationCacheFolder):
+    ''' The path of the cache file of the simulation data in the [folder],
+    it is keyed by the version and the file of the decoder module generating the data,
+    so the cache is generated again when the decoder module is rebuilt.
+    '''
+    try:
+        spec = importlib.util.find_spec(f'{__package__}.BCIDecoder')
+        origin = spec.origin if spec is not None else None
+    except (ImportError, ValueError):
+        origin = None
+
+    key = f'{SIMULATION_CACHE_VERSION}:{origin}'
+    if origin is not None and os.path.isfile(origin):
+        stat = os.stat(origin)
+        key += f':{stat.st_size}:{stat.st_mtime_ns}'
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(folder, f'bci-simulation-{digest}.npy')
+
+
+def _generate_simulation_data():
+    # Built-in method of generating the simulation data,
+    # the decoder module is imported only in the simulation mode
+    from .BCIDecoder import generate_simulation_data
+    tic = time.perf_counter()
+    data, _ = generate_simulation_data()
+    logger.debug(
+        f'Simulation data ({data.shape}) is generated in {time.perf_counter() - tic:.3f} seconds.')
+    return data
+
+
+def _save_simulation_cache(path, data):
+    # Built-in method of saving the [data] into the cache file of [path],
+    # it is written into the temporary file and renamed,
+    # so the other processes never read the partial file.
+    # Outs: The memory-mapped data of the cache file, or the [data] if it fails.
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, path)
+        logger.info(f'Simulation data is cached to "{path}"')
+        return np.load(path, mmap_mode='r')
+    except OSError as err:
+        logger.warning(f'Failed on caching the simulation data to "{path}": {err}')
+        if os.path.isfile(tmp):
+            os.remove(tmp)
+        data.setflags(write=False)
+        return data
+
+
+def simulation_data():
+    ''' The simulation data,
+    it is generated once and shared read-only by the generators,
+    - In the process, it is kept after the first call;
+    - Across the processes, it is memory-mapped from the cache file,
+      so the processes share the pages and never generate it again.
+    '''
+    global _simulation_data
+    with _simulation_lock:
+        if _simulation_data is not None:
+            return _simulation_data
+
+        if not simulationCache:
+            data = _generate_simulation_data()
+            data.setflags(write=False)
+            _simulation_data = data
+            return data
+
+        path = simulation_cache_path()
+        try:
+            data = np.load(path, mmap_mode='r')
+            logger.debug(
+                f'Simulation data ({data.shape}) is mapped from the cache "{path}"')
+        except (OSError, ValueError):
+            data = _save_simulation_cache(path, _generate_simulation_data())
+
+        _simulation_data = data
+        return data
 
 
 class SimulationDataGenerator(object):
-    ''' Generate simulation data '''
+    ''' Generate simulation data,
+    the data is generated on the first pop, and shared by the generators.
+    '''
 
     def __init__(self):
-        ''' Initialize the simulation data '''
-        self.all_data, _ = generate_simulation_data()
-        self.raw = self.all_data.copy()
+        ''' Initialize the simulation data generator '''
+        self.all_data = None
+        self.raw = None
         self.ptr = 0
-        logger.debug(f'Simulation data ({self.all_data.shape}) is generated.')
 
     def reset(self):
         ''' Reset the simulation data generator,
         the generator will work as it was initialized.
         '''
+        if self.raw is None:
+            self.raw = simulation_data()
         self.all_data = self.raw
         self.ptr = 0
         logger.debug(
@@ -36,6 +164,9 @@ class SimulationDataGenerator(object):
         Args:
         - @length: The length to be popped from the top.
         '''
+        if self.all_data is None:
+            self.reset()
+
         if length < self.all_data.shape[1]:
             d = self.all_data[:, :length]
             self.all_data = self.all_data[:, length:]
@@ -49,7 +180,7 @@ class SimulationDataGenerator(object):
             logger.debug(f'Current data is empty, restart from begining.')
             return d
 
-        if length < self.all_data.shape[1]:
+        if length > self.all_data.shape[1]:
             d0 = self.all_data.copy()
             logger.debug(f'Partly fetch data 1 for {d0.shape[1]}.')
             self.all_data = self.raw
@@ -78,7 +209,7 @@ class NeuroScanDeviceClient(object):
     5.2. Disconnect from the device, @disconnect.
     '''
 
-    def __init__(self, ip_address, port, sample_rate, n_channels, time_per_packet=0.04, simulationMode=simulationMode, maxLength=maxLength, autoDetectLabelFlag=False, predict=None):
+    def __init__(self, ip_address, port, sample_rate, n_channels, time_per_packet=0.04, simulationMode=simulationMode, maxLength=maxLength, autoDetectLabelFlag=False, predict=None, buffer=None):
         '''Initialize with Basic Parameters,
         and connect to the device.
 
@@ -89,13 +220,15 @@ class NeuroScanDeviceClient(object):
         - @n_channels: The number of channels;
         - @time_per_packet: The time gap between two packet from the device, the default value is 0.04 seconds;
         - @simulationMode: If use simulation mode, in simulation mode, the EEG Device is ignored, the data will be automatically generated;
-        - @maxLength: The max length of the data, the unit is in seconds;
+        - @maxLength: The max length of the data, the unit is in seconds, the older data is overwritten;
         - @autoDetectLabelFlag: The flag of automatically detect 33 label, if it detected, the predict function will be called;
-        - @predict: Predict function, used for autoDetectLabelFlag, it will be called on independent thread when 33 label is detected.
+        - @predict: Predict function, used for autoDetectLabelFlag, it will be called on independent thread when 33 label is detected;
+        - @buffer: The existing ring buffer to collect the data into, like the one on the shared memory, the [maxLength] is ignored if it is provided.
         '''
         self.simulationMode = simulationMode
 
         self.maxLength = maxLength
+        self.shared_buffer = buffer
 
         self.ip_address = ip_address
         self.port = port
@@ -106,7 +239,8 @@ class NeuroScanDeviceClient(object):
 
         self._clear()
 
-        logger.info(f'EEG Device client initialized.')
+        logger.info(
+            f'EEG Device client initialized, the acquisition core is {"compiled" if acquisitionCore.compiled else "pure Python"}.')
 
         if not simulationMode:
             self.connect()
@@ -121,30 +255,41 @@ class NeuroScanDeviceClient(object):
                 f'Using auto detect label mode, when 33 received, the predict func will be called')
 
     def _clear(self):
-        ''' Clear data '''
-        self.data = np.zeros(
-            (self.n_channels, self.maxLength * self.sample_rate))
-        self.data_length = 0
+        ''' Clear data,
+        the provided buffer is never cleared, since it is shared with the readers.
+        '''
+        if self.shared_buffer is not None:
+            self.buffer = self.shared_buffer
+            logger.info(
+                f'Use the provided ring buffer of {self.buffer.data.shape}')
+            return
+
+        self.buffer = RingBuffer(self.n_channels,
+                                 self.maxLength * self.sample_rate)
         logger.info(
-            f'Created new data pool as zero matrix of {self.data.shape}')
+            f'Created new data pool as ring buffer of {self.buffer.data.shape}, {self.buffer.data.nbytes / 1e6:.0f} MB for {self.maxLength} seconds')
+
+    @property
+    def data_length(self):
+        ''' The number of the samples ever collected '''
+        return self.buffer.length
 
     def _add(self, d):
         ''' Accumulate new data chunk [d] into data '''
-        n = d.shape[1]
-
-        if not self.data_length + n < self.data.shape[1]:
-            logger.error(
-                f'The time limit of the data is reached. New data is ignored.')
-            return
+        start = self.buffer.length
+        self.buffer.write(d)
 
-        self.data[:, self.data_length:self.data_length+n] = d
-        self.data_length += n
+        idx, codes = acquisitionCore.scan_triggers(d[-1, :])
+        for i, code in zip(idx, codes):
+            telemetry.record(telemetry.TRIGGER,
+                             tag=int(code),
+                             a=start + int(i))
 
-        if 33 in d[-1, :]:
+        if 33 in codes:
             self._predict()
 
     def _predict(self):
-        t = threading.Thread(target=self.predict)
+        t = threading.Thread(target=self.predict, name='Inference')
         t.setDaemon(True)
         t.start()
 
@@ -178,11 +323,7 @@ class NeuroScanDeviceClient(object):
         Outs:
         - The contents in the header.
         '''
-        chan_name = struct.unpack('>4s', header_packet[:4])
-        w_code = struct.unpack('>H', header_packet[4:6])
-        w_request = struct.unpack('>H', header_packet[6:8])
-        packet_size = struct.unpack('>I', header_packet[8:])
-        return (chan_name[0], w_code[0], w_request[0], packet_size[0])
+        return acquisitionCore.unpack_header(header_packet)
 
     def _unpack_data(self, data_packet):
         '''The method of unpacking data.
@@ -193,9 +334,7 @@ class NeuroScanDeviceClient(object):
         Outs:
         - The data in matrix, the shape is (n_channels x time_points).
         '''
-        data_trans = np.asarray(struct.unpack(self._unpack_data_fmt(),
-                                              data_packet)).reshape((-1, self.n_channels + 1)).T
-        return data_trans
+        return acquisitionCore.unpack_data(data_packet, self.n_channels)
 
     def connect(self):
         '''Connect to the device,
@@ -227,7 +366,7 @@ class NeuroScanDeviceClient(object):
         - @msg: The message to be sent, it should be of bytes.
         '''
         self.client.send(msg)
-        logger.debug(f'Sent {msg}')
+        logger.debug('Sent %s', msg)
 
     def start_send(self):
         '''Send start sending message to the device.
@@ -249,9 +388,10 @@ class NeuroScanDeviceClient(object):
             self.send(struct.pack('12B', 67, 84, 82,
                                   76, 0, 3, 0, 3, 0, 0, 0, 0))
 
-        t = threading.Thread(target=self.collect)
+        t = threading.Thread(target=self.collect, name='Device collector')
         t.setDaemon(True)
         t.start()
+        self.collect_thread = t
 
     def collect(self):
         '''The collecting method used by start_acq.
@@ -263,10 +403,16 @@ class NeuroScanDeviceClient(object):
         while self.collecting:
             try:
                 d = self.get_data()
+                tic = time.perf_counter()
                 self._add(d)
+                telemetry.record(telemetry.PACKET,
+                                 a=self.data_length,
+                                 b=time.perf_counter() - tic)
+                metrics.inc('device.packets')
+                metrics.inc('device.samples', d.shape[1])
                 if self.data_length % self.sample_rate == 0:
-                    logger.debug(
-                        f'Accumulated data length: {self.data_length}')
+                    logger.debug('Accumulated data length: %d',
+                                 self.data_length)
             except ConnectionAbortedError:
                 logger.warning(
                     'Connection to the device is closed. This can be normal if collecting is done.')
@@ -293,25 +439,43 @@ class NeuroScanDeviceClient(object):
             if details_header[-1] == self.bytes_per_packet:
                 pass
             else:
+                metrics.inc('device.malformed')
                 print(
                     f'Warning, received data has {details_header[-1]} bytes, and required data should have {self.bytes_per_packet} bytes. The EEG channels setting may be incorrect')
 
             bytes_data = self.receive_data(self.bytes_per_packet)
-            new_data_trans = self._unpack_data(bytes_data)
+            metrics.inc('device.bytes', len(tmp_header) + len(bytes_data))
+            tic = time.perf_counter()
 
-            new_data_temp = np.empty(new_data_trans.shape, dtype=np.float)
-            new_data_temp[:-1, :] = new_data_trans[:-1, :] * 0.0298  # 单位 uV
-            new_data_temp[-1, :] = np.zeros(new_data_trans.shape[1])
+            # The packet has one more row than the buffer, the trigger row is zeroed
+            new_data_temp = acquisitionCore.decode_packet(bytes_data,
+                                                          self.n_channels,
+                                                          scale)  # 单位 uV
+            metrics.observe('device.decode', time.perf_counter() - tic)
 
         return new_data_temp
 
     def get_all(self):
-        '''Get the accumulated data as a matrix, the shape is (n_channels x time_points(accumulated)).
+        '''Get the accumulated data as a matrix, the shape is (n_channels x time_points(accumulated)),
+        only the data still in the ring buffer is available.
 
         Outs:
         - The accumulated data.
         '''
-        return self.data[:, :self.data_length]
+        return self.buffer.read(self.buffer.first)
+
+    def get_range(self, start, stop=None, out=None):
+        '''Get the data of the sample range [start, stop).
+
+        Args:
+        - @start: The first sample index, counts from the start of the collecting;
+        - @stop: The sample index after the last one, None refers the latest sample;
+        - @out: The array to copy the data into, None refers the read-only view is returned, see RingBuffer.read.
+
+        Outs:
+        - The data, the shape is (n_channels x (stop - start)).
+        '''
+        return self.buffer.read(start, stop, out)
 
     def receive_data(self, n_bytes):
         '''The built-in method of receiving [n_bytes] length bytes from the device,
@@ -323,34 +487,38 @@ class NeuroScanDeviceClient(object):
         Outs:
         - The [n_bytes] length bytes.
         '''
-        b_data = b''
-        flag_stop_recv = False
-        b_count = 0
-
-        while not flag_stop_recv:
-            tmp_bytes = self.client.recv(n_bytes - b_count)
-
-            if b_count == n_bytes or not tmp_bytes:
-                flag_stop_recv = True
-
-            b_count += len(tmp_bytes)
-            b_data += tmp_bytes
-
-        return b_data
+        return acquisitionCore.receive_exactly(self.client, n_bytes)
 
     def stop_send(self):
-        '''Send stopping sending message to the device,
-        and the collecting threading will be stopped accordingly,
-        it will also clear the existing contents in the buffer.
+        '''Stop the collecting,
+        it only marks the collecting threading to be stopped and returns immediately,
+        use @wait_stopped to wait for it.
         '''
         self.collecting = False
-        time.sleep(0.1)
+        logger.debug(f'Collecting is marked as stopped')
+
+    def wait_stopped(self, timeout=1):
+        '''Wait for the collecting threading to be stopped,
+        then send stopping sending message to the device,
+        it will also clear the existing contents in the buffer.
+
+        Args:
+        - @timeout: The timeout of waiting for the collecting threading, the unit is 'second'.
+        '''
+        t = getattr(self, 'collect_thread', None)
+        if t is not None:
+            t.join(timeout)
+            if t.is_alive():
+                logger.warning(
+                    f'Collecting threading is not stopped in {timeout} seconds')
+            self.collect_thread = None
+
         if self.simulationMode:
             logger.debug(f'Not send stop sending message in simulation mode')
         else:
             self.send(struct.pack('12B', 67, 84, 82,
                                   76, 0, 3, 0, 4, 0, 0, 0, 0))
-        self.get_data()
+            self.get_data()
 
     def disconnect(self):
         '''Disconnect from the device.
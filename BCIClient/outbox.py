@@ -0,0 +1,267 @@
+'''
+File: outbox.py
+Aim: The outbound writer of the control socket.
+
+The socket is owned by one writer thread,
+the other threads, like the control loop, the heartbeat and the decoding threads,
+only queue the messages, so the frames never interleave,
+and a slow server never blocks the decoding.
+
+The messages are queued by the priorities,
+- URGENT: The latency-critical messages, like the computed labels, the heartbeats and the errors;
+- BULK: The status messages, they are coalesced into one send.
+The urgent messages are sent at once and the queued bulk messages go after them in the same send,
+the bulk messages are also sent when
+- The oldest one has waited for [batchDelay] seconds;
+- The coalesced bytes exceed [batchBytes].
+The batch policy is configured in the [Outbox] section, [batchDelay] of 0 refers no coalescing.
+
+The queue is bounded by [maxQueueSize] messages, when it is full the [overflowPolicy] decides
+- 'dropOldest': The oldest message of the same priority is dropped for the new one;
+- 'dropNew': The new message is dropped;
+- 'block': The caller waits for [blockTimeout] seconds, the new message is dropped if the queue is still full.
+The urgent message always takes the room of the oldest bulk message, whatever the policy is.
+
+When the socket fails on sending, the unsent messages are discarded,
+except the ones queued with their [replay] object, they are handed to the [on_error],
+so the link buffers them and replays them on the new connection.
+
+The enqueue-to-wire latency of every message is recorded in the telemetry,
+and the queue depth is reported by @metrics.
+'''
+
+import time
+import threading
+import traceback
+import collections
+
+from . import logger, cfg
+from . import telemetry
+
+URGENT = 0
+BULK = 1
+
+POLICIES = ('dropOldest', 'dropNew', 'block')
+
+# The methods of the urgent messages,
+# the pre-encoded messages, like the heartbeats and the errors, are always urgent
+urgent_methods = set(e.strip()
+                     for e in cfg['Outbox']['urgentMethods'].split(',')
+                     if e.strip())
+batch_delay = float(cfg['Outbox']['batchDelay'])  # Seconds
+batch_bytes = int(cfg['Outbox']['batchBytes'])  # Bytes
+max_queue = int(cfg['Outbox']['maxQueueSize'])  # Messages
+policy = cfg['Outbox']['overflowPolicy']
+block_timeout = float(cfg['Outbox']['blockTimeout'])  # Seconds
+
+
+def is_urgent(message):
+    ''' Whether the [message] is sent at once '''
+    if isinstance(message, dict):
+        return message.get('method', None) in urgent_methods
+    return True
+
+
+class Outbox(object):
+    ''' The outbound writer.
+
+    Useful methods:
+    - @put: Queue the bytes to be sent, it never blocks on the socket;
+    - @close: Send the queued bytes and stop the writer;
+    - @metrics: The depth and the counts of the queue.
+    '''
+
+    def __init__(self, sendall, on_error=None, batch_delay=batch_delay, batch_bytes=batch_bytes, max_queue=max_queue, policy=policy, block_timeout=block_timeout):
+        ''' Initialize the outbox and start the writer
+
+        Args:
+        - @sendall: The sending method of the socket, it is only called by the writer;
+        - @on_error: The method called once when the socket fails on sending,
+          it is called as on_error(replays), the [replays] are the replay objects of the unsent messages;
+        - @batch_delay: The max delay of the bulk messages, the unit is 'second', 0 refers no coalescing;
+        - @batch_bytes: The max coalesced bytes of the bulk messages;
+        - @max_queue: The max number of the queued messages;
+        - @policy: The policy of the full queue, see POLICIES;
+        - @block_timeout: The max waiting of the 'block' policy, the unit is 'second'.
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy "{policy}", it should be one of {POLICIES}')
+
+        self.sendall = sendall
+        self.on_error = on_error
+        self.batch_delay = batch_delay
+        self.batch_bytes = batch_bytes
+        self.max_queue = max_queue
+        self.policy = policy
+        self.block_timeout = block_timeout
+
+        # The queues of the priorities, the item is (data, enqueue time, priority, replay)
+        self.queues = (collections.deque(), collections.deque())
+        self.bulk_bytes = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self._keep_writing,
+                                       name='Outbox writer')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        ''' The number of the queued messages '''
+        return len(self.queues[URGENT]) + len(self.queues[BULK])
+
+    def put(self, data, urgent=True, replay=None):
+        ''' Queue the bytes of [data] by the priority,
+        the [replay] is handed back by the on_error if the data is not sent,
+        the OSError is raised if the writer has stopped.
+
+        Outs:
+        - Whether the data is queued, False refers it is dropped by the policy.
+        '''
+        priority = URGENT if urgent else BULK
+        with self.condition:
+            if self.error is not None:
+                raise OSError(f'Outbox is failed: {self.error}')
+            if self.closed:
+                raise OSError('Outbox is closed')
+
+            if self.depth >= self.max_queue and not self._overflow(priority):
+                return False
+
+            self.queues[priority].append((data, time.monotonic(), priority, replay))
+            if priority == BULK:
+                self.bulk_bytes += len(data)
+            self.max_depth = max(self.max_depth, self.depth)
+            self.condition.notify_all()
+        return True
+
+    def close(self, timeout=1):
+        ''' Send the queued bytes and stop the writer,
+        the queued bytes are discarded if they are not sent in [timeout] seconds.
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        if threading.current_thread() is not self.thread:
+            self.thread.join(timeout)
+        logger.info(f'Outbox is closed, {self.metrics()}')
+
+    def metrics(self):
+        ''' The metrics of the queue
+
+        Outs:
+        - The dict of the queue depths and the counts of the messages.
+        '''
+        with self.condition:
+            return dict(depth=self.depth,
+                        urgent=len(self.queues[URGENT]),
+                        bulk=len(self.queues[BULK]),
+                        max_depth=self.max_depth,
+                        sent=self.sent,
+                        dropped=self.dropped,
+                        failed=self.failed)
+
+    def _overflow(self, priority):
+        # Built-in method of making room for the new message of [priority] by the policy,
+        # it is called with the condition acquired.
+        # Outs: Whether the new message can be queued.
+        if priority == URGENT and self.queues[BULK]:
+            data, _, _, _ = self.queues[BULK].popleft()
+            self.bulk_bytes -= len(data)
+            self._count_drop()
+            return True
+
+        if self.policy == 'block':
+            deadline = time.monotonic() + self.block_timeout
+            while self.depth >= self.max_queue and self.error is None and not self.closed:
+                remains = deadline - time.monotonic()
+                if remains <= 0:
+                    break
+                self.condition.wait(remains)
+            if self.depth < self.max_queue:
+                return True
+
+        elif self.policy == 'dropOldest' and self.queues[priority]:
+            # The urgent message is never dropped for a bulk one
+            data, _, _, _ = self.queues[priority].popleft()
+            if priority == BULK:
+                self.bulk_bytes -= len(data)
+            self._count_drop()
+            return True
+
+        self._count_drop()
+        return False
+
+    def _count_drop(self):
+        # Built-in method of counting the dropped message
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            logger.warning(
+                f'Outbox is full of {self.depth} messages, {self.dropped} messages are dropped by "{self.policy}"')
+
+    def _take(self):
+        # Built-in method of taking the messages to be sent,
+        # it is called with the condition acquired.
+        # Outs: The taken messages, or None with the seconds to wait.
+        urgent, bulk = self.queues
+        if urgent:
+            taken = list(urgent) + list(bulk)
+        elif bulk and (self.closed
+                       or self.batch_delay <= 0
+                       or self.bulk_bytes >= self.batch_bytes
+                       or time.monotonic() - bulk[0][1] >= self.batch_delay):
+            taken = list(bulk)
+        else:
+            remains = bulk[0][1] + self.batch_delay - time.monotonic() if bulk else None
+            return None, remains
+
+        urgent.clear()
+        bulk.clear()
+        self.bulk_bytes = 0
+        return taken, None
+
+    def _keep_writing(self):
+        # Built-in method of the writer thread, it owns the socket
+        while True:
+            with self.condition:
+                taken, remains = self._take()
+                if taken is None:
+                    if self.closed:
+                        break
+                    self.condition.wait(remains)
+                    continue
+                # Wake up the callers blocked by the full queue
+                self.condition.notify_all()
+
+            try:
+                self.sendall(b''.join([data for data, _, _, _ in taken]))
+            except OSError as err:
+                logger.warning(
+                    f'Failed on sending {len(taken)} messages: {traceback.format_exc()}')
+                with self.condition:
+                    self.error = err
+                    unsent = taken + list(self.queues[URGENT]) + list(self.queues[BULK])
+                    self.failed += len(unsent)
+                    for queue in self.queues:
+                        queue.clear()
+                    self.bulk_bytes = 0
+                    self.condition.notify_all()
+                if self.on_error is not None:
+                    self.on_error([replay for _, _, _, replay in unsent
+                                   if replay is not None])
+                break
+
+            t = time.monotonic()
+            for data, enqueued, priority, _ in taken:
+                telemetry.record(telemetry.SEND,
+                                 tag=int(priority == URGENT),
+                                 a=len(data),
+                                 b=t - enqueued)
+            with self.condition:
+                self.sent += len(taken)
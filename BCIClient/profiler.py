@@ -0,0 +1,219 @@
+'''
+File: profiler.py
+Aim: The built-in sampling profiler, it is toggled by the control messages.
+
+The profiler samples the stacks of all the threads by sys._current_frames,
+like the device collector, the control loop and the inference threads,
+so the live experiment is profiled without restarting under a profiler.
+
+The stacks are aggregated in the folded format of the flamegraph,
+every line is the thread name and the frames from the root separated by ';', and the count of the samples,
+>> Device collector;collect (neuroScanToolbox.py:300);_add (neuroScanToolbox.py:320) 42
+it is read by flamegraph.pl, speedscope and the other flamegraph tools.
+
+The overhead is bounded,
+- The sampling interval is stretched so the sampling costs no more than [maxOverhead] of one core;
+- The stacks are cut to [maxDepth] frames from the leaf;
+- The profiler stops sampling by itself after [maxDuration] seconds,
+  the stacks are kept until it is stopped.
+The policy is configured in the [Profiler] section.
+
+Useful functions:
+- @start: Start the profiler of the process;
+- @stop: Stop the profiler and write the folded stacks;
+- @running: Whether the profiler is running.
+'''
+
+import os
+import sys
+import time
+import threading
+import collections
+
+from . import logger, cfg, pwd, timestr
+
+interval = float(cfg['Profiler']['interval'])  # Seconds
+max_overhead = float(cfg['Profiler']['maxOverhead'])  # Fraction of one core
+max_duration = float(cfg['Profiler']['maxDuration'])  # Seconds
+max_depth = int(cfg['Profiler']['maxDepth'])  # Frames
+
+
+def _frame_name(frame):
+    # Built-in method of naming the [frame] as the function and its place
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+class Profiler(object):
+    ''' The sampling profiler,
+    the stacks are sampled on its own thread.
+
+    Useful methods:
+    - @start: Start sampling;
+    - @stop: Stop sampling and write the folded stacks;
+    - @folded: The lines of the folded stacks.
+    '''
+
+    def __init__(self, filepath, interval=interval, max_overhead=max_overhead, max_duration=max_duration, max_depth=max_depth):
+        ''' Initialize the profiler
+
+        Args:
+        - @filepath: The path of the folded stacks file;
+        - @interval: The min interval between two samples, the unit is 'second';
+        - @max_overhead: The max fraction of one core spent on sampling;
+        - @max_duration: The profiler stops by itself after the seconds, 0 refers never;
+        - @max_depth: The max frames of every stack.
+        '''
+        self.filepath = filepath
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.max_duration = max_duration
+        self.max_depth = max_depth
+
+        # The key is the folded stack, the value is the count of the samples
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.cost = 0
+        self.t_start = None
+        self.t_stop = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        ''' Start sampling on independent thread '''
+        self.t_start = time.monotonic()
+        self.thread = threading.Thread(target=self._keep_sampling,
+                                       name='Profiler')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        logger.info(
+            f'Profiler started, sampling every {self.interval} seconds into {self.filepath}')
+
+    def stop(self):
+        ''' Stop sampling and write the folded stacks
+
+        Outs:
+        - The dict of the path, the samples, the seconds and the overhead.
+        '''
+        self.stopping.set()
+        if self.thread is not None and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+        lines = self.folded()
+        with open(self.filepath, 'w') as f:
+            f.write(''.join([e + '\n' for e in lines]))
+
+        stats = self.stats()
+        logger.info(f'Profiler stopped, {stats}')
+        return stats
+
+    def stats(self):
+        ''' The statistics of the profiler
+
+        Outs:
+        - The dict of the path, the samples, the seconds and the overhead.
+        '''
+        if self.t_start is None:
+            seconds = 0
+        else:
+            seconds = (self.t_stop or time.monotonic()) - self.t_start
+        return dict(path=self.filepath,
+                    samples=self.samples,
+                    stacks=len(self.stacks),
+                    seconds=seconds,
+                    overhead=self.cost / seconds if seconds > 0 else 0)
+
+    def folded(self):
+        ''' The lines of the folded stacks, the most sampled ones come first '''
+        return [f'{stack} {count}' for stack, count in self.stacks.most_common()]
+
+    def _sample(self):
+        # Built-in method of sampling the stacks of the threads except the profiler
+        names = {e.ident: e.name for e in threading.enumerate()}
+        me = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            frames = []
+            while frame is not None and len(frames) < self.max_depth:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            frames.append(names.get(ident, f'Thread {ident}'))
+            self.stacks[';'.join(reversed(frames))] += 1
+        self.samples += 1
+
+    def _keep_sampling(self):
+        # Built-in method of sampling until stopped,
+        # the interval is stretched by the cost of the last sample, so the overhead is bounded
+        delay = self.interval
+        while not self.stopping.wait(delay):
+            if self.max_duration > 0 and time.monotonic() - self.t_start > self.max_duration:
+                logger.warning(
+                    f'Profiler stops after running for {self.max_duration} seconds')
+                break
+
+            t = time.perf_counter()
+            self._sample()
+            cost = time.perf_counter() - t
+            self.cost += cost
+
+            delay = self.interval
+            if self.max_overhead > 0:
+                delay = max(delay, cost / self.max_overhead - cost)
+
+        self.t_stop = time.monotonic()
+
+
+# ------------------------------------------------------------------------
+# The profiler of the process,
+# it is shared by the connections, so it keeps running across the reconnections
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def running():
+    ''' Whether the profiler of the process is running '''
+    return _profiler is not None
+
+
+def start(folder=None, **kwargs):
+    ''' Start the profiler of the process,
+    the RuntimeError is raised if it is running.
+
+    Args:
+    - @folder: The folder of the folded stacks file, None refers the logs folder;
+    - @kwargs: The options of the Profiler.
+
+    Outs:
+    - The path of the folded stacks file.
+    '''
+    global _profiler
+    if folder is None:
+        folder = os.path.join(pwd, '..', 'logs')
+
+    with _profiler_lock:
+        if _profiler is not None:
+            raise RuntimeError(
+                f'Profiler is running into {_profiler.filepath}')
+        filepath = os.path.join(folder,
+                                'profile-{}-{}.folded'.format(timestr(), os.getpid()))
+        _profiler = Profiler(filepath, **kwargs)
+        _profiler.start()
+        return filepath
+
+
+def stop():
+    ''' Stop the profiler of the process and write the folded stacks,
+    the RuntimeError is raised if it is not running.
+
+    Outs:
+    - The dict of the path, the samples, the seconds and the overhead.
+    '''
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            raise RuntimeError('Profiler is not running')
+        profiler, _profiler = _profiler, None
+    return profiler.stop()
+
@@ -0,0 +1,145 @@
+'''
+File: ringBuffer.py
+Aim: The ring buffer of the continuously collected data.
+
+The samples are indexed by the absolute sample index,
+which counts from the creation of the buffer and never wraps,
+so the readers can refer the data by [start, stop) indices.
+
+The data is owned by the buffer, the readers get it in two ways,
+- The read-only view, nothing is copied, it is the default,
+  writing into it raises ValueError instead of changing the recording;
+- The copy into the array [out] of the reader, nothing is allocated,
+  the reader owns the copy and is free to change it.
+'''
+
+import numpy as np
+
+from . import logger, metrics
+
+
+class RingBuffer(object):
+    ''' The ring buffer of the continuous data.
+
+    Useful methods:
+    - @write: Append new data;
+    - @read: Read the data of the sample range;
+    - @latest: Read the latest data.
+    '''
+
+    def __init__(self, n_channels, capacity, data=None):
+        ''' Initialize the ring buffer
+
+        Args:
+        - @n_channels: The number of channels;
+        - @capacity: The max number of the samples in the buffer;
+        - @data: The existing array to be used as the buffer, the shape is (n_channels x capacity), a zero matrix is created if it is None.
+        '''
+        if data is None:
+            data = np.zeros((n_channels, capacity))
+
+        self.n_channels = n_channels
+        self.capacity = capacity
+        self.data = data
+        self._length = 0
+
+    @property
+    def length(self):
+        ''' The number of the samples ever written '''
+        return self._length
+
+    def _set_length(self, length):
+        # Built-in method of publishing the new length
+        self._length = length
+
+    @property
+    def first(self):
+        ''' The index of the oldest sample in the buffer '''
+        return max(0, self.length - self.capacity)
+
+    def write(self, d):
+        ''' Append new data [d] into the buffer,
+        the oldest data is overwritten when the buffer is full.
+
+        Args:
+        - @d: The new data, the shape is (n_channels x time_points).
+        '''
+        n = d.shape[1]
+        length = self.length
+
+        if n > self.capacity:
+            d = d[:, -self.capacity:]
+            length += n - self.capacity
+            n = self.capacity
+
+        pos = length % self.capacity
+        k = min(n, self.capacity - pos)
+        self.data[:, pos:pos+k] = d[:, :k]
+        if k < n:
+            self.data[:, :n-k] = d[:, k:]
+
+        self._set_length(length + n)
+
+    def read(self, start, stop=None, out=None):
+        ''' Read the data of the sample range [start, stop),
+        it is a read-only view of the buffer unless the range wraps around the end of the buffer,
+        the wrapped range is concatenated into a new read-only array.
+
+        Args:
+        - @start: The first sample index;
+        - @stop: The sample index after the last one, None refers the latest sample;
+        - @out: The array to copy the data into, the shape is (n_channels x m), m is not less than (stop - start),
+          None refers the read-only data is returned.
+
+        Outs:
+        - The data, the shape is (n_channels x (stop - start)),
+          it is the leading columns of the [out] if it is provided.
+        '''
+        length = self.length
+        if stop is None or stop > length:
+            stop = length
+
+        first = max(0, length - self.capacity)
+        if start < first:
+            metrics.inc('buffer.overwritten', first - start)
+            logger.warning(
+                f'The data from {start} to {first} has been overwritten, only {first} to {stop} is available.')
+            start = first
+
+        if stop <= start:
+            return self._readonly(self.data[:, :0]) if out is None else out[:, :0]
+
+        a = start % self.capacity
+        b = a + stop - start
+        if out is not None:
+            return self._copy(out, a, b)
+
+        if b <= self.capacity:
+            return self._readonly(self.data[:, a:b])
+
+        return self._readonly(np.concatenate([self.data[:, a:],
+                                              self.data[:, :b-self.capacity]], axis=1))
+
+    def latest(self, n, stop=None, out=None):
+        ''' Read the latest [n] samples before [stop], see @read for the [out] '''
+        if stop is None:
+            stop = self.length
+        return self.read(max(0, stop - n), stop, out)
+
+    def _readonly(self, d):
+        # Built-in method of marking the view [d] as read-only, the buffer itself is still writable
+        d.flags.writeable = False
+        return d
+
+    def _copy(self, out, a, b):
+        # Built-in method of copying the data of the positions [a, b) into the [out]
+        n = b - a
+        if out.shape[0] != self.n_channels or out.shape[1] < n:
+            raise ValueError(
+                f'The out array of {out.shape} can not hold the data of ({self.n_channels}, {n})')
+        out = out[:, :n]
+        k = min(n, self.capacity - a)
+        out[:, :k] = self.data[:, a:a+k]
+        if k < n:
+            out[:, k:] = self.data[:, :n-k]
+        return out
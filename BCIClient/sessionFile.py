@@ -0,0 +1,418 @@
+'''
+File: sessionFile.py
+Aim: Compressed and chunked storage format for the recorded EEG sessions.
+
+The data arrives from the device as int32 counts with a fixed scale,
+so the session file stores the counts (optionally delta-encoded along the time axis)
+in fixed-duration chunks, each chunk is compressed independently.
+Reading any time range only decompresses the chunks it touches.
+
+The layout of the file is:
+- MAGIC;
+- chunk, chunk, ..., chunk;
+- footer, the json object of the meta data and the chunk index;
+- footer length, 4 bytes little-endian unsigned int;
+- MAGIC.
+
+Useful functions:
+- @save: Save the data matrix into the session file;
+- @load: Load the data matrix from the session file, the legacy joblib file is also supported;
+- @SessionWriter: Write the session file chunk by chunk;
+- @SessionReader: Read the session file with random access.
+'''
+
+import os
+import json
+import zlib
+import bisect
+import struct
+import numpy as np
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+from . import logger
+
+MAGIC = b'BCISESS1'
+VERSION = 1
+
+_footer_length_fmt = '<I'
+_footer_length_size = struct.calcsize(_footer_length_fmt)
+
+_int32_info = np.iinfo(np.int32)
+
+
+# ------------------------------------------------------------------------
+# Codecs
+# Every codec is a pair of (compress, decompress) functions.
+
+
+def _zlib_compress(raw):
+    return zlib.compress(raw, 1)
+
+
+codecs = dict(
+    none=(bytes, bytes),
+    zlib=(_zlib_compress, zlib.decompress),
+)
+
+if lz4_frame is not None:
+    codecs['lz4'] = (lz4_frame.compress, lz4_frame.decompress)
+
+
+def _get_codec(name):
+    ''' Get the codec by its [name] '''
+    if name not in codecs:
+        raise ValueError(
+            f'Unknown or not installed codec "{name}", available codecs are {list(codecs)}')
+    return codecs[name]
+
+
+def default_codec():
+    ''' The fastest codec installed '''
+    if 'lz4' in codecs:
+        return 'lz4'
+    return 'zlib'
+
+
+# ------------------------------------------------------------------------
+# Encoding Tools
+
+
+def _to_counts(data, scale, trigger_row, out=None):
+    ''' Convert the float [data] into int32 counts,
+    the [trigger_row] is not scaled,
+    the [out] is the float array of the same shape for the scaling, it is allocated if None.
+    '''
+    scaled = np.divide(data, scale, out=out)
+    scaled[trigger_row] = data[trigger_row]
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, _int32_info.min, _int32_info.max, out=scaled)
+    return scaled.astype(np.int32)
+
+
+def _to_float(counts, scale, trigger_row):
+    ''' Convert the int32 [counts] back into the float data '''
+    data = counts.astype(np.float64)
+    data *= scale
+    data[trigger_row] = counts[trigger_row]
+    return data
+
+
+def _delta_encode(counts):
+    ''' Delta encode the [counts] along the time axis,
+    the int32 arithmetic wraps, so the decoding is exact.
+    '''
+    delta = counts.copy()
+    delta[:, 1:] -= counts[:, :-1]
+    return delta
+
+
+def _delta_decode(delta):
+    ''' Decode the delta encoded [delta] along the time axis '''
+    return np.cumsum(delta, axis=1, dtype=np.int32)
+
+
+def find_events(data, trigger_row=-1):
+    ''' Find the events in the [trigger_row] of the [data]
+
+    Args:
+    - @data: The data matrix, the shape is (n_channels x time_points);
+    - @trigger_row: The row of the trigger channel.
+
+    Outs:
+    - The list of [sample index, event code].
+    '''
+    trigger = data[trigger_row]
+    idx = np.flatnonzero(trigger)
+    return [[int(i), int(trigger[i])] for i in idx]
+
+
+# ------------------------------------------------------------------------
+# Writer and Reader
+
+
+class SessionWriter(object):
+    ''' Write the session file chunk by chunk.
+    The data is written into the temporary file of [filepath].tmp and renamed on closing,
+    so the process killed during the saving never leaves the partial file on [filepath].
+
+    Useful methods:
+    - @write: Append the data to the file;
+    - @close: Flush the remaining data, write the footer and make the file durable;
+    - @abort: Discard the unfinished file.
+    '''
+
+    def __init__(self, filepath, channels, sample_rate, scale, chunk_seconds=10, codec=None, delta=True, trigger_row=-1):
+        ''' Initialize the session writer
+
+        Args:
+        - @filepath: The path of the session file;
+        - @channels: The names of the channels, including the trigger channel;
+        - @sample_rate: The sample rate;
+        - @scale: The scale factor from counts to uV;
+        - @chunk_seconds: The duration of every chunk, the unit is 'second';
+        - @codec: The name of the compression codec, the fastest installed codec is used by default;
+        - @delta: Whether to delta encode the counts;
+        - @trigger_row: The row of the trigger channel, it is stored without scaling.
+        '''
+        if codec is None:
+            codec = default_codec()
+        self.compress = _get_codec(codec)[0]
+
+        self.filepath = filepath
+        self.channels = list(channels)
+        self.sample_rate = sample_rate
+        self.scale = scale
+        self.chunk_size = int(chunk_seconds * sample_rate)
+        self.codec = codec
+        self.delta = delta
+        self.trigger_row = trigger_row % len(self.channels)
+
+        self.chunks = []
+        self.events = []
+        self.n_samples = 0
+        self._pending = []
+        self._pending_length = 0
+        # The data is scaled in it chunk by chunk, so the whole data is never copied
+        self._scaled = np.empty((len(self.channels), self.chunk_size))
+
+        if os.path.isfile(filepath):
+            logger.warning(
+                f'File exists (session) "{filepath}", overriding it.')
+
+        self.tmp = f'{filepath}.tmp'
+        self.file = open(self.tmp, 'wb')
+        self.file.write(MAGIC)
+
+    def write(self, data):
+        ''' Append the [data] to the file,
+        the data is stored once a chunk is full.
+
+        Args:
+        - @data: The data matrix, the shape is (n_channels x time_points).
+        '''
+        if data.shape[0] != len(self.channels):
+            raise ValueError(
+                f'The data has {data.shape[0]} channels, but {len(self.channels)} channels are required.')
+
+        if data.shape[1] == 0:
+            return
+
+        # Convert the data piece by piece, every piece fills the pending chunk at most
+        start = 0
+        while start < data.shape[1]:
+            n = min(self.chunk_size - self._pending_length, data.shape[1] - start)
+            counts = _to_counts(data[:, start:start+n],
+                                self.scale,
+                                self.trigger_row,
+                                out=self._scaled[:, :n])
+            self.events.extend([[i + self.n_samples + self._pending_length, c]
+                                for i, c in find_events(counts, self.trigger_row)])
+            self._pending.append(counts)
+            self._pending_length += n
+            start += n
+
+            if self._pending_length == self.chunk_size:
+                self._write_chunk(np.concatenate(self._pending, axis=1))
+                self._pending = []
+                self._pending_length = 0
+
+    def _write_chunk(self, counts):
+        # Built-in method of compressing and writing one chunk
+        if self.delta:
+            counts = _delta_encode(counts)
+        blob = self.compress(np.ascontiguousarray(counts).tobytes())
+        offset = self.file.tell()
+        self.file.write(blob)
+        self.chunks.append([offset, len(blob), self.n_samples, counts.shape[1]])
+        self.n_samples += counts.shape[1]
+
+    def close(self):
+        ''' Flush the remaining data, write the footer and make the file durable '''
+        if self.file is None:
+            return
+
+        if self._pending_length > 0:
+            self._write_chunk(np.concatenate(self._pending, axis=1))
+        self._pending = []
+        self._pending_length = 0
+
+        footer = json.dumps(dict(
+            version=VERSION,
+            codec=self.codec,
+            delta=self.delta,
+            dtype='int32',
+            scale=self.scale,
+            sample_rate=self.sample_rate,
+            channels=self.channels,
+            trigger_row=self.trigger_row,
+            n_samples=self.n_samples,
+            chunk_size=self.chunk_size,
+            chunks=self.chunks,
+            events=self.events,
+        )).encode('utf-8')
+
+        self.file.write(footer)
+        self.file.write(struct.pack(_footer_length_fmt, len(footer)))
+        self.file.write(MAGIC)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        os.replace(self.tmp, self.filepath)
+
+    def abort(self):
+        ''' Discard the unfinished file, the existing file of [filepath] is kept '''
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if os.path.isfile(self.tmp):
+            os.remove(self.tmp)
+
+        logger.debug(
+            f'Saved the session ({len(self.channels)}, {self.n_samples}) in {len(self.chunks)} chunks to {self.filepath}')
+
+
+class SessionReader(object):
+    ''' Read the session file with random access.
+
+    Useful methods:
+    - @read: Read the data of the sample range;
+    - @read_seconds: Read the data of the time range;
+    - @close: Close the file.
+    '''
+
+    def __init__(self, filepath):
+        ''' Initialize the session reader, only the footer is read.
+
+        Args:
+        - @filepath: The path of the session file.
+        '''
+        self.filepath = filepath
+        self.file = open(filepath, 'rb')
+
+        tail_size = _footer_length_size + len(MAGIC)
+        self.file.seek(-tail_size, os.SEEK_END)
+        tail = self.file.read(tail_size)
+        if tail[_footer_length_size:] != MAGIC:
+            self.file.close()
+            raise ValueError(f'Not a valid session file: "{filepath}"')
+
+        footer_length = struct.unpack(_footer_length_fmt,
+                                      tail[:_footer_length_size])[0]
+        self.file.seek(-tail_size - footer_length, os.SEEK_END)
+        meta = json.loads(self.file.read(footer_length).decode('utf-8'))
+
+        self.meta = meta
+        self.channels = meta['channels']
+        self.sample_rate = meta['sample_rate']
+        self.scale = meta['scale']
+        self.trigger_row = meta['trigger_row']
+        self.n_samples = meta['n_samples']
+        self.events = meta['events']
+        self.chunks = meta['chunks']
+        self.decompress = _get_codec(meta['codec'])[1]
+        self._starts = [e[2] for e in self.chunks]
+
+    @property
+    def shape(self):
+        return (len(self.channels), self.n_samples)
+
+    def _read_chunk(self, idx):
+        # Built-in method of reading and decoding one chunk as counts
+        offset, nbytes, _, length = self.chunks[idx]
+        self.file.seek(offset)
+        raw = self.decompress(self.file.read(nbytes))
+        counts = np.frombuffer(raw, dtype=np.int32).reshape(
+            (len(self.channels), length))
+        if self.meta['delta']:
+            counts = _delta_decode(counts)
+        return counts
+
+    def read(self, start=0, stop=None):
+        ''' Read the data of the sample range [start, stop),
+        only the chunks touched by the range are decompressed.
+
+        Args:
+        - @start: The first sample index;
+        - @stop: The sample index after the last one, None refers the end of the session.
+
+        Outs:
+        - The data matrix, the shape is (n_channels x (stop - start)).
+        '''
+        if stop is None or stop > self.n_samples:
+            stop = self.n_samples
+        start = max(0, start)
+
+        out = np.empty((len(self.channels), max(0, stop - start)))
+        if stop <= start:
+            return out
+
+        first = bisect.bisect_right(self._starts, start) - 1
+        last = bisect.bisect_left(self._starts, stop)
+        for idx in range(first, last):
+            chunk_start = self._starts[idx]
+            counts = self._read_chunk(idx)
+            a = max(start, chunk_start)
+            b = min(stop, chunk_start + counts.shape[1])
+            out[:, a-start:b-start] = _to_float(counts[:, a-chunk_start:b-chunk_start],
+                                                self.scale,
+                                                self.trigger_row)
+        return out
+
+    def read_seconds(self, t_start=0, t_stop=None):
+        ''' Read the data of the time range [t_start, t_stop), the unit is 'second' '''
+        start = int(round(t_start * self.sample_rate))
+        stop = None if t_stop is None else int(
+            round(t_stop * self.sample_rate))
+        return self.read(start, stop)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# ------------------------------------------------------------------------
+# Shortcuts
+
+
+def is_session_file(filepath):
+    ''' Whether the [filepath] is a session file '''
+    with open(filepath, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def save(filepath, data, channels, sample_rate, scale, **kwargs):
+    ''' Save the [data] into the session file of [filepath],
+    the other kwargs are passed to the SessionWriter.
+    '''
+    writer = SessionWriter(filepath, channels, sample_rate, scale, **kwargs)
+    try:
+        writer.write(data)
+        writer.close()
+    except:
+        writer.abort()
+        raise
+
+
+def load(filepath):
+    ''' Load the whole data matrix from [filepath],
+    the legacy joblib file is also supported.
+    '''
+    if not is_session_file(filepath):
+        logger.debug(f'Loading legacy joblib file "{filepath}"')
+        # The joblib is imported only for the legacy files
+        from joblib import load as joblib_load
+        return joblib_load(filepath)
+
+    with SessionReader(filepath) as reader:
+        return reader.read()
@@ -2,11 +2,122 @@ import time
 import threading
 import traceback
 
-from joblib import load
-
-from . import logger
+from . import logger, telemetry, metrics
+from .sessionFile import load
 from .dataCollector import DataStack
-from .BCIDecoder import BCIDecoder
+from .backgroundWriter import writer
+from .bufferPool import window_dtype, decoder_input
+
+
+def new_decoder(*args):
+    ''' Make the decoder of [args],
+    the decoder module and its ML stack are imported on the first session, not on importing the package.
+    '''
+    from .BCIDecoder import BCIDecoder
+    return BCIDecoder(*args)
+
+
+def save_in_background(save, send, sessionName, dataPath):
+    ''' Run the [save] on the background writer,
+    the sessionSaved message is sent when the data is durable.
+
+    Args:
+    - @save: The saving function, it is called without arguments;
+    - @send: The sending method;
+    - @sessionName: The name of the session;
+    - @dataPath: The path of the saved data.
+    '''
+    def job():
+        try:
+            save()
+        except:
+            err = traceback.format_exc()
+            logger.error(f'Failed on saving {sessionName} session: {err}')
+            send(dict(
+                method='error',
+                reason='operationFailed',
+                detail='fileError',
+                raw='',
+                comment=f'Failed on saving {sessionName} session to "{dataPath}", error is "{err}"'
+            ))
+            return
+
+        logger.info(f'The {sessionName} session is saved to {dataPath}')
+        send(dict(
+            method='sessionSaved',
+            sessionName=sessionName,
+            dataPath=dataPath,
+        ))
+
+    writer.submit(job, name=f'Save {sessionName} session')
+
+
+def report_link(link, sessionName):
+    ''' Report the RTT metrics of the connection on stopping the session
+
+    Args:
+    - @link: The heartbeat of the connection, None refers no heartbeat;
+    - @sessionName: The name of the session.
+    '''
+    if link is None:
+        return
+    m = link.metrics()
+    if m['srtt'] is None:
+        logger.info(f'Session {sessionName} stopped, no RTT is measured')
+        return
+    logger.info(
+        f'Session {sessionName} stopped, SRTT is {m["srtt"]:.6f} seconds, RTTVAR is {m["rttvar"]:.6f} seconds, {m["lost"]} of {m["sent"]} heartbeats lost')
+
+
+class ShadowDecoder(object):
+    ''' The shadow decoder,
+    it runs side by side with the decoder of the session for A/B comparison,
+    its labels are logged and compared, but never sent.
+    '''
+
+    def __init__(self, decoderpath, update_count=None):
+        ''' Initialize the shadow decoder
+
+        Args:
+        - @decoderpath: The path of the decoder;
+        - @update_count: How many trials for update the module, None refers not updating.
+        '''
+        self.decoderpath = decoderpath
+        self.update_count = update_count
+        if update_count is None:
+            self.decoder = new_decoder()
+        else:
+            self.decoder = new_decoder(update_count)
+        self.decoder.load_model(decoderpath)
+
+        # Every result is [label of the session, label of the shadow]
+        self.results = []
+        logger.debug(f'Loaded shadow decoder of "{decoderpath}"')
+
+    def predict(self, d, label):
+        ''' Predict on the same data [d] as the session,
+        the [label] is the label computed by the session.
+        '''
+        try:
+            shadow_label = self.decoder.predict(
+                decoder_input(self.decoder, d, updating=self.update_count is not None))
+        except:
+            err = traceback.format_exc()
+            logger.warning(
+                f'Failed on predict of shadow decoder "{self.decoderpath}": {err}')
+            return
+
+        self.results.append([label, shadow_label])
+        logger.debug('Shadow decoder "%s" computed label of %s, the session computed %s',
+                     self.decoderpath, shadow_label, label)
+
+    def report(self):
+        ''' Report how the shadow decoder agrees with the session '''
+        n = len(self.results)
+        c = len([e for e in self.results if e[0] == e[1]])
+        logger.info(
+            f'Shadow decoder "{self.decoderpath}" agrees with the session on {c} of {n} labels')
+        return c, n
 
 
 class TrainSession(object):
@@ -16,17 +127,21 @@ class TrainSession(object):
     3. Stop to save the data.
     '''
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, send, link=None):
         ''' Initialize the train module,
 
         Args:
         - @filepath: The data will be stored to the filepath;
+        - @send: The sending method;
+        - @link: The heartbeat of the connection, its RTT metrics are reported on stopping.
         '''
         # Necessary parameters
         self.filepath = filepath
+        self.send = send
+        self.link = link
 
         # Start collecting data
-        self.ds = DataStack(filepath)
+        self.ds = DataStack(filepath, name='training')
         self.ds.start()
 
         self.stopped = False
@@ -38,12 +153,11 @@ class TrainSession(object):
         if method == 'stopSession':
             # Stop training session,
             # 1. Stop collecting data;
-            # 2. Generate decoder and save it to the disk;
-            # 3. Save the data to the disk
+            # 2. Save the data to the disk in background
             self.stopped = True
             self.ds.stop()
-            self.ds.save()
-            self.ds.close()
+            save_in_background(self.save, self.send, 'training', self.filepath)
+            report_link(self.link, 'training')
 
             logger.debug(f'Training module stopped')
             return 0, dict(
@@ -58,6 +172,11 @@ class TrainSession(object):
             comment=f'Training module failed to parse {dct}'
         )
 
+    def save(self):
+        # Save the data, it runs on the background writer
+        self.ds.save()
+        self.ds.close()
+
 
 class BuildSession(object):
     ''' The Session of Building BCIDecoder
@@ -81,9 +200,11 @@ class BuildSession(object):
         self.generate_decoder()
 
     def generate_decoder(self):
-        # Generate and save decoder
+        # Generate and save decoder,
+        # the data may still be saved by the background writer, since the controller need not wait for sessionSaved
+        writer.flush()
         data = load(self.filepath)
-        decoder = BCIDecoder()
+        decoder = new_decoder()
         decoderpath = self.decoderpath
 
         # Train decoder
@@ -102,26 +223,31 @@ class ActiveSession(object):
     3. Stop to save the data.
     '''
 
-    def __init__(self, filepath, decoderpath, interval, send):
+    def __init__(self, filepath, decoderpath, interval, send, shadowdecoderpaths=(), link=None):
         ''' Initialize the active module,
 
         Args:
         - @filepath: The path of the file to be stored;
         - @decoderpath: The path of the decoder;
         - @interval: The path of the timely job;
-        - @send: The sending method.
+        - @send: The sending method;
+        - @shadowdecoderpaths: The paths of the shadow decoders, they run side by side for comparison;
+        - @link: The heartbeat of the connection, its RTT metrics are reported on stopping.
         '''
 
         # Necessary parameters
         self.filepath = filepath
         self.interval = interval
+        self.send = send
+        self.link = link
 
         # Start collecting data
-        self.ds = DataStack(filepath)
+        self.ds = DataStack(filepath, name='wubiaoqian')
         self.ds.start()
 
         # Load the decoder
         self.load_decoder(decoderpath)
+        self.shadows = [ShadowDecoder(e) for e in shadowdecoderpaths]
 
         self.timely_job(send)
 
@@ -132,7 +258,7 @@ class ActiveSession(object):
 
     def load_decoder(self, decoderpath):
         # Load decoder
-        self.decoder = BCIDecoder()
+        self.decoder = new_decoder()
         self.decoder.load_model(decoderpath)
         logger.debug(f'Loaded decoder of "{decoderpath}"')
 
@@ -140,27 +266,39 @@ class ActiveSession(object):
         logger.debug(f'Active module timely job starts.')
         while self.state == 'alive':
             time.sleep(self.interval)
-            # Get data
-            d = self.ds.latest()
-            logger.debug(
-                f'Got the latest data from device, shape is {d.shape}')
-
-            if d.shape[1] < 4000:
-                logger.warning(
-                    f'Not enough data for compute label, doing nothing')
-                continue
-
-            # Compute label
-            d[-1] = 0
-            d[-1, -1] = 33
-            d[-1, 0] = 22
-            label = self.decoder.predict(d)
-            logger.debug(f'Computed label of {label}')
-            out = dict(
-                method='labelComputed',
-                label=f'{label}'
-            )
-            send(out)
+            # Get data,
+            # it is copied into the borrowed window, since the triggers are rewritten for the decoder
+            pool = self.ds.window_pool(dtype=window_dtype(self.decoder))
+            with pool.borrow() as window:
+                d = self.ds.latest(out=window)
+                logger.debug('Got the latest data from device, shape is %s',
+                             d.shape)
+
+                if d.shape[1] < 4000:
+                    logger.warning(
+                        f'Not enough data for compute label, doing nothing')
+                    continue
+
+                # Compute label
+                d[-1] = 0
+                d[-1, -1] = 33
+                d[-1, 0] = 22
+                tic = time.perf_counter()
+                label = self.decoder.predict(decoder_input(self.decoder, d))
+                toc = time.perf_counter()
+                telemetry.record(telemetry.PREDICTION,
+                                 tag=int(label),
+                                 b=toc - tic)
+                metrics.observe('predict', toc - tic)
+                logger.debug('Computed label of %s', label)
+                out = dict(
+                    method='labelComputed',
+                    label=f'{label}'
+                )
+                send(out)
+
+                for shadow in self.shadows:
+                    shadow.predict(d, label)
 
         logger.debug(f'Active module timely job stops.')
 
@@ -171,7 +309,9 @@ class ActiveSession(object):
         - @handler: The handler on time.
         '''
         self.state = 'alive'
-        thread = threading.Thread(target=self._keep_active, args=(send,))
+        thread = threading.Thread(target=self._keep_active,
+                                  args=(send,),
+                                  name='Active session')
         thread.setDaemon(True)
         thread.start()
 
@@ -184,12 +324,16 @@ class ActiveSession(object):
         if method == 'stopSession' and name == 'wubiaoqian':
             # Stop active session,
             # 1. Stop collecting data;
-            # 2. Save the data to the disk
+            # 2. Save the data to the disk in background
             self.state = 'stopped'
             self.stopped = True
             self.ds.stop()
-            self.ds.save()
-            self.ds.close()
+            save_in_background(self.save, self.send,
+                               'wubiaoqian', self.filepath)
+            report_link(self.link, 'wubiaoqian')
+
+            for shadow in self.shadows:
+                shadow.report()
 
             logger.debug(f'Active module stopped.')
 
@@ -205,6 +349,11 @@ class ActiveSession(object):
             comment=f'Active module failed to parse {dct}'
         )
 
+    def save(self):
+        # Save the data, it runs on the background writer
+        self.ds.save()
+        self.ds.close()
+
 
 class PassiveSession(object):
     ''' The passive session
@@ -213,7 +362,7 @@ class PassiveSession(object):
     3. Stop to save the data.
     '''
 
-    def __init__(self, filepath, decoderpath, updatedecoderpath, update_count, send):
+    def __init__(self, filepath, decoderpath, updatedecoderpath, update_count, send, shadowdecoderpaths=(), link=None):
         ''' Initialize the passive module,
 
         Args:
@@ -221,33 +370,39 @@ class PassiveSession(object):
         - @decoderpath: The path of the decoder;
         - @updatedecoderpath: The path of the updated decoder;
         - @update_count: How many trials for update the module;
-        - @send: The sending method.
+        - @send: The sending method;
+        - @shadowdecoderpaths: The paths of the shadow decoders, they run side by side for comparison;
+        - @link: The heartbeat of the connection, its RTT metrics are reported on stopping.
         '''
 
         # Necessary parameters
         self.filepath = filepath
         self.updatedecoderpath = updatedecoderpath
+        self.send = send
+        self.link = link
+
+        self.results = []
+
+        # Load the decoder,
+        # it is loaded before collecting, since the predict may be called once collecting starts
+        self.load_decoder(decoderpath, update_count)
+        self.shadows = [ShadowDecoder(e, update_count)
+                        for e in shadowdecoderpaths]
 
         # Start collecting data
         self.ds = DataStack(filepath,
                             autoDetectLabelFlag=True,
-                            predict=self.predict)
+                            predict=self.predict,
+                            name='youbiaoqian')
         self.ds.start()
 
-        # Load the decoder
-        self.load_decoder(decoderpath, update_count)
-
-        self.send = send
-
-        self.results = []
-
         self.stopped = False
         logger.debug(
             f'Passive module starts as {filepath}, {decoderpath}, {update_count}')
 
     def load_decoder(self, decoderpath, update_count):
         # Load decoder
-        self.decoder = BCIDecoder(update_count)
+        self.decoder = new_decoder(update_count)
         self.decoder.load_model(decoderpath)
         logger.debug(f'Loaded decoder of "{decoderpath}"')
 
@@ -259,23 +414,35 @@ class PassiveSession(object):
 
     def predict(self):
         try:
-            d = self.ds.latest()
-            label = self.decoder.predict(d)
-
-            if 11 in d[-1, :]:
-                true_label = 0
-                logger.debug(f'True label: {true_label}')
-
-            if 22 in d[-1, :]:
-                true_label = 1
-                logger.debug(f'True label: {true_label}')
-
-            logger.debug(f'Predicted label: {label}')
-            self.send(dict(
-                method='labelComputed',
-                label=f'{label}'
-            ))
-            self.results.append([true_label, label])
+            pool = self.ds.window_pool(dtype=window_dtype(self.decoder))
+            with pool.borrow() as window:
+                d = self.ds.latest(out=window)
+                tic = time.perf_counter()
+                # The decoder updating itself may keep the trials, it is passed its own copy
+                label = self.decoder.predict(decoder_input(self.decoder, d, updating=True))
+                toc = time.perf_counter()
+                telemetry.record(telemetry.PREDICTION,
+                                 tag=int(label),
+                                 b=toc - tic)
+                metrics.observe('predict', toc - tic)
+
+                if 11 in d[-1, :]:
+                    true_label = 0
+                    logger.debug('True label: %s', true_label)
+
+                if 22 in d[-1, :]:
+                    true_label = 1
+                    logger.debug('True label: %s', true_label)
+
+                logger.debug('Predicted label: %s', label)
+                self.send(dict(
+                    method='labelComputed',
+                    label=f'{label}'
+                ))
+                self.results.append([true_label, label])
+
+                for shadow in self.shadows:
+                    shadow.predict(d, label)
         except:
             err = traceback.format_exc()
             logger.warning(f'Failed on predict: {err}')
@@ -289,12 +456,15 @@ class PassiveSession(object):
         if method == 'stopSession' and name == 'youbiaoqian':
             # Stop passive session,
             # 1. Stop collecting data;
-            # 2. Save the data to the disk
+            # 2. Save the data and the updated decoder to the disk in background
             self.stopped = True
             self.ds.stop()
-            self.ds.save()
-            self.ds.close()
-            self.save_updatedecoder()
+            save_in_background(self.save, self.send,
+                               'youbiaoqian', self.filepath)
+            report_link(self.link, 'youbiaoqian')
+
+            for shadow in self.shadows:
+                shadow.report()
 
             logger.debug(f'Passive module stopped.')
 
@@ -307,7 +477,8 @@ class PassiveSession(object):
                 if t == 0 and p == 0:
                     c += 1
 
-            accuracy = c / n
+            # No label is computed if the session stops before the first trial
+            accuracy = c / n if n > 0 else 0
 
             return 0, dict(
                 method='sessionStopped',
@@ -321,3 +492,9 @@ class PassiveSession(object):
             raw='',
             comment=f'Passive module failed to parse {dct}'
         )
+
+    def save(self):
+        # Save the data and the updated decoder, it runs on the background writer
+        self.ds.save()
+        self.ds.close()
+        self.save_updatedecoder()
@@ -0,0 +1,284 @@
+'''
+File: sharedMemory.py
+Aim: Publish the ring buffer of the acquisition through the shared memory,
+so the acquisition runs as its own process and the decoders in other processes do not compete with it for the GIL.
+
+The layout of the shared memory is:
+- The header, it holds the write index, sample rate and channel map;
+- The data, the float64 matrix of (n_channels x capacity).
+
+- @AcquisitionProcess: Create the shared memory and run the acquisition loop in its own process;
+- @SharedStreamClient: Attach to the shared memory and read the windows zero-copy.
+'''
+
+import sys
+import json
+import time
+import struct
+import threading
+import multiprocessing
+import numpy as np
+
+from multiprocessing import shared_memory, resource_tracker
+
+from . import logger
+from .ringBuffer import RingBuffer
+from .neuroScanToolbox import NeuroScanDeviceClient, channel_names, maxLength
+
+MAGIC = b'BCIRING1'
+VERSION = 1
+
+# magic, version, n_channels, capacity, sample_rate, write index, length of the channel map
+_header_fmt = '<8sIIQdQI'
+_header_size = struct.calcsize(_header_fmt)
+_index_offset = struct.calcsize('<8sIIQd')
+HEADER_SIZE = 4096  # The data starts from here, the channel map is stored in the remains of the header
+
+_attach_lock = threading.Lock()
+
+
+def _attach_shm(name):
+    ''' Attach to the existing shared memory of [name],
+    the attaching process should not unlink it on exit.
+    '''
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    if sys.platform == 'win32':
+        return shared_memory.SharedMemory(name=name)
+
+    # The resource tracker is shared with the creator,
+    # so the attaching is kept away from it
+    with _attach_lock:
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+class SharedRingBuffer(RingBuffer):
+    ''' The ring buffer on the shared memory,
+    the write index is published in the header.
+    '''
+
+    def __init__(self, shm):
+        ''' Initialize the ring buffer on the existing [shm] '''
+        magic, version, n_channels, capacity, sample_rate, _, n_map = struct.unpack_from(
+            _header_fmt, shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f'Not a valid shared ring buffer: "{shm.name}"')
+
+        self.shm = shm
+        self.sample_rate = sample_rate
+        self.channels = json.loads(
+            bytes(shm.buf[_header_size:_header_size+n_map]).decode('utf-8'))
+        self._index = np.ndarray((1,), dtype=np.uint64,
+                                 buffer=shm.buf, offset=_index_offset)
+
+        data = np.ndarray((n_channels, capacity), dtype=np.float64,
+                          buffer=shm.buf, offset=HEADER_SIZE)
+        super(SharedRingBuffer, self).__init__(n_channels, capacity, data)
+
+    @property
+    def length(self):
+        return int(self._index[0])
+
+    def _set_length(self, length):
+        # The data is written before the index is published
+        self._index[0] = length
+
+    def release(self):
+        ''' Release the views on the shared memory, so it can be closed '''
+        self.data = None
+        self._index = None
+
+
+def create_shared_buffer(name, n_channels, capacity, sample_rate, channels):
+    ''' Create the shared memory of [name] and initialize its header
+
+    Outs:
+    - The shared memory object, the creator should unlink it.
+    '''
+    channel_map = json.dumps(channels).encode('utf-8')
+    if _header_size + len(channel_map) > HEADER_SIZE:
+        raise ValueError(f'The channel map is too long')
+
+    size = HEADER_SIZE + n_channels * capacity * 8
+    shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+    struct.pack_into(_header_fmt, shm.buf, 0,
+                     MAGIC, VERSION, n_channels, capacity, sample_rate, 0, len(channel_map))
+    shm.buf[_header_size:_header_size+len(channel_map)] = channel_map
+    logger.info(
+        f'Created shared memory "{name}" of {size} bytes for ({n_channels}, {capacity}) buffer')
+    return shm
+
+
+# ------------------------------------------------------------------------
+# Publishing Side
+
+
+def _publish(name, eeg_IP, eeg_port, freq, n_channels, stop_event):
+    # The acquisition loop running in its own process
+    shm = _attach_shm(name)
+    buffer = SharedRingBuffer(shm)
+    nsclient = NeuroScanDeviceClient(eeg_IP,
+                                     eeg_port,
+                                     freq,
+                                     n_channels,
+                                     buffer=buffer)
+    nsclient.start_send()
+    logger.info(f'Acquisition process publishes on "{name}"')
+
+    stop_event.wait()
+
+    nsclient.stop_send()
+    nsclient.wait_stopped()
+    nsclient.disconnect()
+    buffer.release()
+    shm.close()
+    logger.info(f'Acquisition process stopped publishing on "{name}"')
+
+
+class AcquisitionProcess(object):
+    ''' The acquisition process,
+    it runs the acquisition loop of the NeuroScanDeviceClient in its own process,
+    and publishes the ring buffer through the shared memory.
+
+    Useful methods:
+    - @start: Start the process;
+    - @stop: Stop the process and unlink the shared memory.
+    '''
+
+    def __init__(self, name, eeg_IP, eeg_port, n_channels, freq, maxLength=maxLength):
+        ''' Initialize the process and create the shared memory
+
+        Args:
+        - @name: The name of the shared memory;
+        - @eeg_IP: The IP address of the EEG device;
+        - @eeg_port: The port number of the EEG device;
+        - @n_channels: Number of channels;
+        - @freq: The sampling frequency;
+        - @maxLength: The capacity of the ring buffer, the unit is 'second'.
+        '''
+        self.name = name
+        self.shm = create_shared_buffer(name,
+                                        n_channels,
+                                        maxLength * freq,
+                                        freq,
+                                        channel_names(n_channels))
+        self.stop_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(target=_publish,
+                                               args=(name, eeg_IP, eeg_port, freq, n_channels, self.stop_event),
+                                               name='Acquisition process',
+                                               daemon=True)
+
+    def start(self):
+        ''' Start the process '''
+        self.process.start()
+        logger.info(f'Acquisition process started: {self.process.pid}')
+
+    def stop(self, timeout=5):
+        ''' Stop the process and unlink the shared memory '''
+        self.stop_event.set()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            logger.warning(
+                f'Acquisition process is not stopped in {timeout} seconds, terminating it')
+            self.process.terminate()
+        self.shm.close()
+        self.shm.unlink()
+        logger.info(f'Acquisition process stopped')
+
+
+# ------------------------------------------------------------------------
+# Reading Side
+
+
+class SharedStreamClient(object):
+    ''' The reading side of the shared stream,
+    it has the reading interface of the NeuroScanDeviceClient,
+    the windows are the views of the shared memory unless they wrap around the end of the buffer.
+
+    Useful methods:
+    - @get_range: Get the data of the sample range;
+    - @get_all: Get the data in the buffer;
+    - @start_send: Start watching the 33 label;
+    - @stop_send: Stop watching the 33 label;
+    - @disconnect: Detach from the shared memory.
+    '''
+
+    def __init__(self, name, predict=None, poll_interval=0.02):
+        ''' Initialize by attaching to the shared memory
+
+        Args:
+        - @name: The name of the shared memory;
+        - @predict: Predict function, it will be called on independent thread when 33 label is detected;
+        - @poll_interval: The interval of watching the 33 label, the unit is 'second'.
+        '''
+        self.name = name
+        self.shm = _attach_shm(name)
+        self.buffer = SharedRingBuffer(self.shm)
+        self.sample_rate = self.buffer.sample_rate
+        self.n_channels = self.buffer.n_channels
+        self.channels = self.buffer.channels
+        self.predict = predict
+        self.poll_interval = poll_interval
+        self.watching = False
+        self.watch_thread = None
+        logger.info(
+            f'Attached to shared memory "{name}", the buffer is {self.buffer.data.shape}')
+
+    @property
+    def data_length(self):
+        return self.buffer.length
+
+    def get_all(self):
+        return self.buffer.read(self.buffer.first)
+
+    def get_range(self, start, stop=None, out=None):
+        return self.buffer.read(start, stop, out)
+
+    def start_send(self):
+        ''' Start watching the 33 label in the new data '''
+        self.watching = True
+        self.watch_thread = threading.Thread(target=self._watch,
+                                             name='Shared stream watcher')
+        self.watch_thread.setDaemon(True)
+        self.watch_thread.start()
+
+    def _watch(self):
+        # Built-in method of watching the 33 label in the new data
+        checked = self.data_length
+        while self.watching:
+            time.sleep(self.poll_interval)
+            length = self.data_length
+            if length == checked:
+                continue
+            d = self.buffer.read(checked, length)
+            checked = length
+            if 33 in d[-1, :]:
+                t = threading.Thread(target=self.predict, name='Inference')
+                t.setDaemon(True)
+                t.start()
+
+    def stop_send(self):
+        self.watching = False
+
+    def wait_stopped(self, timeout=1):
+        if self.watch_thread is not None:
+            self.watch_thread.join(timeout)
+            self.watch_thread = None
+
+    def disconnect(self):
+        ''' Detach from the shared memory,
+        it is closed when the views are released.
+        '''
+        self.buffer.release()
+        try:
+            self.shm.close()
+        except BufferError:
+            logger.warning(
+                f'Shared memory "{self.name}" is still viewed, it will be closed on exit')
+        logger.info(f'Detached from shared memory "{self.name}"')
@@ -0,0 +1,298 @@
+'''
+File: telemetry.py
+Aim: The structured binary event log for high-rate telemetry.
+
+Every event is a fixed-width record of 32 bytes,
+the timestamp is the monotonic clock in nanoseconds,
+so it is cheap enough to be left on in production.
+It is off in the processes only importing the package, like the benchmarks and the tools,
+the client entry point turns it on by the [enabled] of the [Telemetry] section.
+
+The layout of the file is:
+- The header, MAGIC, the wall time and the monotonic time when the file is created;
+- The records.
+
+The layout of the record is:
+- t_ns: The monotonic timestamp in nanoseconds;
+- kind: The kind of the event, see KINDS;
+- tag: The tag of the event, like the label or the trigger code;
+- seq: The sequence number of the record;
+- a: The integer value of the event, like the sample index or the number of bytes;
+- b: The float value of the event, like the latency in seconds.
+
+Useful functions:
+- @enable: Turn the telemetry on or off;
+- @record: Record an event, it does nothing if the telemetry is disabled;
+- @flush: Write the pending records to the disk;
+- @read: Read the telemetry file as table;
+- @summary: Summarize the telemetry file for the post-hoc latency analysis.
+
+The reader tool is:
+>> python -m BCIClient.telemetry [telemetry file] [--csv output.csv]
+'''
+
+import os
+import sys
+import time
+import struct
+import atexit
+import itertools
+import threading
+import collections
+import numpy as np
+
+from . import logger, cfg, pwd, timestr
+
+MAGIC = b'BCITLM01'
+
+_header_fmt = '<8sdq'
+_header_size = struct.calcsize(_header_fmt)
+
+_record = struct.Struct('<qHHIqd')
+
+record_dtype = np.dtype([('t_ns', '<i8'),
+                         ('kind', '<u2'),
+                         ('tag', '<u2'),
+                         ('seq', '<u4'),
+                         ('a', '<i8'),
+                         ('b', '<f8')])
+
+# The kinds of the events
+PACKET = 1  # a: the number of the collected samples, b: the time of adding the packet into the buffer in seconds
+TRIGGER = 2  # tag: the trigger code, a: the sample index
+PREDICTION = 3  # tag: the label, b: the time of predicting in seconds
+SEND = 4  # tag: 1 for the urgent message, a: the number of the bytes, b: the enqueue-to-wire latency in seconds
+RECEIVE = 5  # a: the number of the bytes
+ERROR = 6  # a: the count of the errors
+
+KINDS = {
+    PACKET: 'packet',
+    TRIGGER: 'trigger',
+    PREDICTION: 'prediction',
+    SEND: 'send',
+    RECEIVE: 'receive',
+    ERROR: 'error',
+}
+
+# The telemetry of the process, it is turned on by @enable
+enabled = False
+# Whether the client entry point turns it on
+client_enabled = cfg.getboolean('Telemetry', 'enabled')
+flush_interval = float(cfg['Telemetry']['flushInterval'])  # Seconds
+
+
+class Telemetry(object):
+    ''' The telemetry writer,
+    the records are packed on the calling thread,
+    and written to the disk by the flushing thread.
+    The pending records are in the deque, it is appended without the lock and drained by popleft,
+    so no record appended during the flushing is lost.
+    '''
+
+    def __init__(self, filepath, flush_interval=flush_interval):
+        ''' Initialize the telemetry file
+
+        Args:
+        - @filepath: The path of the telemetry file;
+        - @flush_interval: The interval of flushing the records to the disk, the unit is 'second'.
+        '''
+        self.filepath = filepath
+        self.flush_interval = flush_interval
+        self.pending = collections.deque()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+
+        self.file = open(filepath, 'wb')
+        self.file.write(struct.pack(_header_fmt,
+                                    MAGIC,
+                                    time.time(),
+                                    time.monotonic_ns()))
+
+        thread = threading.Thread(target=self._keep_flushing,
+                                  name='Telemetry writer')
+        thread.setDaemon(True)
+        thread.start()
+        logger.info(f'Telemetry is recorded to {filepath}')
+
+    def record(self, kind, tag=0, a=0, b=0.0):
+        ''' Record an event '''
+        self.pending.append(_record.pack(time.monotonic_ns(),
+                                         kind,
+                                         tag & 0xFFFF,
+                                         next(self.seq) & 0xFFFFFFFF,
+                                         a,
+                                         b))
+
+    def flush(self):
+        ''' Write the pending records to the disk '''
+        with self.lock:
+            if self.file is None:
+                return
+            # The records appended meanwhile are left for the next flushing
+            pending = [self.pending.popleft() for _ in range(len(self.pending))]
+            self.file.write(b''.join(pending))
+            self.file.flush()
+
+    def _keep_flushing(self):
+        while self.file is not None:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+_telemetry = None
+_telemetry_lock = threading.Lock()
+
+
+def _get_telemetry():
+    # Built-in method of creating the telemetry file of the process on the first record
+    global _telemetry
+    with _telemetry_lock:
+        if _telemetry is None:
+            filepath = os.path.join(pwd,
+                                    '..',
+                                    'logs',
+                                    'telemetry-{}-{}.bin'.format(timestr(), os.getpid()))
+            _telemetry = Telemetry(filepath)
+            atexit.register(_telemetry.close)
+        return _telemetry
+
+
+def enable(flag=True):
+    ''' Turn the telemetry of the process on or off by the [flag] '''
+    global enabled
+    enabled = flag
+    logger.info(f'Telemetry is {"enabled" if flag else "disabled"}')
+
+
+def record(kind, tag=0, a=0, b=0.0):
+    ''' Record an event, it does nothing if the telemetry is disabled
+
+    Args:
+    - @kind: The kind of the event, see KINDS;
+    - @tag: The tag of the event, 16 bits unsigned integer;
+    - @a: The integer value of the event;
+    - @b: The float value of the event.
+    '''
+    if not enabled:
+        return
+
+    telemetry = _telemetry
+    if telemetry is None:
+        telemetry = _get_telemetry()
+    telemetry.record(kind, tag, a, b)
+
+
+def flush():
+    ''' Write the pending records to the disk
+
+    Outs:
+    - The path of the telemetry file, None refers nothing is recorded.
+    '''
+    telemetry = _telemetry
+    if telemetry is None:
+        return None
+    telemetry.flush()
+    return telemetry.filepath
+
+
+# ------------------------------------------------------------------------
+# Reader Tools
+
+
+def read(filepath):
+    ''' Read the telemetry file as table
+
+    Args:
+    - @filepath: The path of the telemetry file.
+
+    Outs:
+    - The records, the numpy structured array of record_dtype,
+      the 't' field is appended as the seconds since the file is created;
+    - The wall time when the file is created.
+    '''
+    with open(filepath, 'rb') as f:
+        magic, wall_time, t0_ns = struct.unpack(_header_fmt,
+                                                f.read(_header_size))
+        if magic != MAGIC:
+            raise ValueError(f'Not a valid telemetry file: "{filepath}"')
+        raw = f.read()
+
+    n = len(raw) // record_dtype.itemsize
+    records = np.frombuffer(raw[:n * record_dtype.itemsize],
+                            dtype=record_dtype)
+
+    table = np.empty(n, dtype=record_dtype.descr + [('t', '<f8')])
+    for name in record_dtype.names:
+        table[name] = records[name]
+    table['t'] = (records['t_ns'] - t0_ns) / 1e9
+    return table, wall_time
+
+
+def _describe(values):
+    # Built-in method of describing the [values] in percentiles
+    if len(values) == 0:
+        return 'n=0'
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return f'n={len(values)}, p50={p50:.6f}, p90={p90:.6f}, p99={p99:.6f}, max={np.max(values):.6f}'
+
+
+def summary(table):
+    ''' Summarize the telemetry [table] for the post-hoc latency analysis
+
+    Outs:
+    - The lines of the summary.
+    '''
+    lines = []
+    for kind, name in KINDS.items():
+        lines.append(f'{name}: {np.count_nonzero(table["kind"] == kind)}')
+
+    packets = table[table['kind'] == PACKET]
+    lines.append('packet interval (s): ' + _describe(np.diff(packets['t'])))
+    lines.append('packet handling (s): ' + _describe(packets['b']))
+
+    predictions = table[table['kind'] == PREDICTION]
+    lines.append('prediction (s): ' + _describe(predictions['b']))
+
+    # The latency from the 33 trigger to the computed label
+    triggers = table[(table['kind'] == TRIGGER) & (table['tag'] == 33)]
+    latency = []
+    for t in triggers['t']:
+        after = predictions['t'][predictions['t'] >= t]
+        if len(after) > 0:
+            latency.append(after[0] - t)
+    lines.append('trigger to prediction (s): ' +
+                 _describe(np.array(latency)))
+
+    # The enqueue-to-wire latency of the sent messages
+    sends = table[table['kind'] == SEND]
+    lines.append('send urgent (s): ' + _describe(sends['b'][sends['tag'] == 1]))
+    lines.append('send coalesced (s): ' + _describe(sends['b'][sends['tag'] == 0]))
+    return lines
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    table, wall_time = read(sys.argv[1])
+    print(f'Created at {time.ctime(wall_time)}, {len(table)} records')
+    for line in summary(table):
+        print(line)
+
+    if '--csv' in sys.argv:
+        path = sys.argv[sys.argv.index('--csv') + 1]
+        names = ['t', 'kind', 'tag', 'seq', 'a', 'b']
+        with open(path, 'w') as f:
+            f.write(','.join(names) + '\n')
+            for e in table:
+                f.write(','.join([KINDS.get(int(e['kind']), str(e['kind'])) if n == 'kind' else str(e[n])
+                                  for n in names]) + '\n')
+        print(f'Saved the table to {path}')
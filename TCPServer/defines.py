@@ -9,58 +9,38 @@ TCPServer will serve forever and it handles several TCP sessions.
 
 # Imports
 import os
-import json
-import socket
+import queue
 import threading
 import traceback
 
 from .modules import TrainModule, ActiveModule, PassiveModule
 from . import logger, cfg
+from protocol import encode, dumps, pack, unpack, Splitter, SCHEMAS, KEEP_ALIVE_REPLY, keepAliveReply
+from protocol.dispatcher import Dispatcher
+from protocol.transport import EventLoopServer
 
 # Read configures
 IP = cfg['Server']['localIP']
 port = int(cfg['Server']['localPort'])
 buffer_size = int(cfg['Server']['bufferSize'])
-coding = cfg['Server']['coding']
 interval = 2
 
-# Tools
-# The TCP message is binary, so decoding and encoding is necessary.
-
-
-def decode(content, coding=coding):
-    ''' Decode [content] if necessary '''
-    if isinstance(content, type(b'')):
-        return content.decode(coding)
-    else:
-        return content
-
-
-def encode(content, coding=coding):
-    ''' Encode [content] if necessary '''
-    if isinstance(content, type('')):
-        return content.encode(coding)
-    else:
-        return content
-
-
-def unpack(pack):
-    try:
-        return json.loads(pack)
-    except:
-        return None
-
+# The write buffer of every session,
+# the policy decides what to do with the slow clients, see protocol.transport.POLICIES
+max_buffer = cfg.getint('Broadcast', 'maxBufferSize', fallback=1024 * 1024)
+slow_client_policy = cfg.get('Broadcast', 'slowClientPolicy', fallback='drop')
 
-def pack(dct):
-    for key in dct:
-        dct[key] = decode(dct[key])
-    return json.dumps(dct)
+# Tools
+# The codec is shared with the client in the protocol package.
 
 # Keep Alive Message
 
 
-def keepAliveMessage():
-    return pack(dict(method='keepAlive', count='1'))
+def keepAliveMessage(dct=None):
+    ''' Make the reply of the keepAlive message [dct], the seq and timestamp are echoed '''
+    if dct is None:
+        return KEEP_ALIVE_REPLY
+    return keepAliveReply(dct)
 
 # Error Messages
 
@@ -86,21 +66,20 @@ def operationFailedError(raw, detail='', comment=''):
 
 class TCPServer(object):
     ''' TCP server serves forever,
-    it handles several sessions.
+    it handles several sessions in one event loop.
     '''
 
     def __init__(self):
         ''' Init by empty sessions pool '''
         self.server = None
-        self.sessions = []
+        # The sessions, the key is the file number of the connection
+        self.sessions = dict()
 
     def alive_sessions(self):
-        ''' Remove disconnected sessions and return the remains '''
-        n = len(self.sessions)
-        self.sessions = [e for e in self.sessions if e.is_connected]
-        logger.debug('There are {} alive sessions, squeezed from {}'.format(
-            len(self.sessions), n))
-        return self.sessions
+        ''' Return the alive sessions,
+        the closed sessions have been removed on closing.
+        '''
+        return list(self.sessions.values())
 
     def start(self):
         ''' Run the pipeline to start serving '''
@@ -114,233 +93,333 @@ class TCPServer(object):
         - @port: The port number, make sure it is large.
         '''
         assert(self.server is None)
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind((IP, port))
+        server = EventLoopServer(on_connect=self.new_session,
+                                 on_receive=self.receive,
+                                 on_close=self.remove_session,
+                                 buffer_size=buffer_size,
+                                 max_buffer=max_buffer,
+                                 policy=slow_client_policy)
+        server.bind(IP, port)
         self.server = server
         logger.info(f'TCP server binds on {IP}:{port}')
 
     def serve(self):
         ''' Start serving.
         - Listen forever;
-        - Generate separated thread to serve incoming sessions;
-        - self.new_session function is used for handling.
+        - Generate separated thread to run the event loop of all the sessions.
         '''
-        # Listen
-        self.server.listen(1)
-        logger.info(f'TCP server is listening')
-
-        # Generate thread
-        thread = threading.Thread(target=self.new_session,
-                                  name='TCP session interface')
-        thread.setDaemon(True)
-        thread.start()
+        self.server.start()
         logger.info(f'TCP server is ready for new session')
 
-    def new_session(self):
+    def broadcast(self, message):
+        ''' Broadcast the [message] to all the sessions,
+        the message is serialized once and queued to every session without blocking.
+
+        Outs:
+        - The number of the sessions accepted the message;
+        - The number of the sessions refused the message by the slow client policy.
+        '''
+        if isinstance(message, dict):
+            msg = dumps(message)
+        else:
+            msg = encode(message)
+
+        accepted, refused = self.server.broadcast(msg)
+        if refused > 0:
+            logger.warning(
+                f'Broadcast is refused by {refused} slow sessions, the policy is "{slow_client_policy}"')
+        logger.debug(f'Broadcast "{message}" to {accepted} sessions')
+        return accepted, refused
+
+    def new_session(self, connection):
         ''' The function to handle new session.
-        - Get client and address;
-        - Generate TCP session with them;
-        - Append into the sessions pool.
+        - Generate TCP session with the connection;
+        - Resume the sessions of the client, the messages buffered while it was disconnected are replayed;
+        - Add into the sessions pool.
         '''
-        while True:
-            client, address = self.server.accept()
-            session = TCPSession(client=client, address=address)
-            session.send('Hello from server')
-            logger.info(f'New session established: {client} at {address}')
-            self.sessions.append(session)
-            self.alive_sessions()
+        session = TCPSession(connection)
+        session.send('Hello from server')
+        session.send(dict(method='resumeSession'))
+        logger.info(f'New session established at {connection.address}')
+        self.sessions[connection.fileno] = session
+
+    def receive(self, connection, income):
+        ''' The function to handle the incoming message of the connection '''
+        self.sessions[connection.fileno].handle(income)
+
+    def remove_session(self, connection):
+        ''' The function to remove the closed session '''
+        session = self.sessions.pop(connection.fileno, None)
+        if session is not None:
+            session.close()
+        logger.debug(f'There are {len(self.sessions)} alive sessions')
 
 
 # TCPSession
 class TCPSession(object):
-    ''' Session object used by TCP server '''
+    ''' Session object used by TCP server.
+
+    The session has its own worker thread for the module,
+    starting, feeding and stopping the module are slow, like connecting the device and saving the data,
+    they run on the worker one by one in the order of the messages,
+    so the event loop keeps serving the other sessions and the keepAlive messages meanwhile.
+    '''
 
-    def __init__(self, client, address):
+    def __init__(self, connection):
         ''' Init the session
         - Setup the session;
+        - Start the worker of the module;
         - Mark it with is_connected = True.
         Args:
-        - @client: The client object;
-        - @address: The address of the client.
+        - @connection: The connection of the client.
         '''
-        self.client = client
-        self.address = address
-        self.start()
+        self.connection = connection
+        self.address = connection.address
         self.is_connected = True
         self.module = None
+        self.metrics = None
+        self.dispatcher = self._register_handlers()
+        self.module_dispatcher = self._register_module_handlers()
+        # The incoming messages are reassembled from the stream of the connection
+        self.splitter = Splitter()
+
+        # The jobs of the worker, None stops the worker
+        self.jobs = queue.Queue()
+        self.worker = threading.Thread(target=self._work,
+                                       name=f'Session worker of {self.address}')
+        self.worker.setDaemon(True)
+        self.worker.start()
         logger.info(f'Client connected: {self.address}')
 
-    def start(self):
-        ''' Take new thread to handle the client's message.
-        - self.handle is used to handle messages.
+    def close(self):
+        ''' Close the session,
+        the module is stopped on the worker, and the worker exits after it.
         '''
-        thread = threading.Thread(
-            target=self.handle, name='TCP session handler')
-        thread.setDaemon(True)
-        thread.start()
+        if not self.is_connected:
+            return
 
-    def close(self):
-        ''' Close the session '''
-        self.client.close()
+        self.connection.close()
         self.is_connected = False
 
-        if self.module is not None:
-            self.module.ds.stop()
+        self.jobs.put((self._stop_module, None, None))
+        self.jobs.put(None)
 
         logger.info(f'Client closed: {self.address}')
 
-    def handle(self):
-        ''' It will serve the client's messaging until being forcedly closed.
-        - Received the message;
-        - Send reply;
-        - It will be closed if it receives empty message or error occurs.
-        '''
+    def _work(self):
+        # Built-in method of running the jobs of the module one by one
         while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            func, dct, income = job
             try:
-                # ----------------------------------------------------------------
-                # Receive new incoming message
-                income = self.client.recv(buffer_size)
-                logger.debug(f'Received {income} from {self.address}')
-                self.send(f'Message is received: {income}')
+                func(dct, income)
+            except Exception as err:
+                logger.error(f'Unexpected error: {err}')
+                traceback.print_exc()
+                self.close()
+        logger.debug(f'Session worker of {self.address} exits')
 
-                # ----------------------------------------------------------------
-                # Terminating commands
-                if income == b'':
-                    self.close()
-                    break
+    def _submit(self, dct, income):
+        # Built-in method of passing the message to the worker,
+        # it is routed there by the module dispatcher, since the module is only changed on the worker
+        self.jobs.put((self.module_dispatcher.dispatch, dct, income))
 
-                if income == b'Terminate':
-                    self.close()
-                    break
+    def _stop_module(self, dct, income):
+        # Built-in method of stopping the module of the closed session
+        if self.module is not None:
+            self.module.ds.stop()
 
-                # ----------------------------------------------------------------
-                # Unpack incoming message.
-                # It should be json object and parsed into a dict.
-                dct = unpack(income)
-                # If unpack fails,
-                # send invalid message error.
-                if dct is None:
-                    self.send(invalidMessageError(income,
-                                                  comment=f'Illegal JSON from {self.address}'))
-                    continue
+    def handle(self, income):
+        ''' Handle the incoming message, it is called by the event loop.
+        - Send reply, the messages of the module are replied by the worker;
+        - It will be closed if it receives terminating message or error occurs.
+        '''
+        try:
+            # ----------------------------------------------------------------
+            # Receive new incoming message
+            # It is not echoed to the client, the echoed text would be mixed into the message stream
+            logger.debug(f'Received {income} from {self.address}')
+
+            # ----------------------------------------------------------------
+            # Terminating commands
+            if income == b'Terminate':
+                self.close()
+                return
+
+            # ----------------------------------------------------------------
+            # Unpack incoming message.
+            # It should be json objects and parsed into dicts,
+            # several messages may arrive together, and a message may arrive in pieces.
+            dcts, errors = self.splitter.feed(income)
+            # If unpack fails,
+            # send invalid message error.
+            for raw in errors:
+                self.send(invalidMessageError(raw,
+                                              comment=f'Illegal JSON from {self.address}'))
+
+            for dct in dcts:
                 logger.debug(f'Parsed message {dct} from {self.address}')
 
                 # ----------------------------------------------------------------
-                # Keep alive message
-                if all([dct.get('method', None) == 'keepAlive',
-                        dct.get('count', None) == '0']):
-                    logger.debug(f'Received keepAlive message')
-                    self.send(keepAliveMessage())
-                    continue
-
-                # ----------------------------------------------------------------
-                # Start training module
-                if all([dct.get('method', None) == 'startSession',
-                        dct.get('sessionName', None) == 'training',
-                        self.module == None]):
-                    logger.info(f'Training module is starting')
-                    try:
-                        self.module = TrainModule(filepath=dct['dataPath'],
-                                                  decoderpath=dct['modelPath'])
-                    except:
-                        self.send(operationFailedError(income,
-                                                       detail=f'undefinedError',
-                                                       comment=f'Can not start training module for {self.address}'))
-                    if self.module is not None:
-                        logger.info(f'Training module started')
-                    continue
-
-                # ----------------------------------------------------------------
-                # Start active module
-                if all([dct.get('method', None) == 'startSession',
-                        dct.get('sessionName', None) == 'synchronous',
-                        self.module == None]):
-                    logger.info(f'Active module is starting')
-
-                    if not os.path.isfile(dct['modelPath']):
-                        self.send(operationFailedError(income,
-                                                       detail=f'fileInvalid',
-                                                       comment=f'Can not start active module for {self.address}, decoder path is invalid'))
-                        continue
-
-                    try:
-                        self.module = ActiveModule(filepath=dct['dataPath'],
-                                                   decoderpath=dct['modelPath'],
-                                                   interval=interval,
-                                                   send=self.send)
-                    except:
-                        self.send(operationFailedError(income,
-                                                       detail=f'undefinedError',
-                                                       comment=f'Can not start active module for {self.address}'))
-
-                    if self.module is not None:
-                        logger.info(
-                            f'Active module started, the labels will be sent every {interval} seconds.')
-                        continue
-
-                # ----------------------------------------------------------------
-                # Start passive module
-                if all([dct.get('method', None) == 'startSession',
-                        dct.get('sessionName', None) == 'asynchronous',
-                        self.module == None]):
-                    logger.info(f'Passive module is starting')
-
-                    if not os.path.isfile(dct['modelPath']):
-                        self.send(operationFailedError(income,
-                                                       detail=f'fileInvalid',
-                                                       comment=f'Can not start passive module for {self.address}, decoder path is invalid'))
-                        continue
-
-                    try:
-                        self.module = PassiveModule(filepath=dct['dataPath'],
-                                                    decoderpath=dct['modelPath'])
-                    except:
-                        self.send(operationFailedError(income,
-                                                       detail=f'undefinedError',
-                                                       comment=f'Can not start active module for {self.address}'))
-
-                    if self.module is not None:
-                        logger.info(
-                            f'Passive module started for {self.address}, the labels will be sent at every requests.')
-                        continue
-
-                # ----------------------------------------------------------------
-                # Feed
-                if self.module is not None:
-                    success, rdct = self.module.receive(dct)
-
-                    logger.debug(
-                        f'Module receives {dct}, operation returns {success}:{rdct}')
+                # Route the message by the dispatch table
+                self.dispatcher.dispatch(dct, income)
+
+        except Exception as err:
+            logger.error(f'Unexpected error: {err}')
+            traceback.print_exc()
+            self.close()
+
+    def _register_handlers(self):
+        # Built-in method of building the dispatch table of the event loop,
+        # the quick messages are handled at once,
+        # the others are passed to the worker
+        dispatcher = Dispatcher(default=self._submit)
+
+        dispatcher.register('keepAlive', self._on_keepAlive,
+                            fields=SCHEMAS['keepAliveRequest'])
+        # The error messages are never answered by the errors, or the two sides reply each other endlessly
+        dispatcher.register('error', self._on_error)
+        dispatcher.register('metricsReported', self._on_metrics)
+        dispatcher.register('sessionResumed', self._on_resumed)
+
+        return dispatcher
+
+    def _register_module_handlers(self):
+        # Built-in method of building the dispatch table of the worker,
+        # the unrouted messages are fed into the running module
+        dispatcher = Dispatcher(default=self._feed)
+
+        def idle(dct):
+            return self.module is None
+
+        required = dict(dataPath=None, modelPath=None)
+        dispatcher.register('startSession', self._start_training,
+                            sessionName='training',
+                            fields=required,
+                            when=idle)
+        dispatcher.register('startSession', self._start_active,
+                            sessionName='synchronous',
+                            fields=required,
+                            when=idle)
+        dispatcher.register('startSession', self._start_passive,
+                            sessionName='asynchronous',
+                            fields=required,
+                            when=idle)
+
+        return dispatcher
+
+    # ----------------------------------------------------------------
+    # Keep alive message
+    def _on_keepAlive(self, dct, income):
+        logger.debug(f'Received keepAlive message')
+        self.send(keepAliveMessage(dct))
+
+    # ----------------------------------------------------------------
+    # Error message
+    def _on_error(self, dct, income):
+        logger.warning(f'Received error from {self.address}: {dct}')
+
+    # ----------------------------------------------------------------
+    # Metrics report, the latest one is kept
+    def _on_metrics(self, dct, income):
+        self.metrics = dct
+        logger.info(f'Received {len(dct) - 1} metrics from {self.address}')
+
+    # ----------------------------------------------------------------
+    # Resumed sessions of the client, the replayed messages follow it
+    def _on_resumed(self, dct, income):
+        logger.info(
+            f'Resumed sessions "{dct.get("runningSessions", "")}" of {self.address}, {dct.get("replayed", 0)} messages are replayed')
+
+    # ----------------------------------------------------------------
+    # Start training module
+    def _start_training(self, dct, income):
+        logger.info(f'Training module is starting')
+        try:
+            self.module = TrainModule(filepath=dct['dataPath'],
+                                      decoderpath=dct['modelPath'])
+        except:
+            self.send(operationFailedError(income,
+                                           detail=f'undefinedError',
+                                           comment=f'Can not start training module for {self.address}'))
+        if self.module is not None:
+            logger.info(f'Training module started')
+
+    # ----------------------------------------------------------------
+    # Start active module
+    def _start_active(self, dct, income):
+        logger.info(f'Active module is starting')
+
+        if not os.path.isfile(dct['modelPath']):
+            self.send(operationFailedError(income,
+                                           detail=f'fileInvalid',
+                                           comment=f'Can not start active module for {self.address}, decoder path is invalid'))
+            return
+
+        try:
+            self.module = ActiveModule(filepath=dct['dataPath'],
+                                       decoderpath=dct['modelPath'],
+                                       interval=interval,
+                                       send=self.send)
+        except:
+            self.send(operationFailedError(income,
+                                           detail=f'undefinedError',
+                                           comment=f'Can not start active module for {self.address}'))
 
-                    if success == 0:
-                        self.send(rdct)
-                    else:
-                        self.send(invalidMessageError(income,
-                                                      comment=rdct['comment']))
+        if self.module is not None:
+            logger.info(
+                f'Active module started, the labels will be sent every {interval} seconds.')
+
+    # ----------------------------------------------------------------
+    # Start passive module
+    def _start_passive(self, dct, income):
+        logger.info(f'Passive module is starting')
+
+        if not os.path.isfile(dct['modelPath']):
+            self.send(operationFailedError(income,
+                                           detail=f'fileInvalid',
+                                           comment=f'Can not start passive module for {self.address}, decoder path is invalid'))
+            return
+
+        try:
+            self.module = PassiveModule(filepath=dct['dataPath'],
+                                        decoderpath=dct['modelPath'])
+        except:
+            self.send(operationFailedError(income,
+                                           detail=f'undefinedError',
+                                           comment=f'Can not start active module for {self.address}'))
 
-                    # Remove existing module if it has stopped
-                    if self.module.stopped:
-                        self.module = None
-                        logger.info(
-                            f'Current module stopped for {self.address}.')
+        if self.module is not None:
+            logger.info(
+                f'Passive module started for {self.address}, the labels will be sent at every requests.')
 
-                    continue
+    # ----------------------------------------------------------------
+    # Feed
+    def _feed(self, dct, income):
+        if self.module is None:
+            # No operation is done
+            self.send(invalidMessageError(income,
+                                          comment=f'Invalid operation from {self.address}'))
+            return
 
-                # ----------------------------------------------------------------
-                # No operation is done
-                self.send(invalidMessageError(income,
-                                              comment=f'Invalid operation from {self.address}'))
+        success, rdct = self.module.receive(dct)
 
-            except ConnectionResetError as err:
-                logger.warning(f'Connection reset occurs. It can be normal.')
-                break
+        logger.debug(
+            f'Module receives {dct}, operation returns {success}:{rdct}')
 
-            except Exception as err:
-                logger.error(f'Unexpected error: {err}')
-                traceback.print_exc()
-                break
+        if success == 0:
+            self.send(rdct)
+        else:
+            self.send(invalidMessageError(income,
+                                          comment=rdct['comment']))
 
-        self.close()
+        # Remove existing module if it has stopped
+        if self.module.stopped:
+            self.module = None
+            logger.info(
+                f'Current module stopped for {self.address}.')
 
     def send(self, message):
         ''' Send message to the client.
@@ -349,9 +428,9 @@ class TCPSession(object):
         - @message: The message to be sent.
         '''
         if isinstance(message, dict):
-            msg = encode(pack(message))
+            msg = dumps(message)
         else:
             msg = encode(message)
 
-        self.client.sendall(msg)
+        self.connection.send(msg)
         logger.debug(f'Sent "{message}" to {self.address}')
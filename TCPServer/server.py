@@ -19,7 +19,7 @@ def interface():
         h="Show help message",
         q="Quit",
         list="List the alive sessions",
-        send="Send message through all alive sessions, send [message]"
+        send="Broadcast message to all alive sessions, send [message]"
     )
 
     while True:
@@ -40,8 +40,8 @@ def interface():
 
         if inp.startswith('send '):
             message = inp.split(' ', 1)[1]
-            for session in server.alive_sessions():
-                session.send(message)
+            accepted, refused = server.broadcast(message)
+            print(f'Sent to {accepted} sessions, refused by {refused} slow sessions')
             continue
 
     print('ByeBye')
@@ -6,10 +6,14 @@ Define the example TCP client object.
 
 # Imports
 import os
+import sys
 import socket
 import threading
 import configparser
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))  # noqa
+from protocol import encode  # noqa
+
 # Read configures
 cfg = configparser.ConfigParser()
 cfg.read(os.path.join(os.path.dirname(__file__),
@@ -24,23 +28,7 @@ buffer_size = int(cfg['Server']['bufferSize'])
 coding = cfg['Server']['coding']
 
 # Tools
-# The TCP message is binary, so decoding and encoding is necessary.
-
-
-def decode(content, coding=coding):
-    ''' Decode [content] if necessary '''
-    if isinstance(content, type(b'')):
-        return content.decode(coding)
-    else:
-        return content
-
-
-def encode(content, coding=coding):
-    ''' Encode [content] if necessary '''
-    if isinstance(content, type('')):
-        return content.encode(coding)
-    else:
-        return content
+# The codec is shared with the BCI client in the protocol package.
 
 # TCPClient
 
@@ -1,66 +1,61 @@
 ''' TCP Server for BCI Simulation '''
 
-import json
-import socket
-import threading
+import os
+import sys
 import traceback
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))  # noqa
+from protocol import encode, dumps, pack, unpack, Splitter, classify, KEEP_ALIVE_REPLY, keepAliveReply  # noqa
+from protocol.transport import EventLoopServer  # noqa
+
 IP = 'localhost'
 port = 63365
 buffer_size = 1024
 coding = 'utf-8'
 
+# The write buffer of every session,
+# the policy decides what to do with the slow clients, see protocol.transport.POLICIES
+max_buffer = 1024 * 1024
+slow_client_policy = 'drop'
 
-def decode(content, coding=coding):
-    ''' Decode [content] if necessary '''
-    if isinstance(content, type(b'')):
-        return content.decode(coding)
-    else:
-        return content
-
-
-def encode(content, coding=coding):
-    ''' Encode [content] if necessary '''
-    if isinstance(content, type('')):
-        return content.encode(coding)
-    else:
-        return content
-
+# Print the messages, it is turned off by the benchmark
+verbose = True
 
-def unpack(pack):
-    try:
-        return json.loads(pack)
-    except:
-        return None
 
+def log(message):
+    if verbose:
+        print(message)
 
-def pack(dct):
-    for key in dct:
-        dct[key] = decode(dct[key])
-    return json.dumps(dct)
 
-
-def keepAliveMessage():
-    return pack(dict(method='keepAlive', count='1'))
+def keepAliveMessage(dct=None):
+    ''' Make the reply of the keepAlive message [dct], the seq and timestamp are echoed '''
+    if dct is None:
+        return KEEP_ALIVE_REPLY
+    return keepAliveReply(dct)
 
 
 class TCPServer(object):
     ''' TCP server serves forever,
-    it handles several sessions.
+    it handles several sessions in one event loop.
     '''
 
-    def __init__(self):
-        ''' Init by empty sessions pool '''
+    def __init__(self, on_message=None):
+        ''' Init by empty sessions pool
+
+        Args:
+        - @on_message: The callback of the parsed messages except the keepAlive requests,
+          it is called as on_message(session, dct) on the event loop, like the benchmark collecting the labels.
+        '''
         self.server = None
-        self.sessions = []
+        self.on_message = on_message
+        # The sessions, the key is the file number of the connection
+        self.sessions = dict()
 
     def alive_sessions(self):
-        ''' Remove disconnected sessions and return the remains '''
-        n = len(self.sessions)
-        self.sessions = [e for e in self.sessions if e.is_connected]
-        print('There are {} alive sessions, squeezed from {}'.format(
-            len(self.sessions), n))
-        return self.sessions
+        ''' Return the alive sessions,
+        the closed sessions have been removed on closing.
+        '''
+        return list(self.sessions.values())
 
     def start(self):
         ''' Run the pipeline to start serving '''
@@ -71,127 +66,134 @@ class TCPServer(object):
         ''' Bind the server to IP and port.
         Args:
         - @IP: The host IP;
-        - @port: The port number, make sure it is large.
+        - @port: The port number, make sure it is large, 0 refers any free port.
         '''
         assert(self.server is None)
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.bind((IP, port))
+        server = EventLoopServer(on_connect=self.new_session,
+                                 on_receive=self.receive,
+                                 on_close=self.remove_session,
+                                 buffer_size=buffer_size,
+                                 max_buffer=max_buffer,
+                                 policy=slow_client_policy)
+        server.bind(IP, port)
         self.server = server
-        print(f'TCP server binds on {IP}:{port}')
+        log(f'TCP server binds on {server.address}')
 
     def serve(self):
         ''' Start serving.
         - Listen forever;
-        - Generate separated thread to serve incoming sessions;
-        - self.new_session function is used for handling.
+        - Generate separated thread to run the event loop of all the sessions.
         '''
-        # Listen
-        self.server.listen(1)
-        print(f'TCP server is listening')
-
-        # Generate thread
-        thread = threading.Thread(target=self.new_session,
-                                  name='TCP session interface')
-        thread.setDaemon(True)
-        thread.start()
-        print(f'TCP server is ready for new session')
-
-    def new_session(self):
+        self.server.start()
+        log(f'TCP server is ready for new session')
+
+    def stop(self):
+        ''' Stop serving and close all the sessions '''
+        self.server.stop()
+
+    def broadcast(self, message):
+        ''' Broadcast the [message] to all the sessions,
+        the message is serialized once and queued to every session without blocking.
+
+        Outs:
+        - The number of the sessions accepted the message;
+        - The number of the sessions refused the message by the slow client policy.
+        '''
+        if isinstance(message, dict):
+            msg = dumps(message)
+        else:
+            msg = encode(message)
+
+        accepted, refused = self.server.broadcast(msg)
+        log(f'Broadcast "{message}" to {accepted} sessions, refused by {refused} slow sessions')
+        return accepted, refused
+
+    def new_session(self, connection):
         ''' The function to handle new session.
-        - Get client and address;
-        - Generate TCP session with them;
-        - Append into the sessions pool.
+        - Generate TCP session with the connection;
+        - Resume the sessions of the client, the messages buffered while it was disconnected are replayed;
+        - Add into the sessions pool.
         '''
-        while True:
-            client, address = self.server.accept()
-            session = TCPSession(client=client, address=address)
-            session.send('Hello from server')
-            print(f'New session established: {client} at {address}')
-            self.sessions.append(session)
-            self.alive_sessions()
+        session = TCPSession(connection, on_message=self.on_message)
+        session.send('Hello from server')
+        session.send(dict(method='resumeSession'))
+        log(f'New session established at {connection.address}')
+        self.sessions[connection.fileno] = session
+
+    def receive(self, connection, income):
+        ''' The function to handle the incoming message of the connection '''
+        self.sessions[connection.fileno].handle(income)
+
+    def remove_session(self, connection):
+        ''' The function to remove the closed session '''
+        session = self.sessions.pop(connection.fileno, None)
+        if session is not None:
+            session.close()
+        log(f'There are {len(self.sessions)} alive sessions')
 
 
 # TCPSession
 class TCPSession(object):
     ''' Session object used by TCP server '''
 
-    def __init__(self, client, address):
+    def __init__(self, connection, on_message=None):
         ''' Init the session
         - Setup the session;
         - Mark it with is_connected = True.
         Args:
-        - @client: The client object;
-        - @address: The address of the client.
+        - @connection: The connection of the client;
+        - @on_message: The callback of the parsed messages.
         '''
-        self.client = client
-        self.address = address
-        self.start()
+        self.connection = connection
+        self.on_message = on_message
+        self.address = connection.address
         self.is_connected = True
-        print(f'Client connected: {self.address}')
-
-    def start(self):
-        ''' Take new thread to handle the client's message.
-        - self.handle is used to handle messages.
-        '''
-        thread = threading.Thread(
-            target=self.handle, name='TCP session handler')
-        thread.setDaemon(True)
-        thread.start()
+        # The incoming messages are reassembled from the stream of the connection
+        self.splitter = Splitter()
+        log(f'Client connected: {self.address}')
 
     def close(self):
         ''' Close the session '''
-        self.client.close()
+        if not self.is_connected:
+            return
+
+        self.connection.close()
         self.is_connected = False
 
-        print(f'Client closed: {self.address}')
+        log(f'Client closed: {self.address}')
 
-    def handle(self):
-        ''' It will serve the client's messaging until being forcedly closed.
-        - Received the message;
-        - Send reply;
-        - It will be closed if it receives empty message or error occurs.
-        '''
-        while True:
-            try:
-                # ----------------------------------------------------------------
-                # Receive new incoming message
-                income = self.client.recv(buffer_size)
-                print(f'Received {income} from {self.address}')
+    def handle(self, income):
+        ''' Handle the incoming message, it is called by the event loop. '''
+        try:
+            # ----------------------------------------------------------------
+            # Receive new incoming message
+            log(f'Received {income} from {self.address}')
 
-                # ----------------------------------------------------------------
-                # Terminating commands
-                if income == b'':
-                    self.close()
-                    break
+            # ----------------------------------------------------------------
+            # Unpack incoming message.
+            # It should be json objects and parsed into dicts,
+            # several messages may arrive together, and a message may arrive in pieces.
+            dcts, errors = self.splitter.feed(income)
+            for raw in errors:
+                log(f'Failed to unpack message: "{raw}"')
 
-                # ----------------------------------------------------------------
-                # Unpack incoming message.
-                # It should be json object and parsed into a dict.
-                try:
-                    dct = unpack(income)
-                except:
-                    print(f'Failed to unpack message: "{income}"')
-                    continue
-                print(f'Parsed message {dct} from {self.address}')
+            for dct in dcts:
+                log(f'Parsed message {dct} from {self.address}')
 
                 # ----------------------------------------------------------------
                 # Keep alive message
-                if all([dct.get('method', None) == 'keepAlive',
-                        dct.get('count', None) == '0']):
-                    print(f'Received keepAlive message')
-                    self.send(keepAliveMessage())
+                if classify(dct) == 'keepAliveRequest':
+                    log(f'Received keepAlive message')
+                    self.send(keepAliveMessage(dct))
                     continue
 
-            except ConnectionResetError as err:
-                print(f'Connection reset occurs. It can be normal.')
-                break
-
-            except Exception as err:
-                print(f'Unexpected error: {err}')
-                traceback.print_exc()
-                break
+                if self.on_message is not None:
+                    self.on_message(self, dct)
 
-        self.close()
+        except Exception as err:
+            print(f'Unexpected error: {err}')
+            traceback.print_exc()
+            self.close()
 
     def send(self, message):
         ''' Send message to the client.
@@ -200,9 +202,9 @@ class TCPSession(object):
         - @message: The message to be sent.
         '''
         if isinstance(message, dict):
-            msg = encode(pack(message))
+            msg = dumps(message)
         else:
             msg = encode(message)
 
-        self.client.sendall(msg)
-        print(f'Sent "{message}" to {self.address}')
+        self.connection.send(msg)
+        log(f'Sent "{message}" to {self.address}')
@@ -5,9 +5,13 @@ Aim: Start new TCP client and make interface for it in the console.
 - @interface: The function for starting client and user interface.
 '''
 
-import json
+import os
+import sys
 from TCPClient import TCPClient
 
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))  # noqa
+from protocol import pack  # noqa
+
 if __name__ == '__main__':
     client = TCPClient()
     client.connect()
@@ -41,7 +45,7 @@ if __name__ == '__main__':
                 method="message",
                 content=message
             )
-            client.send(json.dumps(dct))
+            client.send(pack(dct))
             continue
 
     input('ByeBye, press enter to escape.')
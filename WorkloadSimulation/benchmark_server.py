@@ -0,0 +1,125 @@
+'''
+File: benchmark_server.py
+Aim: Benchmark the event-loop TCP server with many simulated middleware clients.
+
+Every client connects to the simulation server,
+and sends keepAlive messages one by one, waiting for the reply of each,
+the round trip latencies and the throughput are reported.
+
+Usage:
+>> python benchmark_server.py [--clients 200] [--messages 100]
+'''
+
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+
+import TCPServerSimulation
+from TCPServerSimulation import TCPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))  # noqa
+from protocol import KEEP_ALIVE_REQUEST, KEEP_ALIVE_REPLY  # noqa
+
+HELLO = b'Hello from server'
+
+
+def recv_exactly(client, n):
+    ''' Receive [n] bytes from the [client] '''
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = client.recv(n - len(buf))
+        if chunk == b'':
+            raise ConnectionResetError('Server closed the connection')
+        buf += chunk
+    return bytes(buf)
+
+
+def simulate_client(address, n_messages, barrier, latencies, errors):
+    ''' Simulate the middleware client,
+    it sends [n_messages] keepAlive messages after all the clients are connected.
+    '''
+    try:
+        client = socket.create_connection(address)
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        recv_exactly(client, len(HELLO))
+    except Exception as err:
+        errors.append(err)
+        barrier.abort()
+        return
+
+    try:
+        barrier.wait()
+        for _ in range(n_messages):
+            tic = time.perf_counter()
+            client.sendall(KEEP_ALIVE_REQUEST)
+            reply = recv_exactly(client, len(KEEP_ALIVE_REPLY))
+            latencies.append(time.perf_counter() - tic)
+            assert(reply == KEEP_ALIVE_REPLY)
+    except Exception as err:
+        errors.append(err)
+    finally:
+        client.close()
+
+
+def benchmark(n_clients, n_messages):
+    ''' Run the benchmark of [n_clients] clients sending [n_messages] messages each
+
+    Outs:
+    - The dict of the results.
+    '''
+    TCPServerSimulation.verbose = False
+    server = TCPServer()
+    server.bind(port=0)
+    server.serve()
+    address = server.server.address
+
+    latencies = []
+    errors = []
+    barrier = threading.Barrier(n_clients + 1)
+    threads = [threading.Thread(target=simulate_client,
+                                args=(address, n_messages, barrier, latencies, errors),
+                                daemon=True)
+               for _ in range(n_clients)]
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    connected = len(server.alive_sessions())
+    tic = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    cost = time.perf_counter() - tic
+
+    server.stop()
+
+    latencies = np.array(latencies)
+    return dict(
+        clients=n_clients,
+        connected=connected,
+        messages=len(latencies),
+        errors=len(errors),
+        seconds=cost,
+        throughput=len(latencies) / cost,
+        p50=np.percentile(latencies, 50),
+        p90=np.percentile(latencies, 90),
+        p99=np.percentile(latencies, 99),
+        max=np.max(latencies),
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=100)
+    args = parser.parse_args()
+
+    results = benchmark(args.clients, args.messages)
+    print(f'{results["connected"]} of {results["clients"]} clients connected, {results["errors"]} errors')
+    print(f'{results["messages"]} round trips in {results["seconds"]:.3f} seconds, '
+          f'{results["throughput"]:.0f} messages per second')
+    print(f'Latency (ms): p50={results["p50"]*1000:.3f}, p90={results["p90"]*1000:.3f}, '
+          f'p99={results["p99"]*1000:.3f}, max={results["max"]*1000:.3f}')
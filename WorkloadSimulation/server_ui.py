@@ -7,42 +7,15 @@ The TCP server will be automatically built.
 '''
 
 import os
+import sys
 import time
-import json
 from TCPServerSimulation import TCPServer
 
 # %%
 # Coding Tools
-coding = 'utf-8'
-
-
-def decode(content, coding=coding):
-    ''' Decode [content] if necessary '''
-    if isinstance(content, type(b'')):
-        return content.decode(coding)
-    else:
-        return content
-
-
-def encode(content, coding=coding):
-    ''' Encode [content] if necessary '''
-    if isinstance(content, type('')):
-        return content.encode(coding)
-    else:
-        return content
-
-
-def unpack(pack):
-    try:
-        return json.loads(pack)
-    except:
-        return None
-
-
-def pack(dct):
-    for key in dct:
-        dct[key] = decode(dct[key])
-    return json.dumps(dct)
+# The codec is shared with the BCI client in the protocol package.
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))  # noqa
+from protocol import pack, unpack  # noqa
 
 
 # %%
@@ -149,8 +122,7 @@ def interface():
 
         if inp.startswith('send '):
             message = inp.split(' ', 1)[1]
-            for session in server.alive_sessions():
-                session.send(message)
+            server.broadcast(message)
             continue
 
         if inp in ['training', 'building', 'youbiaoqian', 'wubiaoqian']:
@@ -1,17 +1,10 @@
-import json
+import os
+import sys
 import time
 from TCPClient import TCPClient
 
-
-def unpack(pack):
-    try:
-        return json.loads(pack)
-    except:
-        return None
-
-
-def pack(dct):
-    return json.dumps(dct)
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))  # noqa
+from protocol import pack, unpack  # noqa
 
 
 if __name__ == '__main__':
@@ -0,0 +1,194 @@
+'''
+File: deviceEmulator.py
+Aim: The local emulator of the NeuroScan device for the benchmarks.
+
+It speaks the same protocol as the device on a local port,
+- The control packets are 12 bytes of 'CTRL', code, request and size;
+- The data packets are the 12 bytes header of 'DATA' and the body of int32 samples,
+  the body has (n_channels + 1) rows of [time_per_packet] seconds.
+The NeuroScanDeviceClient connects to it with simulationMode=False,
+so the benchmarks cover the socket and unpacking path of the real device.
+
+The packets are sent [speed] times faster than the real time,
+0 refers as fast as possible.
+
+Usage:
+>> python deviceEmulator.py [--port 4000] [--speed 1]
+'''
+
+import time
+import struct
+import socket
+import argparse
+import threading
+import numpy as np
+
+_header = struct.Struct('>4sHHI')
+
+# (code, request) of the control packets
+START_ACQ = (2, 1)
+STOP_ACQ = (2, 2)
+START_SENDING = (3, 3)
+STOP_SENDING = (3, 4)
+CLOSE = (1, 2)
+
+
+class DeviceEmulator(object):
+    ''' The device emulator,
+    it serves one client at a time.
+
+    Useful methods:
+    - @start: Listen on the port and serve on independent thread;
+    - @stop: Stop serving;
+    - @address: The listening address.
+    '''
+
+    def __init__(self, n_channels=69, sample_rate=1000, time_per_packet=0.04, speed=1, IP='127.0.0.1', port=0, seconds=10, seed=0):
+        ''' Initialize the emulator
+
+        Args:
+        - @n_channels: The number of channels, the same as the client;
+        - @sample_rate: The sample rate;
+        - @time_per_packet: The time gap between two packets in the real time;
+        - @speed: How many times faster than the real time, 0 refers as fast as possible;
+        - @IP, @port: The listening address, 0 refers any free port;
+        - @seconds: The length of the generated data, it is sent in loop;
+        - @seed: The seed of the generated data.
+        '''
+        self.n_channels = n_channels
+        self.sample_rate = sample_rate
+        self.time_per_packet = time_per_packet
+        self.speed = speed
+
+        self.packet_time_point = int(np.round(sample_rate * time_per_packet))
+        self.bytes_per_packet = (n_channels + 1) * self.packet_time_point * 4
+
+        # The packets are encoded once and sent in loop
+        rng = np.random.default_rng(seed)
+        n_packets = max(1, int(seconds / time_per_packet))
+        counts = rng.normal(scale=1000,
+                            size=(n_packets, self.packet_time_point, n_channels + 1))
+        header = _header.pack(b'DATA', 2, 1, self.bytes_per_packet)
+        self.packets = [header + e.astype('<i4').tobytes() for e in counts]
+
+        self.sent = 0
+        self.streaming = threading.Event()
+        self.running = False
+        self.lock = threading.Lock()
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((IP, port))
+        self.listener.listen(1)
+
+    @property
+    def address(self):
+        ''' The listening address '''
+        return self.listener.getsockname()
+
+    def start(self):
+        ''' Serve on independent thread '''
+        self.running = True
+        thread = threading.Thread(target=self._keep_serving,
+                                  name='Device emulator')
+        thread.setDaemon(True)
+        thread.start()
+
+    def stop(self):
+        ''' Stop serving '''
+        self.running = False
+        self.streaming.clear()
+        self.listener.close()
+
+    def _keep_serving(self):
+        # Built-in method of serving the clients one by one
+        while self.running:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            try:
+                self._serve(client)
+            except OSError:
+                pass
+            finally:
+                self.streaming.clear()
+                client.close()
+
+    def _serve(self, client):
+        # Built-in method of handling the control packets of the [client]
+        while True:
+            packet = self._recv_exactly(client, _header.size)
+            if packet is None:
+                return
+            _, code, request, _ = _header.unpack(packet)
+
+            if (code, request) == START_ACQ:
+                self._send(client, _header.pack(b'CTRL', 1, 3, 12) + bytes(12))
+
+            elif (code, request) == START_SENDING:
+                self.streaming.set()
+                thread = threading.Thread(target=self._keep_streaming,
+                                          args=(client,),
+                                          name='Device emulator streaming')
+                thread.setDaemon(True)
+                thread.start()
+
+            elif (code, request) == STOP_SENDING:
+                # The client reads one more packet after stopping
+                self.streaming.clear()
+                self._send(client, self.packets[self.sent % len(self.packets)])
+
+            elif (code, request) == CLOSE:
+                return
+
+    def _keep_streaming(self, client):
+        # Built-in method of sending the packets in the pace of the [speed]
+        interval = self.time_per_packet / self.speed if self.speed > 0 else 0
+        next_time = time.perf_counter()
+        while self.streaming.is_set():
+            if interval > 0:
+                next_time += interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                self._send(client, self.packets[self.sent % len(self.packets)])
+            except OSError:
+                return
+
+    def _send(self, client, data):
+        # Built-in method of sending the whole packet
+        with self.lock:
+            client.sendall(data)
+            if data[:4] == b'DATA':
+                self.sent += 1
+
+    def _recv_exactly(self, client, n):
+        # Built-in method of receiving [n] bytes, None refers the client is closed
+        buf = b''
+        while len(buf) < n:
+            chunk = client.recv(n - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return buf
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=4000)
+    parser.add_argument('--channels', type=int, default=69)
+    parser.add_argument('--rate', type=int, default=1000)
+    parser.add_argument('--speed', type=float, default=1)
+    args = parser.parse_args()
+
+    emulator = DeviceEmulator(n_channels=args.channels,
+                              sample_rate=args.rate,
+                              speed=args.speed,
+                              port=args.port)
+    emulator.start()
+    print(f'Device emulator listens on {emulator.address}')
+    input('Press enter to escape')
+    emulator.stop()
@@ -0,0 +1,160 @@
+'''
+File: packet.py
+Aim: The per-packet CPU cost of the acquisition hot path.
+
+Every packet goes through the path of the NeuroScanDeviceClient,
+receiving the header and the body from the socket, unpacking the header,
+decoding the body, writing the ring buffer and scanning the triggers.
+The implementations are
+- legacy: The struct based unpacking and the concatenated receiving before the acquisition core;
+- python: The acquisitionCore.py in pure Python;
+- compiled: The acquisitionCore compiled by cythonScripts/convert.py, it is skipped if it is not built.
+
+The CPU time is the process time per packet, the best of the [--repeat] rounds.
+
+Usage:
+>> python benchmarks/packet.py [--channels 69] [--rate 1000] [--packets 2000] [--output packet.jsonl]
+'''
+
+import os
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import importlib.util
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)  # noqa
+
+from BCIClient import acquisitionCore  # noqa
+from BCIClient.ringBuffer import RingBuffer  # noqa
+from BCIClient.neuroScanToolbox import scale  # noqa
+from pipeline import git_commit  # noqa
+
+time_per_packet = 0.04  # Seconds
+
+
+class legacy(object):
+    ''' The hot path before the acquisition core, it is kept as the reference '''
+
+    @staticmethod
+    def receive_exactly(client, n_bytes):
+        b_data = b''
+        b_count = 0
+        while b_count < n_bytes:
+            tmp_bytes = client.recv(n_bytes - b_count)
+            if not tmp_bytes:
+                break
+            b_count += len(tmp_bytes)
+            b_data += tmp_bytes
+        return b_data
+
+    @staticmethod
+    def unpack_header(header_packet):
+        return (struct.unpack('>4s', header_packet[:4])[0],
+                struct.unpack('>H', header_packet[4:6])[0],
+                struct.unpack('>H', header_packet[6:8])[0],
+                struct.unpack('>I', header_packet[8:])[0])
+
+    @staticmethod
+    def decode_packet(data_packet, n_channels, scale):
+        fmt = '<' + str(len(data_packet) // 4) + 'i'
+        trans = np.asarray(struct.unpack(fmt, data_packet)).reshape((-1, n_channels + 1)).T
+        out = np.empty((n_channels, trans.shape[1]), dtype=float)
+        out[:-1, :] = trans[:n_channels-1, :] * scale
+        out[-1, :] = 0
+        return out
+
+    @staticmethod
+    def scan_triggers(row):
+        idx = np.flatnonzero(row)
+        return idx, row[idx]
+
+
+def pure_python_core():
+    ''' Load the acquisitionCore.py in pure Python, even if the compiled one exists '''
+    path = os.path.join(root, 'BCIClient', 'acquisitionCore.py')
+    spec = importlib.util.spec_from_file_location('acquisitionCorePure', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run(core, n_channels, rate, n_packets):
+    ''' Run the [n_packets] packets through the hot path of the [core]
+
+    Outs:
+    - The process seconds per packet.
+    '''
+    points = int(np.round(rate * time_per_packet))
+    size = (n_channels + 1) * points * 4
+    rng = np.random.default_rng(0)
+    body = rng.integers(-2**20, 2**20, size=(points, n_channels + 1)).astype('<i4').tobytes()
+    packet = struct.pack('>4sHHI', b'DATA', 2, 1, size) + body
+
+    buffer = RingBuffer(n_channels, rate * 60)
+    reader, writer = socket.socketpair()
+    writer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, len(packet) * 4)
+    reader.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, len(packet) * 4)
+    try:
+        tic = time.process_time()
+        for _ in range(n_packets):
+            writer.sendall(packet)
+            header = core.unpack_header(core.receive_exactly(reader, 12))
+            d = core.decode_packet(core.receive_exactly(reader, header[-1]),
+                                   n_channels,
+                                   scale)
+            buffer.write(d)
+            core.scan_triggers(d[-1, :])
+        return (time.process_time() - tic) / n_packets
+    finally:
+        reader.close()
+        writer.close()
+
+
+def benchmark(n_channels=69, rate=1000, n_packets=2000, repeat=3):
+    ''' Run the benchmark of the implementations
+
+    Outs:
+    - The dict of the implementations and their process seconds per packet.
+    '''
+    cores = dict(legacy=legacy, python=pure_python_core())
+    if acquisitionCore.compiled:
+        cores['compiled'] = acquisitionCore
+
+    results = dict()
+    for name, core in cores.items():
+        results[name] = min([run(core, n_channels, rate, n_packets)
+                             for _ in range(repeat)])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=69)
+    parser.add_argument('--rate', type=int, default=1000)
+    parser.add_argument('--packets', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None,
+                        help='The json lines file the results are appended to')
+    args = parser.parse_args()
+
+    results = benchmark(args.channels, args.rate, args.packets, args.repeat)
+    if not acquisitionCore.compiled:
+        print('The compiled acquisitionCore is not built, see cythonScripts/convert.py')
+    for name, seconds in results.items():
+        print(f'{name:<10}{seconds * 1e6:>10.1f} us per packet')
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(dict(commit=git_commit(),
+                                    time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                                    channels=args.channels,
+                                    rate=args.rate,
+                                    packets=args.packets,
+                                    compiled=acquisitionCore.compiled,
+                                    results=results)) + '\n')
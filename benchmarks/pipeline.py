@@ -0,0 +1,407 @@
+'''
+File: pipeline.py
+Aim: The end-to-end benchmark of the middleware pipeline.
+
+It starts the TCP server simulation as the main controller on a free port,
+connects the BCIClient.TCPClient to it, and drives the sessions in order,
+- training: Collect the data, then stop and save it;
+- building: Build the youbiaoqian and wubiaoqian decoders on the collected data;
+- youbiaoqian: The passive session, the labels are computed on the 33 triggers;
+- wubiaoqian: The active session, the labels are computed timely.
+
+The data comes from
+- simulation: The simulation data generator of the device client;
+- emulator: The local device emulator, see deviceEmulator.py, it covers the socket and unpacking path.
+
+The results are
+- Packet throughput: The packets and samples per second, the packet handling time;
+- Decode CPU: The seconds of predicting per second of data, and the process CPU per second;
+- Memory: The high-water mark of the resident memory;
+- Label latency: From the trigger (youbiaoqian) or the prediction (wubiaoqian) to the label received by the controller;
+- Save and load: From stopping the session to the sessionSaved message, and loading the saved file.
+
+The results are printed as json, and appended as one json line to [--output],
+so the lines of the commits can be compared for the regressions.
+
+Usage:
+>> python benchmarks/pipeline.py [--device simulation] [--seconds 20] [--speed 1] [--output results.jsonl]
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import traceback
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)  # noqa
+sys.path.insert(0, os.path.join(root, 'WorkloadSimulation'))  # noqa
+
+import TCPServerSimulation  # noqa
+from TCPServerSimulation import TCPServer  # noqa
+from BCIClient import telemetry, sessionFile  # noqa
+from BCIClient.acquisition import AcquisitionService, register_service, shutdown_all, n_channels, freq  # noqa
+from BCIClient.TCPClient import TCPClient  # noqa
+from BCIClient.link import Link  # noqa
+from deviceEmulator import DeviceEmulator  # noqa
+
+
+def _describe(values):
+    # Built-in method of describing the [values] in percentiles, the unit is 'second'
+    if len(values) == 0:
+        return None
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return dict(n=len(values), p50=p50, p90=p90, p99=p99, max=float(np.max(values)))
+
+
+def peak_memory_mb():
+    ''' The high-water mark of the resident memory, None refers unknown '''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It is in bytes on macOS and in kilobytes on Linux
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+def git_commit():
+    ''' The commit of the repository, None refers unknown '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=root,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Controller(object):
+    ''' The main controller,
+    it sends the commands through the simulation server and collects the replies.
+    '''
+
+    def __init__(self):
+        self.messages = []  # (monotonic ns, dct)
+        self.condition = threading.Condition()
+        self.server = TCPServer(on_message=self.on_message)
+
+    def on_message(self, session, dct):
+        # The callback of the server
+        with self.condition:
+            self.messages.append((time.monotonic_ns(), dct))
+            self.condition.notify_all()
+
+    def mark(self):
+        ''' The index of the next message '''
+        with self.condition:
+            return len(self.messages)
+
+    def wait_client(self, timeout=10):
+        ''' Wait for the client to connect '''
+        deadline = time.time() + timeout
+        while not self.server.alive_sessions():
+            if time.time() > deadline:
+                raise TimeoutError('The client is not connected')
+            time.sleep(0.05)
+        # The greeting of the server is received before the commands
+        time.sleep(0.5)
+
+    def send(self, dct):
+        ''' Send the command [dct] to the client '''
+        for session in self.server.alive_sessions():
+            session.send(dct)
+
+    def wait(self, method, since, timeout=60):
+        ''' Wait for the message of [method] after the index [since]
+
+        Outs:
+        - The monotonic ns when it is received;
+        - The message.
+        '''
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for t, dct in self.messages[since:]:
+                    if dct.get('method', None) == method:
+                        return t, dct
+                    if dct.get('method', None) == 'error':
+                        raise RuntimeError(f'Failed on waiting for {method}: {dct}')
+                remains = deadline - time.monotonic()
+                if remains <= 0:
+                    raise TimeoutError(f'No {method} in {timeout} seconds')
+                self.condition.wait(remains)
+
+    def labels(self, since, until=None):
+        ''' The monotonic ns of the labels received in the messages [since:until] '''
+        with self.condition:
+            return np.array([t for t, dct in self.messages[since:until]
+                             if dct.get('method', None) == 'labelComputed'])
+
+
+def keep_client(address, link, running):
+    ''' Keep the client connected while [running] is set '''
+    while running.is_set():
+        try:
+            TCPClient(*address, link=link)
+        except Exception:
+            traceback.print_exc()
+        time.sleep(0.5)
+
+
+def _records(t_start, t_stop):
+    # Built-in method of reading the telemetry records between the monotonic ns
+    path = telemetry.flush()
+    if path is None:
+        return None
+    table, _ = telemetry.read(path)
+    return table[(table['t_ns'] >= t_start) & (table['t_ns'] < t_stop)]
+
+
+def measure_stream(t_start, t_stop):
+    ''' Measure the packets and the predictions between the monotonic ns
+
+    Outs:
+    - The dict of the results.
+    '''
+    table = _records(t_start, t_stop)
+    if table is None:
+        return dict()
+
+    seconds = (t_stop - t_start) / 1e9
+    packets = table[table['kind'] == telemetry.PACKET]
+    predictions = table[table['kind'] == telemetry.PREDICTION]
+    samples = int(packets['a'][-1] - packets['a'][0]) if len(packets) > 1 else 0
+    return dict(
+        packets_per_second=len(packets) / seconds,
+        samples_per_second=samples / seconds,
+        packet_handling=_describe(packets['b']),
+        prediction=_describe(predictions['b']),
+        decode_seconds_per_data_second=float(np.sum(predictions['b'])) / (samples / freq) if samples else None,
+    )
+
+
+def label_latency(labels, t_start, t_stop, trigger):
+    ''' The latency from the events to the [labels] received between the monotonic ns
+
+    Args:
+    - @labels: The monotonic ns of the received labels;
+    - @trigger: True refers the events are the 33 triggers, False refers the predictions.
+    '''
+    table = _records(t_start, t_stop)
+    if table is None or len(labels) == 0:
+        return None
+
+    if trigger:
+        events = table[(table['kind'] == telemetry.TRIGGER) & (table['tag'] == 33)]
+    else:
+        events = table[table['kind'] == telemetry.PREDICTION]
+    events = np.sort(events['t_ns'])
+
+    latency = []
+    for t in labels:
+        before = events[events <= t]
+        if len(before) > 0:
+            latency.append((t - before[-1]) / 1e9)
+    return _describe(np.array(latency))
+
+
+class Pipeline(object):
+    ''' The pipeline of the sessions '''
+
+    def __init__(self, controller, folder, seconds):
+        self.ctl = controller
+        self.folder = folder
+        self.seconds = seconds
+        self.data_path = os.path.join(folder, 'training.bcis')
+
+    def _online(self, name, start, trigger):
+        # Built-in method of running the online session of [name] started by [start]
+        cpu = time.process_time()
+        t_start = time.monotonic_ns()
+        since = self.ctl.mark()
+        self.ctl.send(start)
+        time.sleep(self.seconds)
+        t_stop = time.monotonic_ns()
+        until = self.ctl.mark()
+
+        self.ctl.send(dict(method='stopSession', sessionName=name))
+        self.ctl.wait('sessionStopped', until)
+        t_saved, _ = self.ctl.wait('sessionSaved', until)
+
+        result = measure_stream(t_start, t_stop)
+        result['labels'] = len(self.ctl.labels(since, until))
+        result['label_latency'] = label_latency(self.ctl.labels(since, until),
+                                                t_start,
+                                                t_stop,
+                                                trigger)
+        result['cpu_per_second'] = (time.process_time() - cpu) / ((t_saved - t_start) / 1e9)
+        result['save_seconds'] = (t_saved - t_stop) / 1e9
+        return result
+
+    def training(self):
+        ''' Collect the data, then stop and save it '''
+        result = self._online('training',
+                              dict(method='startSession',
+                                   sessionName='training',
+                                   dataPath=self.data_path),
+                              trigger=True)
+
+        tic = time.perf_counter()
+        d = sessionFile.load(self.data_path)
+        result['load_seconds'] = time.perf_counter() - tic
+        result['file_mb'] = os.path.getsize(self.data_path) / 1024 / 1024
+        result['recorded_seconds'] = d.shape[1] / freq
+        return result
+
+    def building(self, name):
+        ''' Build the decoder of [name] on the collected data '''
+        since = self.ctl.mark()
+        t = time.monotonic_ns()
+        self.ctl.send(dict(method='startBuilding',
+                           sessionName=name,
+                           dataPath=self.data_path,
+                           modelPath=self.model_path(name)))
+        t_built, dct = self.ctl.wait('stopBuilding', since, timeout=600)
+        return dict(build_seconds=(t_built - t) / 1e9,
+                    valid_accuracy=dct.get('validAccuracy', None))
+
+    def model_path(self, name):
+        return os.path.join(self.folder, f'{name}.model')
+
+    def youbiaoqian(self):
+        ''' The passive session '''
+        return self._online('youbiaoqian',
+                            dict(method='startSession',
+                                 sessionName='youbiaoqian',
+                                 dataPath=os.path.join(self.folder, 'youbiaoqian.bcis'),
+                                 modelPath=self.model_path('youbiaoqian'),
+                                 newModelPath=os.path.join(self.folder, 'youbiaoqian.updated.model'),
+                                 updateCount='10'),
+                            trigger=True)
+
+    def wubiaoqian(self):
+        ''' The active session '''
+        return self._online('wubiaoqian',
+                            dict(method='startSession',
+                                 sessionName='wubiaoqian',
+                                 dataPath=os.path.join(self.folder, 'wubiaoqian.bcis'),
+                                 modelPath=self.model_path('wubiaoqian')),
+                            trigger=False)
+
+
+def benchmark(device='simulation', seconds=20, speed=1):
+    ''' Run the benchmark of the pipeline
+
+    Args:
+    - @device: The source of the data, 'simulation' or 'emulator';
+    - @seconds: The seconds of every online session;
+    - @speed: How many times faster the emulator sends than the real time, 0 refers as fast as possible.
+
+    Outs:
+    - The dict of the results.
+    '''
+    telemetry.enable()
+    TCPServerSimulation.verbose = False
+    folder = tempfile.mkdtemp(prefix='bci-benchmark-')
+
+    emulator = None
+    if device == 'emulator':
+        emulator = DeviceEmulator(n_channels=n_channels,
+                                  sample_rate=freq,
+                                  speed=speed)
+        emulator.start()
+        register_service(AcquisitionService(*emulator.address,
+                                            n_channels=n_channels,
+                                            freq=freq,
+                                            simulationMode=False))
+    else:
+        register_service(AcquisitionService(n_channels=n_channels,
+                                            freq=freq,
+                                            simulationMode=True))
+
+    ctl = Controller()
+    ctl.server.bind('127.0.0.1', 0)
+    ctl.server.serve()
+
+    running = threading.Event()
+    running.set()
+    link = Link()
+    thread = threading.Thread(target=keep_client,
+                              args=(ctl.server.server.address, link, running),
+                              daemon=True)
+    thread.start()
+    ctl.wait_client()
+
+    pipeline = Pipeline(ctl, folder, seconds)
+    steps = [('training', pipeline.training),
+             ('building_youbiaoqian', lambda: pipeline.building('youbiaoqian')),
+             ('building_wubiaoqian', lambda: pipeline.building('wubiaoqian')),
+             ('youbiaoqian', pipeline.youbiaoqian),
+             ('wubiaoqian', pipeline.wubiaoqian)]
+
+    results = dict()
+    for name, step in steps:
+        print(f'Running {name}', file=sys.stderr)
+        try:
+            results[name] = step()
+        except Exception as err:
+            traceback.print_exc()
+            results[name] = dict(error=f'{err}')
+
+    running.clear()
+    ctl.server.stop()
+    link.close()
+    shutdown_all()
+    if emulator is not None:
+        emulator.stop()
+    shutil.rmtree(folder, ignore_errors=True)
+
+    return dict(
+        commit=git_commit(),
+        time=time.strftime('%Y-%m-%d %H:%M:%S'),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        device=device,
+        seconds=seconds,
+        speed=speed,
+        n_channels=n_channels,
+        freq=freq,
+        peak_memory_mb=peak_memory_mb(),
+        results=results,
+    )
+
+
+def _default(obj):
+    # Built-in method of converting the numpy values for json
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(f'{type(obj)} is not serializable')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--device', choices=['simulation', 'emulator'], default='simulation')
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--speed', type=float, default=1)
+    parser.add_argument('--output', default=None,
+                        help='The json lines file the results are appended to')
+    args = parser.parse_args()
+
+    results = benchmark(args.device, args.seconds, args.speed)
+    print(json.dumps(results, indent=2, default=_default))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results, default=_default) + '\n')
@@ -0,0 +1,184 @@
+'''
+File: primitives.py
+Aim: The micro-benchmarks of the acquisition primitives.
+
+Every primitive is measured across the grid of
+- channels: The number of channels, the last one is the trigger channel;
+- rates: The sample rates in Hz;
+- minutes: The length of the collected data in minutes.
+
+The primitives are
+- pop: SimulationDataGenerator.pop of one packet;
+- add: NeuroScanDeviceClient._add of one packet;
+- get_all: NeuroScanDeviceClient.get_all of the collected data;
+- latest: DataStack.latest of 5 seconds;
+- save: DataStack.save of the collected data, in the storage format of the setting;
+- load: sessionFile.load of the saved data.
+
+The time is the best of the [--repeat] rounds of timeit,
+the memory is the peak of the allocations of one call traced by tracemalloc.
+The results are printed as table, and appended as one json line to [--output],
+so the rewrites of the buffers and the decoders come with numbers.
+
+Usage:
+>> python benchmarks/primitives.py [--channels 32 69] [--rates 1000 2000] [--minutes 1 10 60] [--output primitives.jsonl]
+'''
+
+import os
+import sys
+import json
+import time
+import timeit
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)  # noqa
+
+from BCIClient import sessionFile  # noqa
+from BCIClient.neuroScanToolbox import NeuroScanDeviceClient, SimulationDataGenerator  # noqa
+from BCIClient.acquisition import AcquisitionService, register_service  # noqa
+from BCIClient.dataCollector import DataStack  # noqa
+from pipeline import git_commit  # noqa
+
+time_per_packet = 0.04  # Seconds
+
+
+def measure(func, repeat=3):
+    ''' Measure the [func] called without arguments
+
+    Outs:
+    - The seconds of one call, the best of the [repeat] rounds;
+    - The peak bytes of the allocations of one call.
+    '''
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    seconds = min(timer.repeat(repeat=repeat, number=number)) / number
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def make_data(n_channels, n_samples, seed=0):
+    ''' Make the random data of [n_channels] x [n_samples], the trigger row is zero '''
+    rng = np.random.default_rng(seed)
+    d = rng.normal(scale=50, size=(n_channels, n_samples))
+    d[-1] = 0
+    return d
+
+
+def bench(n_channels, rate, minutes, folder, repeat=3):
+    ''' Run the benchmarks of the primitives at the size
+
+    Args:
+    - @n_channels: The number of channels;
+    - @rate: The sample rate;
+    - @minutes: The length of the collected data in minutes;
+    - @folder: The folder of the saved files;
+    - @repeat: The rounds of timeit.
+
+    Outs:
+    - The dict of the primitives and their (seconds, peak bytes).
+    '''
+    n_samples = int(minutes * 60 * rate)
+    packet = int(np.round(rate * time_per_packet))
+    results = dict()
+
+    # The simulation data of the size
+    sdg = SimulationDataGenerator()
+    sdg.all_data = sdg.raw = make_data(n_channels, n_samples)
+    results['pop'] = measure(lambda: sdg.pop(packet), repeat)
+
+    # The device client of the buffer of the size,
+    # the data stack records it from the beginning
+    nsclient = NeuroScanDeviceClient(None,
+                                     None,
+                                     rate,
+                                     n_channels,
+                                     time_per_packet=time_per_packet,
+                                     simulationMode=True,
+                                     maxLength=int(np.ceil(minutes * 60)))
+    service = AcquisitionService(n_channels=n_channels, freq=rate)
+    service.nsclient = nsclient
+    register_service(service)
+
+    filepath = os.path.join(folder, f'{n_channels}-{rate}-{minutes}.bcis')
+    ds = DataStack(filepath, n_channels=n_channels, freq=rate, name='benchmark')
+    ds.start()
+
+    data = make_data(n_channels, packet * 100, seed=1)
+    for i in range(0, n_samples - packet + 1, packet):
+        j = i % (data.shape[1] - packet + 1)
+        nsclient._add(data[:, j:j+packet])
+
+    d = data[:, :packet]
+    length = nsclient.buffer.length
+    results['add'] = measure(lambda: nsclient._add(d), repeat)
+    # The timed packets are rolled back, so the size is kept
+    nsclient.buffer._set_length(length)
+
+    results['get_all'] = measure(nsclient.get_all, repeat)
+    results['latest'] = measure(lambda: ds.latest(5), repeat)
+
+    def save():
+        # The file of the last round is removed, so the overriding is not measured
+        if os.path.isfile(filepath):
+            os.remove(filepath)
+        ds.save()
+
+    results['save'] = measure(save, repeat)
+    results['load'] = measure(lambda: sessionFile.load(filepath), repeat)
+
+    ds.stop()
+    ds.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, nargs='+', default=[32, 69])
+    parser.add_argument('--rates', type=int, nargs='+', default=[1000, 2000])
+    parser.add_argument('--minutes', type=float, nargs='+', default=[1, 10])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=None,
+                        help='The json lines file the results are appended to')
+    args = parser.parse_args()
+
+    # The logs of every call are not measured
+    logging.getLogger('BCIClient').setLevel(logging.WARNING)
+
+    folder = tempfile.mkdtemp(prefix='bci-primitives-')
+    rows = []
+    print(f'{"primitive":<10}{"channels":>10}{"rate":>8}{"minutes":>9}{"ms":>14}{"peak MB":>12}')
+    try:
+        for n_channels in args.channels:
+            for rate in args.rates:
+                for minutes in args.minutes:
+                    results = bench(n_channels, rate, minutes, folder, args.repeat)
+                    for name, (seconds, peak) in results.items():
+                        rows.append(dict(primitive=name,
+                                         channels=n_channels,
+                                         rate=rate,
+                                         minutes=minutes,
+                                         seconds=seconds,
+                                         peak_bytes=peak))
+                        print(f'{name:<10}{n_channels:>10}{rate:>8}{minutes:>9g}'
+                              f'{seconds * 1000:>14.4f}{peak / 1024 / 1024:>12.3f}')
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(dict(commit=git_commit(),
+                                    time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                                    numpy=np.__version__,
+                                    results=rows)) + '\n')
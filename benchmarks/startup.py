@@ -0,0 +1,148 @@
+'''
+File: startup.py
+Aim: The cold start benchmark of the BCIClient.
+
+Every round starts a fresh interpreter, so nothing is cached in the process,
+- import: Import the BCIClient package;
+- client: Import the BCIClient.TCPClient, it is what start_client.py imports;
+- connected: From starting the interpreter to the TCP client connected to the local server.
+The seconds of the stages in the process, from importing the package, are also reported,
+they are the startup metrics, see BCIClient/metrics.py.
+
+The heavy modules loaded by the imports are listed by -X importtime,
+so the modules escaping the lazy imports are easy to find.
+
+Usage:
+>> python benchmarks/startup.py [--rounds 5] [--output startup.jsonl]
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import numpy as np
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)  # noqa
+
+from pipeline import git_commit  # noqa
+
+# The script of the client process, it connects to the port and prints the startup stages
+_client_script = '''
+import sys, json
+from BCIClient import metrics
+from BCIClient.TCPClient import TCPClient
+metrics.startup('imported')
+TCPClient(port=int(sys.argv[1]))
+print(json.dumps(metrics.startup_stages))
+'''
+
+
+def _run(args):
+    # Built-in method of running the python of [args] in the root, the seconds are returned
+    tic = time.perf_counter()
+    subprocess.run([sys.executable] + args,
+                   cwd=root,
+                   check=True,
+                   stdout=subprocess.DEVNULL,
+                   stderr=subprocess.DEVNULL)
+    return time.perf_counter() - tic
+
+
+def time_connected():
+    ''' Start the client process and wait for its connection
+
+    Outs:
+    - The seconds from starting the process to accepting the connection;
+    - The startup stages reported by the process.
+    '''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    tic = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', _client_script, str(port)],
+                               cwd=root,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+    connection, _ = server.accept()
+    seconds = time.perf_counter() - tic
+
+    # The client stops when the connection is closed
+    connection.close()
+    server.close()
+    out, _ = process.communicate(timeout=10)
+    try:
+        stages = json.loads(out.decode().strip().splitlines()[-1])
+    except (ValueError, IndexError):
+        stages = dict()
+    return seconds, stages
+
+
+def heavy_modules(module, top=10):
+    ''' The modules of the largest cumulative import time of importing [module]
+
+    Outs:
+    - The list of [module name, seconds].
+    '''
+    out = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                         cwd=root,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.PIPE).stderr.decode()
+    modules = []
+    for line in out.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        modules.append([parts[2].strip(), int(parts[1]) / 1e6])
+    return sorted(modules, key=lambda e: -e[1])[:top]
+
+
+def benchmark(rounds=5):
+    ''' Run the cold start benchmark of [rounds] rounds
+
+    Outs:
+    - The dict of the results, the unit is 'second'.
+    '''
+    baseline = [_run(['-c', 'pass']) for _ in range(rounds)]
+    imports = [_run(['-c', 'import BCIClient']) for _ in range(rounds)]
+    clients = [_run(['-c', 'import BCIClient.TCPClient']) for _ in range(rounds)]
+
+    connected = []
+    stages = dict()
+    for _ in range(rounds):
+        seconds, e = time_connected()
+        connected.append(seconds)
+        for key, value in e.items():
+            stages.setdefault(key, []).append(value)
+
+    return dict(commit=git_commit(),
+                time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                python=sys.version.split()[0],
+                rounds=rounds,
+                interpreter=float(np.median(baseline)),
+                import_package=float(np.median(imports)),
+                import_client=float(np.median(clients)),
+                connected=float(np.median(connected)),
+                stages={key: float(np.median(value)) for key, value in stages.items()},
+                heavy_modules=heavy_modules('BCIClient.TCPClient'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--output', default=None,
+                        help='The json lines file the results are appended to')
+    args = parser.parse_args()
+
+    results = benchmark(args.rounds)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
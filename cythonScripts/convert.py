@@ -1,11 +1,37 @@
 '''
 FileName: convert.py
 Author: Chuncheng
-Version: V0.0
+Version: V0.1
 Purpose: Convert the .py Files into its Compiled Version
+
+The BCIDecoder.py is compiled in the folder if it is copied here,
+and the acquisition hot path of BCIClient/acquisitionCore.py is compiled next to itself
+with the types declared in BCIClient/acquisitionCore.pxd,
+the BCIClient uses the compiled one if it exists, and falls back to the .py file otherwise.
+
+Usage:
+>> python convert.py build_ext --inplace
 '''
 
-from distutils.core import setup
+import os
+
+try:
+    from setuptools import setup, Extension
+except ImportError:
+    from distutils.core import setup, Extension
 from Cython.Build import cythonize
 
-setup(ext_modules=cythonize(["BCIDecoder.py"]))
+root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+package = os.path.join(root, 'BCIClient')
+
+modules = [e for e in ["BCIDecoder.py"] if os.path.isfile(e)]
+if os.path.isfile(os.path.join(package, 'acquisitionCore.py')):
+    # The absolute path keeps the objects inside the build folder,
+    # the relative '../BCIClient' places them out of it and fails the compiling
+    modules.append(Extension('BCIClient.acquisitionCore',
+                             [os.path.join(package, 'acquisitionCore.py')]))
+
+# The package_dir places the compiled acquisitionCore in the BCIClient folder on --inplace
+setup(ext_modules=cythonize(modules, language_level=3),
+      package_dir={'BCIClient': package})
@@ -0,0 +1,328 @@
+'''
+File: protocol/__init__.py
+Aim: The shared codec of the control messages between the BCI client and the server.
+
+The messages are json objects encoded in utf-8,
+see fileWorks/communication.md for the details.
+
+The faster json backend of orjson is used if it is installed,
+the standard json module is used otherwise,
+the messages are the same except for the white spaces.
+
+The constant messages, like the keepAlive messages, are encoded once on import,
+and the incoming messages are matched against the schema table,
+so the hot path does not format any string.
+
+Useful functions:
+- @dumps: Encode the dict into the bytes of the message;
+- @loads: Decode the message into the dict;
+- @pack: Encode the dict into the string of the message, it is kept for the old callers;
+- @unpack: Decode the message into the dict, None is returned if it is not a valid json object;
+- @Splitter: Reassemble the messages from the stream of one connection;
+- @match: Check the message by the required fields;
+- @classify: Match the message against the schema table.
+
+The dispatch table of the messages is in protocol.dispatcher.
+'''
+
+import re
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+coding = 'utf-8'
+
+# The name of the json backend
+backend = 'json' if orjson is None else 'orjson'
+
+
+def decode(content, coding=coding):
+    ''' Decode [content] if necessary '''
+    if isinstance(content, bytes):
+        return content.decode(coding)
+    else:
+        return content
+
+
+def encode(content, coding=coding):
+    ''' Encode [content] if necessary '''
+    if isinstance(content, str):
+        return content.encode(coding)
+    else:
+        return content
+
+
+def _decode_values(dct):
+    # Built-in method of decoding the bytes values,
+    # like the raw message in the error messages
+    return {key: decode(value) for key, value in dct.items()}
+
+
+if orjson is not None:
+    def _dumps(dct):
+        return orjson.dumps(dct)
+
+    _loads = orjson.loads
+    _DecodeError = orjson.JSONDecodeError
+else:
+    def _dumps(dct):
+        return json.dumps(dct, separators=(',', ':')).encode(coding)
+
+    _loads = json.loads
+    _DecodeError = ValueError
+
+
+def dumps(dct):
+    ''' Encode [dct] into the bytes of the message,
+    the bytes values are decoded only if they exist.
+    '''
+    try:
+        return _dumps(dct)
+    except TypeError:
+        return _dumps(_decode_values(dct))
+
+
+def loads(raw):
+    ''' Decode the message [raw] into the dict,
+    the ValueError is raised if it is not a valid json.
+    '''
+    try:
+        return _loads(raw)
+    except _DecodeError as err:
+        raise ValueError(f'Invalid json: {err}')
+
+
+def pack(dct):
+    ''' Pack [dct] into the string of the message '''
+    return dumps(dct).decode(coding)
+
+
+def unpack(pack):
+    ''' Unpack [pack] into dict,
+    None is returned if it is not a valid json object.
+    '''
+    try:
+        dct = loads(pack)
+    except ValueError:
+        return None
+    if not isinstance(dct, dict):
+        return None
+    return dct
+
+
+# The bytes changing the nesting of the json objects,
+# they are ASCII, so they never appear inside the multi-byte utf-8 characters
+_tokens = re.compile(rb'[{}"\\]')
+
+# The max bytes of one message, the longer one is regarded as malformed
+max_message_size = 1024 * 1024
+
+
+class Splitter(object):
+    ''' The reassembler of the messages from the stream of one connection,
+    the stream is received in pieces, the boundaries of the pieces may be inside the messages,
+    so the complete json objects are returned and the incomplete tail is kept for the next piece.
+
+    Useful methods:
+    - @feed: Feed the received bytes.
+    '''
+
+    def __init__(self, max_size=max_message_size):
+        ''' Initialize the splitter
+
+        Args:
+        - @max_size: The max bytes of one message, the longer one is regarded as malformed.
+        '''
+        self.max_size = max_size
+        self.buffer = bytearray()
+        # The scanning state of the incomplete message at the head of the buffer
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+
+    @property
+    def pending(self):
+        ''' The number of the bytes of the incomplete message '''
+        return len(self.buffer)
+
+    def _take(self, n):
+        # Built-in method of taking the leading [n] bytes of the buffer
+        raw = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        return raw
+
+    def feed(self, raw):
+        ''' Feed the received bytes of [raw]
+
+        Outs:
+        - The dicts of the complete messages;
+        - The bytes of the malformed messages, like the text out of the json objects or the invalid json.
+        '''
+        self.buffer += raw
+        dcts = []
+        errors = []
+
+        while True:
+            # The text before the next json object is malformed
+            if self.depth == 0:
+                idx = self.buffer.find(b'{')
+                junk = self._take(len(self.buffer) if idx < 0 else idx)
+                if junk.strip():
+                    errors.append(junk)
+                if idx < 0:
+                    break
+                self.pos = 1
+                self.depth = 1
+
+            # Scan the object until its end
+            m = _tokens.search(self.buffer, self.pos)
+            if m is None:
+                self.pos = max(self.pos, len(self.buffer))
+                if len(self.buffer) > self.max_size:
+                    errors.append(self._take(len(self.buffer)))
+                break
+
+            token = m.group()
+            self.pos = m.end()
+            if self.in_string:
+                if token == b'\\':
+                    # The escaped byte is skipped, it may be in the next piece
+                    self.pos += 1
+                elif token == b'"':
+                    self.in_string = False
+            elif token == b'"':
+                self.in_string = True
+            elif token == b'{':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    message = self._take(self.pos)
+                    dct = unpack(message)
+                    if dct is None:
+                        errors.append(message)
+                    else:
+                        dcts.append(dct)
+
+        return dcts, errors
+
+
+# ------------------------------------------------------------------------
+# Constant Messages
+# They are encoded once and sent as they are.
+
+KEEP_ALIVE_REQUEST = dumps(dict(method='keepAlive', count='0'))
+KEEP_ALIVE_REPLY = dumps(dict(method='keepAlive', count='1'))
+
+
+def keepAliveRequest(seq, timestamp):
+    ''' Make the keepAlive message of the sequence number [seq] and the [timestamp] '''
+    return dumps(dict(method='keepAlive',
+                      count='0',
+                      seq=f'{seq}',
+                      timestamp=f'{timestamp}'))
+
+
+def keepAliveReply(dct):
+    ''' Make the reply of the keepAlive message [dct],
+    the seq and timestamp are echoed if they exist.
+    '''
+    if 'seq' not in dct:
+        return KEEP_ALIVE_REPLY
+    return dumps(dict(method='keepAlive',
+                      count='1',
+                      seq=dct['seq'],
+                      timestamp=dct.get('timestamp', '')))
+
+
+# ------------------------------------------------------------------------
+# Schema Table
+# The key is the name of the message,
+# the value is the required fields,
+# the field of None value is required to exist,
+# the field of tuple value is required to be one of the values.
+
+SCHEMAS = dict(
+    keepAliveRequest=dict(method=('keepAlive',),
+                          count=('0',)),
+    keepAliveReply=dict(method=('keepAlive',),
+                        count=('1',)),
+    startTraining=dict(method=('startSession',),
+                       sessionName=('training',),
+                       dataPath=None),
+    startBuilding=dict(method=('startBuilding',),
+                       sessionName=('youbiaoqian', 'wubiaoqian'),
+                       dataPath=None,
+                       modelPath=None),
+    startActive=dict(method=('startSession',),
+                     sessionName=('wubiaoqian',),
+                     dataPath=None,
+                     modelPath=None),
+    startPassive=dict(method=('startSession',),
+                      sessionName=('youbiaoqian',),
+                      dataPath=None,
+                      modelPath=None,
+                      newModelPath=None,
+                      updateCount=None),
+    resumeSession=dict(method=('resumeSession',)),
+    profileStart=dict(method=('profileStart',)),
+    profileStop=dict(method=('profileStop',)),
+    getMetrics=dict(method=('getMetrics',)),
+)
+
+
+def _checks(fields):
+    # Built-in method of compiling the [fields] into the checks
+    return [(key, values) for key, values in fields.items()
+            if key != 'method']
+
+
+def _passes(dct, checks):
+    # Built-in method of checking the [dct] by the [checks]
+    for key, values in checks:
+        value = dct.get(key, None)
+        if value is None or (values is not None and value not in values):
+            return False
+    return True
+
+
+def match(dct, fields):
+    ''' Check the message [dct] by the required [fields],
+    the [fields] are in the format of the values of SCHEMAS.
+    '''
+    if 'method' in fields and dct.get('method', None) not in fields['method']:
+        return False
+    return _passes(dct, _checks(fields))
+
+
+def _index(schemas):
+    # Built-in method of indexing the [schemas] by their methods
+    index = dict()
+    for name, fields in schemas.items():
+        for method in fields['method']:
+            index.setdefault(method, []).append((name, _checks(fields)))
+    return index
+
+
+_schema_index = _index(SCHEMAS)
+
+
+def classify(dct):
+    ''' Match the message [dct] against the schema table
+
+    Outs:
+    - The name of the first matched schema, None refers no schema is matched.
+    '''
+    method = dct.get('method', None)
+    if not isinstance(method, str):
+        return None
+    for name, checks in _schema_index.get(method, ()):
+        if _passes(dct, checks):
+            return name
+    return None
@@ -0,0 +1,100 @@
+'''
+File: protocol/dispatcher.py
+Aim: The table-driven dispatcher of the control messages.
+
+The handlers are registered by the (method, sessionName) of the messages,
+so a message is routed by one dict lookup,
+and the registered commands do not slow down the others.
+
+The routes of a message are tried in the order of
+- The handlers of (method, sessionName);
+- The handlers of (method, None), they accept any sessionName;
+- The default handler.
+The handler is skipped if the message fails on its fields or its condition.
+
+- @Dispatcher: The dispatch table.
+'''
+
+import threading
+
+from . import _checks, _passes
+
+
+class Dispatcher(object):
+    ''' The dispatch table of the control messages.
+
+    Useful methods:
+    - @register: Register the handler of (method, sessionName);
+    - @dispatch: Route the message to its handler.
+    '''
+
+    def __init__(self, default=None):
+        ''' Initialize the empty table
+
+        Args:
+        - @default: The handler of the messages without route, it is called as default(dct, raw).
+        '''
+        self.routes = dict()
+        self.default = default
+
+    def register(self, method, handler, sessionName=None, fields=None, when=None, background=False):
+        ''' Register the [handler] of (method, sessionName),
+        the handlers of the same key are tried in the registered order.
+
+        Args:
+        - @method: The method of the message;
+        - @handler: The handler, it is called as handler(dct, raw);
+        - @sessionName: The sessionName of the message, None refers any sessionName;
+        - @fields: The required fields, in the format of the values of protocol.SCHEMAS;
+        - @when: The condition of the handler, it is called as when(dct), the handler is skipped if it returns False;
+        - @background: Whether the handler runs on independent thread, it is used for the slow commands, the handler should catch its own errors.
+        '''
+        checks = _checks(fields) if fields else []
+        self.routes.setdefault((method, sessionName), []).append(
+            (handler, checks, when, background))
+
+    def dispatch(self, dct, raw=None):
+        ''' Route the message [dct] to its handler
+
+        Args:
+        - @dct: The message;
+        - @raw: The raw bytes of the message, it is passed to the handler for the error messages.
+
+        Outs:
+        - Whether the message is handled, False refers no handler nor default handler is found.
+        '''
+        method = dct.get('method', None)
+        if not isinstance(method, str):
+            method = None
+        name = dct.get('sessionName', None)
+        if isinstance(name, str):
+            keys = ((method, name), (method, None))
+        else:
+            keys = ((method, None),)
+
+        for key in keys:
+            for handler, checks, when, background in self.routes.get(key, ()):
+                if checks and not _passes(dct, checks):
+                    continue
+                if when is not None and not when(dct):
+                    continue
+                self._call(handler, dct, raw, background)
+                return True
+
+        if self.default is None:
+            return False
+
+        self.default(dct, raw)
+        return True
+
+    def _call(self, handler, dct, raw, background):
+        # Built-in method of calling the [handler]
+        if not background:
+            handler(dct, raw)
+            return
+
+        thread = threading.Thread(target=handler,
+                                  args=(dct, raw),
+                                  name=f'Handler of {dct.get("method", None)}')
+        thread.setDaemon(True)
+        thread.start()
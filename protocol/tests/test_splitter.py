@@ -0,0 +1,77 @@
+'''
+File: protocol/tests/test_splitter.py
+Aim: The reassembling of the messages split across the reads by protocol.Splitter.
+
+Usage:
+>> python -m pytest protocol/tests
+'''
+
+import random
+
+from protocol import Splitter, dumps
+
+
+def feed_in_pieces(splitter, stream, rng, max_piece=50):
+    ''' Feed the [stream] in the random pieces of 1 to [max_piece] bytes
+
+    Outs:
+    - The dicts of the complete messages;
+    - The bytes of the malformed messages.
+    '''
+    dcts, errors = [], []
+    idx = 0
+    while idx < len(stream):
+        n = rng.randint(1, max_piece)
+        d, e = splitter.feed(stream[idx:idx+n])
+        dcts += d
+        errors += e
+        idx += n
+    return dcts, errors
+
+
+def test_random_pieces():
+    # The strings have the braces, the quotes, the escapes and the multi-byte characters,
+    # the boundaries of the pieces fall anywhere in them
+    messages = [dict(method='labelComputed', label=f'{i}', text='中文 {"}\\' * (i % 7))
+                for i in range(200)]
+    stream = b''.join([dumps(e) for e in messages])
+
+    rng = random.Random(0)
+    for _ in range(20):
+        splitter = Splitter()
+        dcts, errors = feed_in_pieces(splitter, stream, rng)
+        assert errors == []
+        assert dcts == messages
+        assert splitter.pending == 0
+
+
+def test_incomplete_tail_is_kept():
+    splitter = Splitter()
+    dcts, errors = splitter.feed(b'{"method":"labelComputed","label":"1"}{"method":"sessionSt')
+    assert dcts == [dict(method='labelComputed', label='1')]
+    assert errors == []
+    assert splitter.pending > 0
+
+    dcts, errors = splitter.feed(b'opped"}')
+    assert dcts == [dict(method='sessionStopped')]
+    assert errors == []
+    assert splitter.pending == 0
+
+
+def test_malformed_messages():
+    splitter = Splitter()
+    dcts, errors = splitter.feed(b'Hello from server{"a":1,}{"b":"2"}  ')
+    assert dcts == [dict(b='2')]
+    assert errors == [b'Hello from server', b'{"a":1,}']
+
+
+def test_oversize_message():
+    splitter = Splitter(max_size=100)
+    dcts, errors = splitter.feed(b'{"a":"' + b'x' * 200)
+    assert dcts == []
+    assert len(errors) == 1
+    assert splitter.pending == 0
+
+    # The stream goes on after the malformed message
+    dcts, errors = splitter.feed(b'{"b":"2"}')
+    assert dcts == [dict(b='2')]
@@ -0,0 +1,93 @@
+'''
+File: protocol/tests/test_transport.py
+Aim: The write buffer of protocol.transport.Connection never sends a partial message.
+
+The connection is on one end of the loopback TCP pair with the small buffers,
+the other end is not read until all the messages are sent,
+so most of them are dropped by the policy, and the ones on the wire must be whole.
+
+Usage:
+>> python -m pytest protocol/tests
+'''
+
+import socket
+
+import pytest
+
+from protocol.transport import Connection
+
+message_size = 3000
+
+
+class Loop(object):
+    ''' The stand-in of the EventLoopServer, the connection is flushed by the test '''
+
+    def _request(self, connection):
+        pass
+
+
+def make_pair(max_buffer, policy='drop'):
+    ''' Make the connection of the [max_buffer] and the [policy], and the peer socket,
+    the TCP socket sends a part of the message when its buffer is nearly full, the unix socket pair does not.
+    '''
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    b = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    b.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+    b.connect(listener.getsockname())
+    a, address = listener.accept()
+    listener.close()
+    a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    a.setblocking(False)
+    b.setblocking(False)
+    return Connection(Loop(), a, address, max_buffer=max_buffer, policy=policy), b
+
+
+def drain(connection, peer):
+    ''' Flush the [connection] and read the [peer] until nothing is left '''
+    received = bytearray()
+    for _ in range(1000):
+        connection._flush()
+        try:
+            received += peer.recv(65536)
+        except BlockingIOError:
+            if not connection.pending:
+                break
+    return bytes(received)
+
+
+# The bound below the message size makes the tail of the partly sent message exceed it
+@pytest.mark.parametrize('max_buffer', [100, 5000])
+def test_no_partial_message(max_buffer):
+    connection, peer = make_pair(max_buffer=max_buffer)
+    try:
+        # Every message is one letter repeated, so a partial message breaks the pattern
+        messages = [bytes([65 + i % 26]) * message_size for i in range(50)]
+        accepted = [connection.send(e) for e in messages]
+        assert 0 < sum(accepted) < len(messages)
+        assert connection.dropped == len(messages) - sum(accepted)
+
+        received = drain(connection, peer)
+        assert len(received) == sum(accepted) * message_size
+        expected = b''.join([e for e, ok in zip(messages, accepted) if ok])
+        assert received == expected
+    finally:
+        connection.sock.close()
+        peer.close()
+
+
+def test_started_message_is_finished():
+    # The message larger than the buffer is partly sent at once,
+    # its tail is buffered beyond the bound instead of being dropped
+    connection, peer = make_pair(max_buffer=100)
+    try:
+        big = b'x' * 200000
+        assert connection.send(big)
+        assert connection.pending > connection.max_buffer
+        assert not connection.send(b'y' * 1000)
+
+        assert drain(connection, peer) == big
+    finally:
+        connection.sock.close()
+        peer.close()
@@ -0,0 +1,358 @@
+'''
+File: protocol/transport.py
+Aim: The event-loop TCP server for many concurrent clients.
+
+All the connections are served in one thread by the selectors,
+the sockets are non-blocking and every connection has its own write buffer,
+so a slow client does not block the others.
+
+The connections are indexed by their file numbers,
+so they are removed in O(1) when they are closed.
+
+The messages are sent by Connection.send from any thread,
+the bytes are sent at once if the socket is writable,
+the remains are buffered and flushed by the loop.
+
+The write buffer of every connection is bounded by [max_buffer],
+when a slow client can not take the new message, the [policy] decides
+- 'drop': The new message is dropped and counted;
+- 'disconnect': The client is disconnected.
+The whole messages are dropped, so the client never receives a partial one,
+the unsent tail of the message partly sent is always buffered, it may exceed the [max_buffer] by one message.
+
+- @EventLoopServer: The server;
+- @Connection: The connection of a client.
+'''
+
+import socket
+import selectors
+import threading
+import traceback
+
+backlog = 128
+buffer_size = 1024
+max_buffer = 1024 * 1024  # Bytes
+policy = 'drop'
+
+POLICIES = ('drop', 'disconnect')
+
+
+class Connection(object):
+    ''' The connection of a client.
+
+    Useful methods:
+    - @send: Send the bytes, it can be called from any thread;
+    - @close: Close the connection, it can be called from any thread.
+    '''
+
+    def __init__(self, server, sock, address, max_buffer=max_buffer, policy=policy):
+        ''' Initialize the connection
+
+        Args:
+        - @server: The EventLoopServer owns the connection;
+        - @sock: The non-blocking socket;
+        - @address: The address of the client;
+        - @max_buffer: The max bytes of the write buffer, None refers unbounded;
+        - @policy: The policy of the full write buffer, see POLICIES.
+        '''
+        self.server = server
+        self.sock = sock
+        self.address = address
+        self.fileno = sock.fileno()
+        self.outbuf = bytearray()
+        self.max_buffer = max_buffer
+        self.policy = policy
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.closing = False
+        self.is_connected = True
+
+    @property
+    def pending(self):
+        ''' The number of the buffered bytes to be sent '''
+        return len(self.outbuf)
+
+    def send(self, data):
+        ''' Send the bytes of [data],
+        the remains are buffered if the socket is not writable.
+
+        Outs:
+        - Whether the data is accepted, False refers the connection is closed.
+        '''
+        with self.lock:
+            if self.closing:
+                return False
+
+            n = 0
+            if not self.outbuf:
+                try:
+                    n = self.sock.send(data)
+                except BlockingIOError:
+                    n = 0
+                except OSError:
+                    self.closing = True
+                    self.server._request(self)
+                    return False
+                data = data[n:]
+
+            if not data:
+                return True
+
+            # The unsent tail of the started message is always buffered,
+            # so the client never receives a partial message
+            if n == 0 and self.max_buffer is not None and len(self.outbuf) + len(data) > self.max_buffer:
+                self.dropped += 1
+                if self.policy == 'disconnect':
+                    # The slow client is disconnected without flushing
+                    self.outbuf.clear()
+                    self.closing = True
+                    self.server._request(self)
+                return False
+
+            self.outbuf += data
+
+        self.server._request(self)
+        return True
+
+    def close(self):
+        ''' Close the connection,
+        it is closed by the loop after the buffered bytes are flushed.
+        '''
+        with self.lock:
+            self.closing = True
+        self.server._request(self)
+
+    def _flush(self):
+        # Built-in method of flushing the buffered bytes,
+        # it is called by the loop.
+        # Outs: Whether the buffer is empty.
+        with self.lock:
+            if self.outbuf:
+                try:
+                    n = self.sock.send(self.outbuf)
+                except BlockingIOError:
+                    n = 0
+                except OSError:
+                    self.outbuf.clear()
+                    self.closing = True
+                    return True
+                del self.outbuf[:n]
+            return not self.outbuf
+
+
+class EventLoopServer(object):
+    ''' The event-loop TCP server,
+    the callbacks are called on the loop thread.
+
+    Useful methods:
+    - @bind: Bind and listen on the IP and port;
+    - @start: Start the loop on independent thread;
+    - @serve_forever: Run the loop on the current thread;
+    - @stop: Stop the loop and close all the connections.
+    '''
+
+    def __init__(self, on_connect=None, on_receive=None, on_close=None, buffer_size=buffer_size, backlog=backlog, max_buffer=max_buffer, policy=policy):
+        ''' Initialize the server
+
+        Args:
+        - @on_connect: The callback of new connection, it is called as on_connect(connection);
+        - @on_receive: The callback of received bytes, it is called as on_receive(connection, data);
+        - @on_close: The callback of closed connection, it is called as on_close(connection);
+        - @buffer_size: The size of every receiving;
+        - @backlog: The backlog of the listening socket;
+        - @max_buffer: The max bytes of the write buffer of every connection, None refers unbounded;
+        - @policy: The policy of the full write buffer, see POLICIES.
+        '''
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown policy "{policy}", it should be one of {POLICIES}')
+
+        self.on_connect = on_connect
+        self.on_receive = on_receive
+        self.on_close = on_close
+        self.buffer_size = buffer_size
+        self.backlog = backlog
+        self.max_buffer = max_buffer
+        self.policy = policy
+
+        self.selector = selectors.DefaultSelector()
+        self.connections = dict()
+        self._connections_lock = threading.Lock()
+        self.listener = None
+        self.running = False
+        self.thread = None
+
+        # The connections requested by other threads,
+        # the loop is woken up by the socket pair
+        self._requests = set()
+        self._requests_lock = threading.Lock()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ, 'wake')
+
+    @property
+    def address(self):
+        ''' The bound address '''
+        return self.listener.getsockname()
+
+    def bind(self, IP, port):
+        ''' Bind and listen on the [IP] and [port] '''
+        assert(self.listener is None)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((IP, port))
+        listener.listen(self.backlog)
+        listener.setblocking(False)
+        self.selector.register(listener, selectors.EVENT_READ, 'accept')
+        self.listener = listener
+
+    def start(self):
+        ''' Start the loop on independent thread '''
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='TCP event loop')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def serve_forever(self):
+        ''' Run the loop until @stop '''
+        self.running = True
+        while self.running:
+            for key, mask in self.selector.select(timeout=1):
+                if key.data == 'accept':
+                    self._accept()
+                elif key.data == 'wake':
+                    self._wake()
+                else:
+                    self._serve(key.data, mask)
+
+        for connection in list(self.connections.values()):
+            self._close(connection)
+        self.selector.unregister(self.listener)
+        self.listener.close()
+
+    def broadcast(self, data):
+        ''' Queue the same bytes of [data] to every connection,
+        it never blocks on the slow clients.
+
+        Outs:
+        - The number of the connections accepted the data;
+        - The number of the connections refused the data by the policy.
+        '''
+        with self._connections_lock:
+            connections = list(self.connections.values())
+
+        accepted = 0
+        for connection in connections:
+            if connection.send(data):
+                accepted += 1
+        return accepted, len(connections) - accepted
+
+    def stop(self):
+        ''' Stop the loop and close all the connections '''
+        self.running = False
+        self._notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _notify(self):
+        # Built-in method of waking up the loop
+        try:
+            self._wake_w.send(b'\0')
+        except BlockingIOError:
+            pass
+
+    def _request(self, connection):
+        # Built-in method of requesting the loop to flush or close the [connection]
+        with self._requests_lock:
+            self._requests.add(connection)
+        self._notify()
+
+    def _wake(self):
+        # Built-in method of handling the requests
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self._requests_lock:
+            requests, self._requests = self._requests, set()
+
+        for connection in requests:
+            if self.connections.get(connection.fileno) is not connection:
+                continue
+            if connection.outbuf:
+                self.selector.modify(connection.sock,
+                                     selectors.EVENT_READ | selectors.EVENT_WRITE,
+                                     connection)
+            elif connection.closing:
+                self._close(connection)
+
+    def _accept(self):
+        # Built-in method of accepting the new connections
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            sock.setblocking(False)
+            connection = Connection(self, sock, address,
+                                    max_buffer=self.max_buffer,
+                                    policy=self.policy)
+            with self._connections_lock:
+                self.connections[connection.fileno] = connection
+            self.selector.register(sock, selectors.EVENT_READ, connection)
+            self._callback(self.on_connect, connection)
+
+    def _serve(self, connection, mask):
+        # Built-in method of reading and writing the [connection]
+        if connection.fileno not in self.connections:
+            return
+
+        if mask & selectors.EVENT_READ:
+            try:
+                data = connection.sock.recv(self.buffer_size)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b''
+
+            if data == b'':
+                self._close(connection)
+                return
+
+            if data:
+                self._callback(self.on_receive, connection, data)
+
+        if mask & selectors.EVENT_WRITE and connection.fileno in self.connections:
+            if connection._flush():
+                if connection.closing:
+                    self._close(connection)
+                    return
+                self.selector.modify(connection.sock,
+                                     selectors.EVENT_READ,
+                                     connection)
+
+    def _close(self, connection):
+        # Built-in method of closing the [connection]
+        with self._connections_lock:
+            if self.connections.pop(connection.fileno, None) is None:
+                return
+        with connection.lock:
+            connection.closing = True
+            connection.is_connected = False
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+        self._callback(self.on_close, connection)
+
+    def _callback(self, callback, connection, *args):
+        # Built-in method of calling the [callback],
+        # the connection is closed if it fails
+        if callback is None:
+            return
+        try:
+            callback(connection, *args)
+        except Exception:
+            traceback.print_exc()
+            if callback is not self.on_close:
+                self._close(connection)
@@ -1,24 +1,63 @@
 import time
 import threading
 import traceback
+from BCIClient import metrics, telemetry
 from BCIClient.TCPClient import TCPClient
+from BCIClient.link import Link, Backoff
+from BCIClient.acquisition import get_service, shared_memory_name, eeg_IP, eeg_port, n_channels, freq
+from BCIClient.sharedMemory import AcquisitionProcess
 
 
-def keep_try():
+def keep_try(link):
+    ''' Keep connecting to the server,
+    the sessions in the [link] keep running across the reconnections
+    '''
+    backoff = Backoff()
     while True:
         try:
-            client = TCPClient()
+            # It returns after the connection drops
+            TCPClient(link=link)
+            backoff.reset()
         except:
             traceback.print_exc()
-        time.sleep(5)
+        time.sleep(backoff.next())
 
 
 if __name__ == '__main__':
-    thread = threading.Thread(target=keep_try)
+    # Run the acquisition in its own process if the shared memory is used
+    process = None
+    if shared_memory_name:
+        process = AcquisitionProcess(shared_memory_name,
+                                     eeg_IP,
+                                     eeg_port,
+                                     n_channels,
+                                     freq)
+        process.start()
+
+    metrics.startup('imported')
+    telemetry.enable(telemetry.client_enabled)
+
+    # Open the device stream once, it is kept open across the sessions
+    try:
+        get_service().start()
+        metrics.startup('streaming')
+    except:
+        traceback.print_exc()
+
+    # The local endpoint of the metrics, if the [httpPort] is set
+    metrics.serve()
+
+    link = Link()
+    thread = threading.Thread(target=keep_try, args=(link,), name='Control')
     thread.setDaemon(True)
     thread.start()
 
     while 'q' == input('Press q to Escape'):
         break
 
+    link.close()
+
+    if process is not None:
+        process.stop()
+
     print('Done')